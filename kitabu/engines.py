@@ -0,0 +1,129 @@
+#-*- coding=utf-8 -*-
+"""Engines computing peak usage of a subject in a period.
+
+Peak usage is the maximal sum of sizes of reservations that are concurrent
+at some moment of the period. It is what ``FiniteSizeSubjectMixin`` needs to
+decide whether another reservation fits.
+
+An engine is selected per subject class with ``peak_usage_engine``
+attribute, e.g.:
+
+    class Lane(VariableSizeSubjectMixin, BaseSubject):
+        peak_usage_engine = DatabasePeakUsage
+
+"""
+
+from collections import defaultdict
+
+from django.db import connections
+from django.db.models import Max
+
+from kitabu.utils import has_size_field
+
+
+def supports_window_functions(connection):
+    """Tell whether database behind ``connection`` can run ``SUM() OVER``."""
+    if connection.vendor in ('postgresql', 'oracle'):
+        return True
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    return False
+
+
+class PythonPeakUsage(object):
+    """Fetch overlapping reservations and sweep through them in Python."""
+
+    @classmethod
+    def peak_usage(cls, subject, start, end):
+        dates = defaultdict(lambda: 0)
+        for span in subject.overlapping_spans(start, end):
+            # mark when usage of subject changes
+            dates[span.start] += span.size
+            dates[span.end] -= span.size
+
+        balance = peak = 0
+        for date, delta in sorted(dates.iteritems()):
+            balance += delta
+            peak = max(peak, balance)
+        return peak
+
+
+class DatabasePeakUsage(object):
+    """Compute peak usage inside the database with a window function.
+
+    Only one number is transferred from the database, no matter how many
+    reservations overlap the period. On backends without window functions
+    it falls back to ``PythonPeakUsage``.
+
+    """
+    fallback = PythonPeakUsage
+
+    SQL = (
+        "SELECT MAX(balance) FROM ("
+        "SELECT SUM(delta) OVER (ORDER BY moment, delta ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) "
+        "AS balance FROM ("
+        "SELECT r.%(start)s AS moment, %(size)s AS delta FROM (%(reservations)s) r "
+        "UNION ALL "
+        "SELECT r.%(end)s AS moment, -%(size)s AS delta FROM (%(reservations)s) r"
+        ") events"
+        ") timeline"
+    )
+
+    @classmethod
+    def peak_usage(cls, subject, start, end):
+        reservations = subject.overlapping_reservations(start, end)
+        connection = connections[reservations.db]
+        if not supports_window_functions(connection):
+            return cls.fallback.peak_usage(subject, start, end)
+
+        fields = ['start', 'end']
+        if has_size_field(reservations.model):
+            fields.append('size')
+        sql, params = reservations.values_list(*fields).query.sql_with_params()
+
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(cls.SQL % {
+            'start': qn('start'),
+            'end': qn('end'),
+            'size': 'r.' + qn('size') if 'size' in fields else '1',
+            'reservations': sql,
+        }, tuple(params) * 2)
+        peak = cursor.fetchone()[0]
+        return peak or 0
+
+
+class OccupancySegmentsPeakUsage(object):
+    """Read peak usage from precomputed occupancy segments of the subject.
+
+    Meant for subjects with ``OccupancySegmentsSubjectMixin``.
+
+    """
+
+    @classmethod
+    def peak_usage(cls, subject, start, end):
+        segments = subject.occupancy_segments.filter(start__lt=end, end__gt=start)
+        return segments.aggregate(peak=Max('size'))['peak'] or 0
+
+
+class SlotCountersPeakUsage(object):
+    """Read peak usage from slot counters of the subject.
+
+    Meant for subjects with ``SlotCountersSubjectMixin``. Falls back to
+    ``PythonPeakUsage`` for subjects without fixed slot length and for
+    periods not covered by counters.
+
+    """
+    fallback = PythonPeakUsage
+
+    @classmethod
+    def peak_usage(cls, subject, start, end):
+        slot_length = subject.get_slot_length()
+        if slot_length is None:
+            return cls.fallback.peak_usage(subject, start, end)
+        field = subject.get_reservation_model()._meta.get_field('start')
+        start, end = field.to_python(start), field.to_python(end)
+        if not subject.slot_counters_cover(start, slot_length):
+            return cls.fallback.peak_usage(subject, start, end)
+        return subject.slot_peak_usage(start, end, slot_length)
@@ -37,6 +37,15 @@ class OverlappingReservations(ReservationError):
                 reservation.start, reservation.end, self.reservations))
 
 
+class ConcurrentReservationError(ReservationError):
+    def __init__(self, subject, attempts):
+        self.subject = subject
+        self.attempts = attempts
+
+        super(ConcurrentReservationError, self).__init__(
+            u"Subject %s was concurrently reserved, gave up after %s attempts" % (subject, attempts))
+
+
 class ReservationValidationError(ReservationError):
     pass
 
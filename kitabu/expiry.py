@@ -0,0 +1,94 @@
+#-*- coding=utf-8 -*-
+"""Sweeping expired reservations that were never approved.
+
+Not approved ``ApprovableReservation``s stop counting once their
+``valid_until`` passes, but stay in the table. ``sweep_expired_reservations``
+marks them as expired in small transactions, setting their
+``effective_until`` to ``EXPIRED_UNTIL`` (beginning of time), so they are
+kept for the record but not visited by later sweeps:
+
+    sweep_expired_reservations(HotelRoomReservation)
+
+Deleting them (optionally copying them to an archive model first) has to be
+asked for explicitly:
+
+    sweep_expired_reservations(HotelRoomReservation, delete=True, archive_model=ExpiredReservation)
+
+Run it periodically, e.g. with ``kitabu_sweep_expired_reservations``
+management command from cron.
+
+"""
+
+from django.utils import timezone
+
+from kitabu.models.reservations import expired_until
+from kitabu.transactions import default_retry_policy
+
+
+def expired_reservations(reservation_model, moment=None, marked=True):
+    """Return query set of reservations of ``reservation_model`` not approved before ``moment``.
+
+    Reservations already marked as expired are left out if ``marked`` is False.
+
+    """
+    reservations = reservation_model.objects.with_invalid().filter(
+        approved=False, valid_until__lte=moment or timezone.now())
+    if not marked:
+        reservations = reservations.exclude(effective_until=expired_until())
+    return reservations
+
+
+def sweep_expired_reservations(reservation_model, delete=False, archive_model=None, chunk_size=1000,
+                               retry_policy=None):
+    """Mark expired not approved reservations, ``chunk_size`` per transaction.
+
+    With ``delete``, reservations are deleted instead. If ``archive_model``
+    is given (which requires ``delete``), they are copied to it before
+    deletion. Fields are copied by name; fields of ``archive_model`` not
+    present in ``reservation_model`` must have defaults.
+
+    Return number of marked or removed reservations.
+
+    """
+    if archive_model is not None and not delete:
+        raise ValueError('archive_model can only be used when deleting reservations')
+    moment = timezone.now()
+    retry_policy = retry_policy or default_retry_policy
+    swept = 0
+    last_pk = None
+    while True:
+        reservations = expired_reservations(reservation_model, moment, marked=delete)
+        if last_pk is not None:
+            reservations = reservations.filter(pk__gt=last_pk)
+        pks = list(reservations.order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if pks:
+            swept += retry_policy.run(_sweep_chunk, reservation_model, delete, archive_model, pks, moment)
+        if len(pks) < chunk_size:
+            return swept
+        last_pk = pks[-1]
+
+
+def _sweep_chunk(reservation_model, delete, archive_model, pks, moment):
+    # check again, reservations might have been approved in the meantime
+    reservations = list(expired_reservations(reservation_model, moment).select_for_update().filter(pk__in=pks))
+    if not reservations:
+        return 0
+
+    if not delete:
+        reservation_model.objects.with_invalid().filter(pk__in=[r.pk for r in reservations]).update(
+            effective_until=expired_until())
+        return len(reservations)
+
+    if archive_model is not None:
+        field_names = set(field.attname for field in reservation_model._meta.fields)
+        archive_fields = [
+            field.attname for field in archive_model._meta.fields
+            if field.attname in field_names and not field.primary_key
+        ]
+        archive_model.objects.bulk_create([
+            archive_model(**dict((name, getattr(reservation, name)) for name in archive_fields))
+            for reservation in reservations
+        ])
+
+    reservation_model.objects.with_invalid().filter(pk__in=[r.pk for r in reservations]).delete()
+    return len(reservations)
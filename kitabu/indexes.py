@@ -0,0 +1,72 @@
+#-*- coding=utf-8 -*-
+"""Composite indexes for overlap queries on reservation models.
+
+Almost every query kitabu makes looks for reservations of a subject
+overlapping a period: ``subject = ? AND start < ? AND end > ?`` (and
+``effective_until > ?`` for ``ApprovableReservation``s). Separate indexes
+on ``start`` and ``end`` don't serve it well, one composite index does.
+Reservation models are defined in projects, so the index is created by
+their migrations, e.g. with South:
+
+    from kitabu.indexes import create_overlap_index, delete_overlap_index
+
+    class Migration(SchemaMigration):
+        def forwards(self, orm):
+            create_overlap_index(db, orm['lanes.LaneReservation'])
+
+        def backwards(self, orm):
+            delete_overlap_index(db, orm['lanes.LaneReservation'])
+
+Without South, run SQL returned by ``overlap_index_sql``.
+
+Upgrading an ``ApprovableReservation`` model to a version with the
+``effective_until`` column requires filling it for existing rows, which is
+what ``fill_effective_until`` does. Until then, those reservations are
+treated as not valid:
+
+    def forwards(self, orm):
+        db.add_column(...)
+        if not db.dry_run:
+            fill_effective_until(orm['lanes.LaneReservation'])
+        create_overlap_index(db, orm['lanes.LaneReservation'])
+
+"""
+
+from django.db import connection as default_connection
+from django.db.models import F
+
+from kitabu.models.reservations import approved_until
+
+
+def overlap_index_columns(reservation_model):
+    """Return names of columns of the overlap index of ``reservation_model``."""
+    field_names = ['subject', 'start', 'end']
+    if 'effective_until' in [field.name for field in reservation_model._meta.fields]:
+        field_names.append('effective_until')
+    return [reservation_model._meta.get_field(name).column for name in field_names]
+
+
+def create_overlap_index(db, reservation_model):
+    """Create overlap index with South's ``db``."""
+    db.create_index(reservation_model._meta.db_table, overlap_index_columns(reservation_model))
+
+
+def delete_overlap_index(db, reservation_model):
+    """Drop overlap index with South's ``db``."""
+    db.delete_index(reservation_model._meta.db_table, overlap_index_columns(reservation_model))
+
+
+def overlap_index_sql(reservation_model, connection=None):
+    """Return SQL creating overlap index of ``reservation_model``."""
+    qn = (connection or default_connection).ops.quote_name
+    table = reservation_model._meta.db_table
+    columns = overlap_index_columns(reservation_model)
+    return 'CREATE INDEX %s ON %s (%s);' % (
+        qn('%s_overlap' % table), qn(table), ', '.join(qn(column) for column in columns))
+
+
+def fill_effective_until(reservation_model):
+    """Fill ``effective_until`` of all existing reservations of ``reservation_model``."""
+    reservations = reservation_model._base_manager
+    reservations.filter(approved=True).update(effective_until=approved_until())
+    reservations.filter(approved=False).update(effective_until=F('valid_until'))
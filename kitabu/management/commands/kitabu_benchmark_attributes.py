@@ -0,0 +1,79 @@
+#-*- coding: utf-8 -*-
+
+from optparse import make_option
+from timeit import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kitabu.management.commands.kitabu_sweep_expired_reservations import _get_model
+from kitabu.utils import has_size_field
+
+
+class GetattributeEnsureSize(object):
+    """Former implementation of ``EnsureSize``, kept for comparison."""
+    def __getattribute__(self, name, *args):
+        try:
+            return super(GetattributeEnsureSize, self).__getattribute__(name, *args)
+        except AttributeError:
+            if name == 'size':
+                return 1
+            else:
+                raise
+
+
+def _missing_size(reservation):
+    raise AttributeError('size')
+
+
+def former_model(reservation_model):
+    """Return proxy of ``reservation_model`` using former ``EnsureSize``.
+
+    Without size field, ``size`` of the proxy is missing again (it hides the
+    class attribute of current ``EnsureSize``), so it is found the former way.
+
+    """
+    attrs = {
+        '__module__': reservation_model.__module__,
+        'Meta': type('Meta', (), {'proxy': True}),
+    }
+    if not has_size_field(reservation_model):
+        attrs['size'] = property(_missing_size)
+    return type('Former%s' % reservation_model.__name__, (GetattributeEnsureSize, reservation_model), attrs)
+
+
+def load_reservations(reservation_model, rows):
+    """Build reservations from ``rows`` the way query sets do and read what timelines read."""
+    for row in rows:
+        reservation = reservation_model(*row)
+        reservation.subject_id, reservation.start, reservation.end, reservation.size
+
+
+class Command(BaseCommand):
+    args = '<app_label.ReservationModel>'
+    help = ('Compares cost of building reservations from database rows and reading their attributes '
+            'with former and current EnsureSize')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=1000,
+                    help='How many reservations to fetch from the database'),
+        make_option('--number', type='int', default=100,
+                    help='How many times to build all fetched reservations'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give one reservation model')
+        reservation_model = _get_model(args[0])
+        attnames = [field.attname for field in reservation_model._meta.fields]
+        rows = list(reservation_model._base_manager.values_list(*attnames)[:options['rows']])
+        if not rows:
+            raise CommandError('No reservations of %s to build' % args[0])
+
+        number = options['number']
+        results = []
+        for label, model in [('before', former_model(reservation_model)), ('after', reservation_model)]:
+            seconds = timeit(lambda: load_reservations(model, rows), number=number)
+            results.append(seconds)
+            self.stdout.write('%s: %.3fs for %d times %d reservations (%.0f ns per reservation)' % (
+                label, seconds, number, len(rows), seconds / number / len(rows) * 10 ** 9))
+        self.stdout.write('speedup: %.1fx' % (results[0] / results[1]))
@@ -0,0 +1,46 @@
+#-*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from kitabu.expiry import sweep_expired_reservations
+
+
+def _get_model(label):
+    try:
+        app_label, model_name = label.split('.')
+    except ValueError:
+        raise CommandError('Model must be given as app_label.ModelName, got "%s"' % label)
+    model = get_model(app_label, model_name)
+    if model is None:
+        raise CommandError('Unknown model "%s"' % label)
+    return model
+
+
+class Command(BaseCommand):
+    args = '<app_label.ReservationModel ...>'
+    help = 'Marks (or deletes) not approved reservations whose approval time has passed'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--delete', action='store_true', default=False,
+                    help='Delete reservations instead of marking them as expired'),
+        make_option('--archive', default=None,
+                    help='Model (app_label.ModelName) to copy reservations to before deleting them'),
+        make_option('--chunk-size', type='int', default=1000,
+                    help='How many reservations to remove in one transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give at least one reservation model')
+        if options['archive'] and not options['delete']:
+            raise CommandError('--archive can only be used with --delete')
+        archive_model = _get_model(options['archive']) if options['archive'] else None
+        action = 'removed' if options['delete'] else 'marked'
+        for label in args:
+            swept = sweep_expired_reservations(
+                _get_model(label), delete=options['delete'], archive_model=archive_model,
+                chunk_size=options['chunk_size'])
+            self.stdout.write('%s: %s %d expired reservations' % (label, action, swept))
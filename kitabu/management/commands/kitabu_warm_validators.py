@@ -0,0 +1,17 @@
+#-*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kitabu.models.validators import warm_static_validators
+
+
+class Command(BaseCommand):
+    help = 'Resolves functions of all static validators and reports the ones that cannot be resolved'
+
+    def handle(self, *args, **options):
+        errors = warm_static_validators()
+        for name, error in sorted(errors.items()):
+            self.stderr.write('%s: %s: %s' % (name, error.__class__.__name__, error))
+        if errors:
+            raise CommandError('%d static validator function(s) could not be resolved' % len(errors))
+        self.stdout.write('All static validator functions resolved')
@@ -0,0 +1,151 @@
+#-*- coding=utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import models
+from django.db.models import F
+from django.utils import timezone
+
+from kitabu.exceptions import ConcurrentReservationError
+from kitabu.utils import overlap_memo
+
+
+class OptimisticLockingSubjectMixin(models.Model):
+    """Mixin for subjects reserved without locking them.
+
+    Instead of ``SELECT ... FOR UPDATE`` on the subject (see
+    ``SECURE_RESERVATIONS`` setting), ``reservations_version`` of the subject
+    is read before availability is checked and bumped with a compare-and-swap
+    update right before the reservation is saved. If another reservation was
+    made in the meantime the update matches no row and the whole attempt is
+    repeated, up to ``optimistic_locking_attempts`` times. Then
+    ``ConcurrentReservationError`` is raised.
+
+    Reservations on the subject neither wait for each other nor block
+    readers, so use it for subjects that are reserved very often.
+
+    Retrying needs each query to see data committed by other transactions,
+    as with READ COMMITTED isolation level (PostgreSQL default).
+
+    With ``AtomicReserver`` there is no retrying: reservation fails with
+    ``ConcurrentReservationError`` if the subject was reserved after it was
+    fetched from the database.
+
+    """
+    class Meta:
+        abstract = True
+
+    optimistic_locking = True
+    optimistic_locking_attempts = 3
+
+    reservations_version = models.PositiveIntegerField(default=0)
+
+    def reserve_without_transaction(self, **kwargs):
+        for attempt in range(self.optimistic_locking_attempts):
+            self._read_reservations_version()
+            try:
+                return self.create_reservation(**kwargs)
+            except ConcurrentReservationError:
+                pass
+        raise ConcurrentReservationError(self, self.optimistic_locking_attempts)
+
+    def _read_reservations_version(self):
+        self.reservations_version = self.__class__._base_manager.filter(pk=self.pk).values_list(
+            'reservations_version', flat=True)[0]
+        # spans memoized before the version was read may be outdated
+        overlap_memo.invalidate()
+
+    def _before_save_reservations(self, reservations):
+        super(OptimisticLockingSubjectMixin, self)._before_save_reservations(reservations)
+        updated = self.__class__._base_manager.filter(
+            pk=self.pk,
+            reservations_version=self.reservations_version,
+        ).update(reservations_version=F('reservations_version') + 1)
+        if not updated:
+            raise ConcurrentReservationError(self, 1)
+        self.reservations_version += 1
+
+
+class BaseReservationLock(models.Model):
+    """Lock of one time bucket of a subject, see ``BucketLockingSubjectMixin``.
+
+    When subclassing this class, add foreign key to your subject class with
+    related name of "reservation_locks" and make it unique with ``bucket``:
+
+        class LaneLock(BaseReservationLock):
+            subject = models.ForeignKey(Lane, related_name='reservation_locks')
+
+            class Meta:
+                unique_together = ('subject', 'bucket')
+
+    """
+    class Meta:
+        abstract = True
+
+    bucket = models.DateTimeField()
+
+    def __unicode__(self):
+        return "bucket: %s" % self.bucket
+
+
+class BucketLockingSubjectMixin(models.Model):
+    """Mixin for subjects locked per time bucket rather than as a whole.
+
+    With ``SECURE_RESERVATIONS`` setting, reserving locks rows of
+    ``BaseReservationLock`` subclass for all buckets ``lock_bucket_size``
+    long that the reservation touches (instead of the subject row). Rows are
+    locked in order of time, so reservations never deadlock, and
+    reservations in distant periods don't wait for each other.
+
+    Overlapping reservations always share a bucket, so availability checks
+    are as safe as with subject locks. Validators that look beyond the
+    period of reservation (e.g. ``MaxReservationsPerUserValidator``) are not
+    protected.
+
+    """
+    class Meta:
+        abstract = True
+
+    bucket_locking = True
+    lock_bucket_size = timedelta(days=1)
+
+    @classmethod
+    def get_reservation_lock_model(cls):
+        return cls._meta.get_field_by_name('reservation_locks')[0].model
+
+    def reserve_without_transaction(self, **kwargs):
+        if settings.SECURE_RESERVATIONS:
+            self.lock_periods([(kwargs['start'], kwargs['end'])])
+        return self.create_reservation(**kwargs)
+
+    def get_buckets(self, start, end):
+        """Return starts of buckets touched by period between ``start`` and ``end``."""
+        field = self.get_reservation_model()._meta.get_field('start')
+        start, end = field.to_python(start), field.to_python(end)
+
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc) if timezone.is_aware(start) else datetime(1970, 1, 1)
+        bucket_seconds = self._seconds(self.lock_bucket_size)
+        bucket = epoch + timedelta(seconds=self._seconds(start - epoch) // bucket_seconds * bucket_seconds)
+
+        buckets = []
+        while bucket < end:
+            buckets.append(bucket)
+            bucket += self.lock_bucket_size
+        return buckets
+
+    def lock_periods(self, periods):
+        """Lock all buckets touched by (start, end) ``periods``, creating missing ones."""
+        buckets = sorted(set(bucket for start, end in periods for bucket in self.get_buckets(start, end)))
+        locks = self.reservation_locks.filter(bucket__in=buckets)
+
+        existing_buckets = set(locks.values_list('bucket', flat=True))
+        for bucket in buckets:
+            if bucket not in existing_buckets:
+                # get_or_create copes with concurrent creation of the same bucket
+                self.reservation_locks.get_or_create(bucket=bucket)
+
+        overlap_memo.select_for_update(locks.order_by('bucket'))
+
+    def _seconds(self, delta):
+        return delta.days * 86400 + delta.seconds
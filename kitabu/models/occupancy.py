@@ -0,0 +1,97 @@
+#-*- coding=utf-8 -*-
+
+from django.db import models
+
+from kitabu.engines import OccupancySegmentsPeakUsage
+from kitabu.models.reservations import track_reservation_periods
+from kitabu.models.subjects import forbid_approvable_reservations
+from kitabu.search.utils import Timeline
+
+
+class BaseOccupancySegment(models.Model):
+    """Period in which summed size of reservations on a subject is constant.
+
+    Segments are denormalized data maintained by
+    ``OccupancySegmentsSubjectMixin``. They cover only periods in which
+    anything is reserved, so peak usage of a subject in a period is simply
+    the biggest ``size`` of segments overlapping it.
+
+    When subclassing this class, add foreign key to your subject class
+    with related name of "occupancy_segments":
+
+        subject = models.ForeignKey(YourSubject, related_name='occupancy_segments')
+
+    """
+    class Meta:
+        abstract = True
+
+    start = models.DateTimeField(db_index=True)
+    end = models.DateTimeField(db_index=True)
+    size = models.PositiveIntegerField()
+
+    def __unicode__(self):
+        return "start: %s, end: %s, size: %s" % (self.start, self.end, self.size)
+
+
+class OccupancySegmentsSubjectMixin(models.Model):
+    """Mixin for subjects that keep their occupancy in ``BaseOccupancySegment``s.
+
+    Segments are updated whenever a reservation on the subject is saved or
+    deleted, so availability checks and searches need no sweep over
+    reservations. Mix in before FiniteSizeSubjectMixin (and its subclasses).
+
+    Updates made without model signals (``QuerySet.update``, ``delete`` or
+    ``bulk_create``) are not tracked, unless followed by
+    ``kitabu.signals.reservations_changed`` (as ``AtomicReserver.bulk_reserve``
+    does). Call ``update_occupancy`` for affected periods otherwise.
+
+    Segments can't follow expiry of not approved reservations, so the mixin
+    can't be combined with ``SubjectWithApprovableReservations``
+    (``ImproperlyConfigured`` is raised when such model is defined).
+
+    """
+    class Meta:
+        abstract = True
+
+    peak_usage_engine = OccupancySegmentsPeakUsage
+
+    @classmethod
+    def get_occupancy_segment_model(cls):
+        return cls._meta.get_field_by_name('occupancy_segments')[0].model
+
+    def update_occupancy(self, start, end):
+        """Recompute occupancy segments in period between ``start`` and ``end``.
+
+        The period is extended to cover segments that cross or touch its
+        bounds, so these can be replaced as a whole and merged with new ones.
+        The subject row is locked first, so concurrent rewrites of
+        overlapping periods (in their own transactions, as ``reserve``
+        makes) don't interleave.
+
+        """
+        list(self.__class__._base_manager.select_for_update().filter(pk=self.pk))
+        segments = self.occupancy_segments.filter(start__lte=end, end__gte=start)
+        for segment in segments:
+            start = min(start, segment.start)
+            end = max(end, segment.end)
+        segments.delete()
+
+        new_segments = []
+        balance = 0
+        previous_moment = None
+        for moment, delta in Timeline(start, end, subject=self):
+            if delta == 0:
+                continue
+            if balance > 0:
+                new_segments.append(self.get_occupancy_segment_model()(
+                    subject=self, start=previous_moment, end=moment, size=balance))
+            balance += delta
+            previous_moment = moment
+
+        self.get_occupancy_segment_model().objects.bulk_create(new_segments)
+
+
+forbid_approvable_reservations(OccupancySegmentsSubjectMixin)
+track_reservation_periods(OccupancySegmentsSubjectMixin,
+                          lambda subject, start, end: subject.update_occupancy(start, end),
+                          'occupancy')
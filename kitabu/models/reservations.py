@@ -1,12 +1,17 @@
 #-*- coding=utf-8 -*-
 
 import warnings
+from datetime import datetime
 
-from django.db import models, transaction
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models.signals import pre_save, post_save, post_delete
 
-from kitabu.utils import EnsureSize, AtomicReserver
+from kitabu.utils import EnsureSize, AtomicReserver, overlap_memo
+from kitabu.signals import reservations_changed, transaction_rolled_back
+from kitabu.transactions import default_retry_policy
 from kitabu.models.managers import ApprovableReservationsManager
-from kitabu.exceptions import OutdatedReservationError
+from kitabu.exceptions import OutdatedReservationError, TooLong
 
 from django.conf import settings
 from django.utils import timezone
@@ -50,6 +55,31 @@ class BaseReservation(models.Model, EnsureSize):
     def __unicode__(self):
         return "id: %s, start: %s, end: %s" % (self.id, self.start, self.end)
 
+    def clean(self):
+        super(BaseReservation, self).clean()
+        try:
+            self.check_max_duration()
+        except TooLong as e:
+            raise ValidationError('Reservation may last at most %s seconds' % e.max_allowed_seconds)
+
+    def save(self, *args, **kwargs):
+        self.check_max_duration()
+        return super(BaseReservation, self).save(*args, **kwargs)
+
+    def check_max_duration(self):
+        """Raise ``TooLong`` if reservation is longer than ``max_reservation_duration`` of subject model.
+
+        Overlap queries rely on no stored reservation being longer than
+        that (see ``overlap_lookups``), so it is checked on every save.
+
+        """
+        max_duration = self._get_max_duration()
+        if max_duration is None:
+            return
+        field = self._meta.get_field('start')
+        if field.to_python(self.end) - field.to_python(self.start) > max_duration:
+            raise TooLong(max_duration.days * 24 * 3600 + max_duration.seconds)
+
     # TODO: According to django design practices the following 3 methods should
     # be methods on manager, not model.
     @classmethod
@@ -70,7 +100,42 @@ class BaseReservation(models.Model, EnsureSize):
     def colliding_reservations(cls, start, end, *args, **kwargs):
         """Return reservations on ``clusters`` that overlap <start, end> period.
         """
-        return cls.objects.filter(start__lt=end, end__gt=start, *args, **kwargs)
+        kwargs.update(cls.overlap_lookups(start, end))
+        return cls.objects.filter(*args, **kwargs)
+
+    @classmethod
+    def overlap_lookups(cls, start, end):
+        """Return lookups for reservations that overlap <start, end> period.
+
+        If subject model has ``max_reservation_duration``, reservations
+        starting earlier than that before ``start`` are excluded up front,
+        so ``start`` is bounded on both sides. That is correct only as long
+        as no reservation is longer, which ``save`` makes sure of.
+
+        """
+        lookups = {'start__lt': end, 'end__gt': start}
+        max_duration = cls._get_max_duration()
+        if max_duration is not None:
+            lookups['start__gt'] = cls._meta.get_field('start').to_python(start) - max_duration
+        return lookups
+
+    @classmethod
+    def _get_max_duration(cls):
+        return getattr(cls._meta.get_field('subject').rel.to, 'max_reservation_duration', None)
+
+
+def approved_until():
+    """Return ``effective_until`` of approved reservations, aware if time zones are used."""
+    if settings.USE_TZ:
+        return timezone.make_aware(ApprovableReservation.APPROVED_UNTIL, timezone.utc)
+    return ApprovableReservation.APPROVED_UNTIL
+
+
+def expired_until():
+    """Return ``effective_until`` of reservations marked as expired, aware if time zones are used."""
+    if settings.USE_TZ:
+        return timezone.make_aware(ApprovableReservation.EXPIRED_UNTIL, timezone.utc)
+    return ApprovableReservation.EXPIRED_UNTIL
 
 
 class ApprovableReservation(models.Model):
@@ -92,38 +157,63 @@ class ApprovableReservation(models.Model):
     Overrides default manager to filter out outdated reservations that didn't
     get approved.
 
+    Whether reservation is valid is kept in one more field,
+    ``effective_until``: it is ``valid_until`` of not approved reservations
+    and ``APPROVED_UNTIL`` (end of time) of approved ones, so valid
+    reservations are simply those with ``effective_until`` in the future.
+    Unlike ``approved OR valid_until > now``, that condition can be answered
+    from an index, e.g. on (subject_id, start, end, effective_until). It is
+    updated on ``save`` (and by ``SubjectWithApprovableReservations`` for
+    bulk reservations), but not by ``QuerySet.update``. When adding the
+    column to an existing table, fill it with
+    ``kitabu.indexes.fill_effective_until`` in the same migration.
+    Expired reservations marked by ``kitabu.expiry`` have it set to
+    ``EXPIRED_UNTIL`` (beginning of time) instead, until saved again.
+
     """
     class Meta:
         abstract = True
 
+    APPROVED_UNTIL = datetime(9999, 12, 31)
+    EXPIRED_UNTIL = datetime(1970, 1, 1)
+
     objects = ApprovableReservationsManager()
 
     approved = models.BooleanField(default=True, db_index=True)
     valid_until = models.DateTimeField(null=True, db_index=True)
+    effective_until = models.DateTimeField(null=True, db_index=True, editable=False)
 
     def is_valid(self):
         """Return True, unless reservation is not aproved and outdated."""
         return self.approved or self.valid_until > now()
 
-    def approve(self):
+    def save(self, *args, **kwargs):
+        self.update_effective_until()
+        return super(ApprovableReservation, self).save(*args, **kwargs)
+
+    def update_effective_until(self):
+        """Set ``effective_until`` according to ``approved`` and ``valid_until``."""
+        if self.approved:
+            self.effective_until = approved_until()
+        else:
+            self.effective_until = self.valid_until
+
+    def approve(self, retry_policy=None):
         """Mark reservation as approved and save it."""
-        with transaction.commit_manually():
-            try:
-                if settings.SECURE_RESERVATIONS:
-                    # explicitly lock subject before approving the reservation
-                    list(self.subject.__class__.objects.select_for_update().filter(pk=self.subject.pk))
+        return (retry_policy or default_retry_policy).run(self._approve)
 
-                self.approved = True
-                self.save()
+    def _approve(self):
+        if settings.SECURE_RESERVATIONS:
+            # explicitly lock subject before approving the reservation
+            list(self.subject.__class__.objects.select_for_update().filter(pk=self.subject.pk))
 
-                if self.valid_until > now():
-                    transaction.commit()
-                    return True
-                else:
-                    raise OutdatedReservationError
-            except:
-                transaction.rollback()
-                raise
+        self.approved = True
+        self.save()
+
+        if self.valid_until > now():
+            return True
+        else:
+            raise OutdatedReservationError
 
 
 class ReservationWithSize(models.Model):
@@ -134,6 +224,30 @@ class ReservationWithSize(models.Model):
     size = models.PositiveIntegerField()
 
 
+class ExclusiveSize(object):
+    """Descriptor of ``size`` of ``ReservationMaybeExclusive``.
+
+    Size of exclusive reservation is size of its subject, but it is read
+    from the subject only when first needed, so instantiating reservations
+    (e.g. iterating over a query set) makes no queries for subjects.
+
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if instance.__dict__.get('exclusive') and not instance.__dict__.get('_subject_size_known'):
+            instance.__dict__['size'] = instance.subject.size
+            instance.__dict__['_subject_size_known'] = True
+        try:
+            return instance.__dict__['size']
+        except KeyError:
+            raise AttributeError('size')
+
+    def __set__(self, instance, value):
+        instance.__dict__['size'] = value
+
+
 class ReservationMaybeExclusive(ReservationWithSize):
     """Subclass of ReservationWithSize that allows exclusiveness.
 
@@ -148,28 +262,57 @@ class ReservationMaybeExclusive(ReservationWithSize):
     To make sure that changing size of related subject won't break the
     exclusive reservation functionality, use ExclusivableVariableSizeSubjectMixin
     that will update all exclusive reservation when size of subject is changed.
+
+    Size of exclusive reservation is read from its subject on first access
+    (see ``ExclusiveSize``). Use ``select_related('subject')`` or
+    ``fill_exclusive_sizes`` when reading sizes of many reservations.
     """
     class Meta:
         abstract = True
 
     exclusive = models.BooleanField(default=False, db_index=True)
 
+    size = ExclusiveSize()
+
     def __init__(self, *args, **kwargs):
         super(ReservationMaybeExclusive, self).__init__(*args, **kwargs)
         if self.exclusive:
-            self.__dict__['size'] = self.subject.size
+            self.__dict__.pop('_subject_size_known', None)
             if 'size' in kwargs:
                 warnings.warn("Explicitely setting size for exclusive reservation is ignored")
 
     def __setattr__(self, name, value):
-        if name == 'size' and getattr(self, 'size', False) and getattr(self, 'exclusive', False):
+        if name == 'size' and self.__dict__.get('size') and self.__dict__.get('exclusive'):
             raise AttributeError('Cannot explicitely change size of exclusive reservation')
         super(ReservationMaybeExclusive, self).__setattr__(name, value)
 
     def save(self, *args, **kwargs):
         super(ReservationMaybeExclusive, self).save(*args, **kwargs)
         if self.exclusive:
-            self.__dict__['size'] = self.subject.size
+            self.__dict__.pop('_subject_size_known', None)
+
+    @classmethod
+    def fill_exclusive_sizes(cls, reservations):
+        """Set size of exclusive ``reservations`` to size of their subjects.
+
+        Sizes of all subjects are fetched with one query, instead of one
+        query per reservation on first access to ``size``. Return list of
+        ``reservations``.
+
+        """
+        reservations = list(reservations)
+        pending = [
+            r for r in reservations
+            if r.__dict__.get('exclusive') and not r.__dict__.get('_subject_size_known')
+        ]
+        if pending:
+            subject_model = cls._meta.get_field('subject').rel.to
+            sizes = dict(subject_model._base_manager.filter(
+                pk__in=set(r.subject_id for r in pending)).values_list('pk', 'size'))
+            for reservation in pending:
+                reservation.__dict__['size'] = sizes[reservation.subject_id]
+                reservation.__dict__['_subject_size_known'] = True
+        return reservations
 
 
 class ReservationGroup(models.Model):
@@ -190,13 +333,73 @@ class ReservationGroup(models.Model):
         abstract = True
 
     @classmethod
-    @transaction.commit_manually
     def reserve(cls, *args, **kwargs):
-        try:
-            group = cls.objects.create()
-            AtomicReserver.non_transactional_reserve(*args, group=group, **kwargs)
-            transaction.commit()
-            return group
-        except:
-            transaction.rollback()
-            raise
+        retry_policy = kwargs.pop('retry_policy', None) or default_retry_policy
+        return retry_policy.run(cls._reserve, AtomicReserver.non_transactional_reserve, *args, **kwargs)
+
+    @classmethod
+    def bulk_reserve(cls, *args, **kwargs):
+        """Like ``reserve`` but with ``AtomicReserver.bulk_reserve`` semantics."""
+        retry_policy = kwargs.pop('retry_policy', None) or default_retry_policy
+        return retry_policy.run(cls._reserve, AtomicReserver.non_transactional_bulk_reserve, *args, **kwargs)
+
+    @classmethod
+    def _reserve(cls, non_transactional_reserve, *args, **kwargs):
+        group = cls.objects.create()
+        non_transactional_reserve(*args, group=group, **kwargs)
+        return group
+
+
+def _invalidate_overlap_memo(sender, instance=None, **kwargs):
+    if instance is None or isinstance(instance, BaseReservation):
+        overlap_memo.invalidate()
+
+
+post_save.connect(_invalidate_overlap_memo, dispatch_uid='kitabu_overlap_memo_post_save')
+post_delete.connect(_invalidate_overlap_memo, dispatch_uid='kitabu_overlap_memo_post_delete')
+reservations_changed.connect(_invalidate_overlap_memo, dispatch_uid='kitabu_overlap_memo_reservations_changed')
+transaction_rolled_back.connect(_invalidate_overlap_memo, dispatch_uid='kitabu_overlap_memo_transaction_rolled_back')
+
+
+def track_reservation_periods(subject_mixin, update, name):
+    """Call ``update(subject, start, end)`` whenever reservations in a period change.
+
+    Covers reservations of subjects being instances of ``subject_mixin``
+    that are saved (both their old and new period), deleted and changed in
+    bulk (``reservations_changed``). Used to keep data denormalized on
+    subjects, like occupancy segments and slot counters, up to date.
+
+    """
+    old_period_attname = '_old_%s_period' % name
+
+    def tracks(reservation):
+        if not isinstance(reservation, BaseReservation):
+            return False
+        subject_model = reservation._meta.get_field('subject').rel.to
+        return issubclass(subject_model, subject_mixin)
+
+    def remember_old_period(sender, instance, **kwargs):
+        if instance.pk is not None and tracks(instance):
+            old_periods = list(sender._base_manager.filter(pk=instance.pk).values_list('start', 'end'))
+            if old_periods:
+                setattr(instance, old_period_attname, old_periods[0])
+
+    def update_reservation_periods(sender, instance, **kwargs):
+        if not tracks(instance):
+            return
+        old_period = instance.__dict__.pop(old_period_attname, None)
+        if old_period:
+            update(instance.subject, *old_period)
+        update(instance.subject,
+               instance._meta.get_field('start').to_python(instance.start),
+               instance._meta.get_field('end').to_python(instance.end))
+
+    def update_changed_period(sender, subject, start, end, **kwargs):
+        if isinstance(subject, subject_mixin):
+            update(subject, start, end)
+
+    pre_save.connect(remember_old_period, weak=False, dispatch_uid='kitabu_%s_pre_save' % name)
+    post_save.connect(update_reservation_periods, weak=False, dispatch_uid='kitabu_%s_post_save' % name)
+    post_delete.connect(update_reservation_periods, weak=False, dispatch_uid='kitabu_%s_post_delete' % name)
+    reservations_changed.connect(update_changed_period, weak=False,
+                                 dispatch_uid='kitabu_%s_reservations_changed' % name)
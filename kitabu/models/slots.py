@@ -0,0 +1,218 @@
+#-*- coding=utf-8 -*-
+
+import sys
+from array import array
+from base64 import b64decode, b64encode
+from datetime import datetime
+
+from django.db import models
+from django.utils import timezone
+
+from kitabu.engines import SlotCountersPeakUsage
+from kitabu.models.reservations import track_reservation_periods
+from kitabu.models.subjects import forbid_approvable_reservations
+from kitabu.models.validators import FullTimeValidator, validator_registry
+from kitabu.search.utils import Timeline
+from kitabu.utils import load_spans
+
+now = timezone.now
+
+
+def _pack(counters):
+    counters = array('I', counters)
+    if sys.byteorder == 'big':
+        counters.byteswap()
+    return b64encode(counters.tostring())
+
+
+def _unpack(data):
+    counters = array('I')
+    counters.fromstring(b64decode(data))
+    if sys.byteorder == 'big':
+        counters.byteswap()
+    return counters
+
+
+class BaseSlotCountersChunk(models.Model):
+    """Used size of subsequent slots of a subject, beginning at ``start``.
+
+    Chunks are denormalized data maintained by ``SlotCountersSubjectMixin``.
+    Each of them keeps ``slot_counters_chunk_size`` counters of the subject,
+    packed into ``counters``, and starts at a multiple of its length since
+    the epoch. Chunks with no slots used are not kept.
+
+    When subclassing this class, add foreign key to your subject class
+    with related name of "slot_counters":
+
+        subject = models.ForeignKey(YourSubject, related_name='slot_counters')
+
+    and make ``subject`` and ``start`` unique together.
+
+    """
+    class Meta:
+        abstract = True
+
+    start = models.DateTimeField(db_index=True)
+    counters = models.TextField()
+
+    def __unicode__(self):
+        return "start: %s, counters: %s" % (self.start, list(_unpack(self.counters)))
+
+
+class SlotCountersSubjectMixin(models.Model):
+    """Mixin for subjects reserved in whole slots, keeping used size per slot.
+
+    Used size of every slot is stored in ``BaseSlotCountersChunk``s of the
+    subject and updated whenever a reservation on the subject is saved or
+    deleted. Capacity checks, ``Subjects`` searches and ``FindPeriod`` then
+    read counters of the searched period instead of reservations.
+
+    Length of slots is ``slot_length`` or, if it is None, the one enforced by
+    ``FullTimeValidator`` attached to the subject (e.g. an hour for
+    ``interval_type`` of 'minute' and ``interval`` of 0). Subjects without
+    slot length work as usual. Reservations not aligned to slots make every
+    slot they touch count as used by them.
+
+    Only chunks from the current one on are kept; past ones are deleted
+    whenever counters are updated. Periods starting before the current
+    chunk are checked against reservations instead.
+
+    Mix in before FiniteSizeSubjectMixin (and its subclasses). As with
+    occupancy segments, changes made without model signals are not tracked
+    (see ``update_slot_counters``), and the mixin can't be combined with
+    ``SubjectWithApprovableReservations``.
+
+    """
+    class Meta:
+        abstract = True
+
+    peak_usage_engine = SlotCountersPeakUsage
+    slot_length = None
+    slot_counters_chunk_size = 96
+
+    @classmethod
+    def get_slot_counters_chunk_model(cls):
+        return cls._meta.get_field_by_name('slot_counters')[0].model
+
+    def get_slot_length(self, validators=None):
+        """Return length of slots or None if subject has no fixed slots."""
+        if self.slot_length is not None:
+            return self.slot_length
+        if validators is None:
+            validators = validator_registry.get_validators(self)
+        lengths = [v.get_slot_length() for v in validators if isinstance(v, FullTimeValidator)]
+        return max(lengths) if lengths else None
+
+    def get_slot_counters(self, start, end, slot_length=None, chunks=None):
+        """Return start of the first slot touched by period and array of counters of touched slots.
+
+        ``chunks`` are (start, counters) pairs of chunks of the subject
+        overlapping the period; they are read from the database if not given.
+
+        """
+        if slot_length is None:
+            slot_length = self.get_slot_length()
+        first_slot = self._align(start, slot_length)
+        if chunks is None:
+            chunks = self.slot_counters.filter(
+                start__gte=self._align(start, slot_length * self.slot_counters_chunk_size),
+                start__lt=end,
+            ).values_list('start', 'counters')
+        slots_count = max(0, -self._slot_index(end, first_slot, slot_length))
+        counters = array('I', [0]) * slots_count
+        for chunk_start, data in chunks:
+            chunk = _unpack(data)
+            offset = self._slot_index(first_slot, chunk_start, slot_length)
+            first, last = max(0, offset), min(slots_count, offset + len(chunk))
+            if first < last:
+                counters[first:last] = chunk[first - offset:last - offset]
+        return first_slot, counters
+
+    def slot_counters_cover(self, start, slot_length=None):
+        """Return whether counters can answer questions about periods from ``start`` on.
+
+        Chunks before the current one are not kept, but future chunks
+        missing from the database are known to be empty.
+
+        """
+        if slot_length is None:
+            slot_length = self.get_slot_length()
+        return start >= self._align(now(), slot_length * self.slot_counters_chunk_size)
+
+    def slot_peak_usage(self, start, end, slot_length, chunks=None):
+        """Return the biggest counter of slots touched by period between ``start`` and ``end``."""
+        counters = self.get_slot_counters(start, end, slot_length, chunks)[1]
+        return max(counters) if counters else 0
+
+    def slot_timeline(self, start, end, slot_length):
+        """Return ``Timeline`` between ``start`` and ``end`` built from slot counters."""
+        first_slot, counters = self.get_slot_counters(start, end, slot_length)
+        changes = []
+        usage = 0
+        for index, counter in enumerate(counters):
+            if counter != usage:
+                changes.append((max(start, first_slot + index * slot_length), counter - usage))
+                usage = counter
+        if usage:
+            changes.append((end, -usage))
+        return Timeline.from_changes(start, end, changes, subject=self)
+
+    def update_slot_counters(self, start, end):
+        """Recompute chunks of counters overlapping period between ``start`` and ``end``.
+
+        Chunks are rewritten as a whole from reservations, with the subject
+        row locked, so concurrent updates (in their own transactions, as
+        ``reserve`` makes) don't interleave. Past chunks are deleted.
+
+        """
+        slot_length = self.get_slot_length()
+        if slot_length is None:
+            return
+
+        list(self.__class__._base_manager.select_for_update().filter(pk=self.pk))
+        chunk_size = self.slot_counters_chunk_size
+        chunk_length = slot_length * chunk_size
+        current_chunk = self._align(now(), chunk_length)
+        first_chunk = max(current_chunk, self._align(start, chunk_length))
+        chunks_count = max(0, -self._slot_index(end, first_chunk, chunk_length))
+        chunks_end = first_chunk + chunks_count * chunk_length
+        self.slot_counters.filter(
+            models.Q(start__lt=current_chunk) | models.Q(start__gte=first_chunk, start__lt=chunks_end)
+        ).delete()
+
+        counters = array('I', [0]) * (chunks_count * chunk_size)
+        for span in load_spans(self.overlapping_reservations(first_chunk, chunks_end)):
+            first = max(0, self._slot_index(first_chunk, span.start, slot_length))
+            last = min(len(counters), -self._slot_index(span.end, first_chunk, slot_length))
+            for index in range(first, last):
+                counters[index] += span.size
+
+        chunk_model = self.get_slot_counters_chunk_model()
+        chunk_model.objects.bulk_create([
+            chunk_model(subject=self, start=first_chunk + index * chunk_length,
+                        counters=_pack(counters[index * chunk_size:(index + 1) * chunk_size]))
+            for index in range(chunks_count)
+            if any(counters[index * chunk_size:(index + 1) * chunk_size])
+        ])
+
+    def _align(self, moment, length):
+        """Return start of period of ``length`` containing ``moment``, counting from the epoch."""
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc) if timezone.is_aware(moment) else datetime(1970, 1, 1)
+        return epoch + self._slot_index(epoch, moment, length) * length
+
+    def _slot_index(self, slots_start, moment, slot_length):
+        """Return index of slot containing ``moment`` in slots beginning at ``slots_start``.
+
+        Negated index of ``slots_start`` in slots beginning at ``moment``
+        gives number of slots touched before ``moment``, i.e. it rounds up.
+
+        """
+        delta = moment - slots_start
+        slot_seconds = slot_length.days * 86400 + slot_length.seconds
+        return int((delta.days * 86400 + delta.seconds + delta.microseconds / 1e6) // slot_seconds)
+
+
+forbid_approvable_reservations(SlotCountersSubjectMixin)
+track_reservation_periods(SlotCountersSubjectMixin,
+                          lambda subject, start, end: subject.update_slot_counters(start, end),
+                          'slots')
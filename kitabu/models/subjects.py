@@ -2,8 +2,10 @@
 
 from collections import defaultdict
 
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models, transaction
-from django.db.models import Q
+from django.db.models import Max
+from django.db.models.signals import class_prepared
 
 from django.conf import settings
 
@@ -11,8 +13,11 @@ from kitabu.exceptions import (
     SizeExceeded,
     OverlappingReservations,
 )
-from kitabu.utils import EnsureSize
-from kitabu.models.validators import Validator
+from kitabu.utils import EnsureSize, load_spans, overlap_memo
+from kitabu.transactions import default_retry_policy
+from kitabu.engines import PythonPeakUsage
+from kitabu.models.validators import Validator, validator_registry
+from kitabu.signals import reservations_changed
 
 import datetime
 from time import sleep
@@ -35,26 +40,30 @@ class BaseSubject(models.Model, EnsureSize):
     additional info about the subject, except for validators that can be
     attached.
 
+    If ``max_reservation_duration`` (``timedelta``) is set, saving longer
+    reservations is refused with ``TooLong`` and queries for overlapping
+    reservations are bounded on both sides of ``start`` (see
+    ``BaseReservation.overlap_lookups``), so an index on (subject, start,
+    end) is scanned only in a short range. Before setting it on a model
+    with reservations already stored, make sure none of them is longer:
+    such reservations would be missed by overlap queries.
+
     """
     class Meta:
         abstract = True
 
+    max_reservation_duration = None
+
     validators = models.ManyToManyField(Validator, blank=True)
 
-    @transaction.commit_manually
-    def reserve(self, **kwargs):
-        try:
-            reservation = self.reserve_without_transaction(**kwargs)
-            transaction.commit()
-            return reservation
-        except:
-            transaction.rollback()
-            raise
+    def reserve(self, retry_policy=None, **kwargs):
+        """Make reservation in a transaction, see ``kitabu.transactions.RetryPolicy``."""
+        return (retry_policy or default_retry_policy).run(self.reserve_without_transaction, **kwargs)
 
     def reserve_without_transaction(self, **kwargs):
         if settings.SECURE_RESERVATIONS:
             # explicitly lock this subject before reserving it
-            list(self.__class__.objects.select_for_update().filter(pk=self.pk))
+            overlap_memo.select_for_update(self.__class__.objects.filter(pk=self.pk))
         return self.create_reservation(**kwargs)
 
     def create_reservation(self, **kwargs):
@@ -66,25 +75,61 @@ class BaseSubject(models.Model, EnsureSize):
         Otherwise ``ReservationError`` is raised.
 
         """
-        assert kwargs.get('start') and kwargs.get('end'), "start and end dates must be provided"
-
         delay_time = kwargs.pop('delay_time', None)
 
-        reservation = self.reservation_model(subject=self, **kwargs)
-        self._validate_reservation(reservation)
-        if kwargs.get('exclusive') or self._only_exclusive_reservations():
-            self._validate_exclusive(reservation)
+        with overlap_memo:
+            reservation = self.build_reservation(**kwargs)
+            if kwargs.get('exclusive') or self._only_exclusive_reservations():
+                self._validate_exclusive(reservation)
+            self._before_save_reservations([reservation])
         reservation.save()
         if delay_time:
             sleep(delay_time)
         return reservation
 
+    def build_reservation(self, **kwargs):
+        """Return new reservation on current subject, validated but not saved.
+
+        Reservation is validated against all attached and global validators,
+        but availability of the subject is not checked. It is used by
+        ``create_reservation`` and by bulk reservations
+        (``AtomicReserver.bulk_reserve``).
+
+        """
+        assert kwargs.get('start') and kwargs.get('end'), "start and end dates must be provided"
+
+        reservation = self.reservation_model(subject=self, **kwargs)
+        self._validate_reservation(reservation)
+        return reservation
+
     def overlapping_reservations(self, start, end):
         """Find all reservations that overlap with given period.
 
         Return a query set, possibly empty.
         """
-        return self.reservations.filter(start__lt=end, end__gt=start)
+        return self.reservations.filter(**self.reservation_model.overlap_lookups(start, end))
+
+    @classmethod
+    def overlapping_reservations_in_subjects(cls, subjects, start, end):
+        """Find reservations on any of ``subjects`` that overlap with given period.
+
+        Bulk counterpart of ``overlapping_reservations`` used by searchers;
+        subclasses overriding one of them should override the other too.
+        """
+        reservation_model = cls.get_reservation_model()
+        return reservation_model.objects.filter(subject__in=subjects, **reservation_model.overlap_lookups(start, end))
+
+    def overlapping_spans(self, start, end):
+        """Return list of ``ReservationSpan``s of ``overlapping_reservations``.
+
+        The list is shared while ``kitabu.utils.overlap_memo`` is active.
+
+        """
+        field = self.reservation_model._meta.get_field('start')
+        start, end = field.to_python(start), field.to_python(end)
+        return overlap_memo.get_spans(
+            (self.__class__, self.pk, start, end),
+            lambda: list(load_spans(self.overlapping_reservations(start, end))))
 
     @classmethod
     def get_reservation_model(cls):
@@ -99,14 +144,26 @@ class BaseSubject(models.Model, EnsureSize):
     # Private
 
     def _validate_reservation(self, reservation):
-        """Run associated and global validators."""
+        """Run global and associated validators.
 
-        for validator in Validator.universal.all():
-            validator.validate(reservation)
+        Validators are taken from ``validator_registry``, already resolved to
+        their actual subclasses.
 
-        for validator in self.validators.all():
+        """
+        for validator in validator_registry.get_validators(self):
             validator.validate(reservation)
 
+        # checked here too, as bulk reservations are saved without ``save``
+        reservation.check_max_duration()
+
+    @classmethod
+    def _validators_check_other_reservations(cls, subjects):
+        """Return whether any validator of ``subjects`` checks other reservations."""
+        return any(
+            validator.checks_other_reservations
+            for validators in validator_registry.get_validators_for_subjects(subjects).itervalues()
+            for validator in validators)
+
     def _validate_exclusive(self, reservation):
         """Make sure given reservation's period doesn't overlap any other's.
 
@@ -114,13 +171,45 @@ class BaseSubject(models.Model, EnsureSize):
         otherwise do nothing.
 
         """
-        overlapping_reservations = self.overlapping_reservations(reservation.start, reservation.end)
-        if overlapping_reservations:
-            raise OverlappingReservations(reservation, overlapping_reservations)
+        if self.overlapping_spans(reservation.start, reservation.end):
+            raise OverlappingReservations(
+                reservation, self.overlapping_reservations(reservation.start, reservation.end))
 
     def _only_exclusive_reservations(self):
         return False
 
+    def _before_save_reservations(self, reservations):
+        """Hook called when ``reservations`` passed all checks, just before they are saved."""
+        pass
+
+    def _validate_availability(self, reservations):
+        """Make sure all given fresh reservations can be made together.
+
+        Reservations are checked against those already made, fetched with
+        one query for the period covering all of them, and against each
+        other. Raise ``ReservationError`` if any of them is not possible.
+
+        """
+        for reservation in reservations:
+            reservation.start = reservation._meta.get_field('start').to_python(reservation.start)
+            reservation.end = reservation._meta.get_field('end').to_python(reservation.end)
+
+        existing_reservations = list(self.overlapping_reservations(
+            min(r.start for r in reservations), max(r.end for r in reservations)))
+        self._check_availability(reservations, existing_reservations)
+
+    def _check_availability(self, reservations, existing_reservations):
+        """Check new exclusive ``reservations`` overlap no other reservation."""
+        all_reservations = existing_reservations + reservations
+        for reservation in reservations:
+            if getattr(reservation, 'exclusive', False) or self._only_exclusive_reservations():
+                overlapping_reservations = [
+                    r for r in all_reservations
+                    if r is not reservation and r.start < reservation.end and r.end > reservation.start
+                ]
+                if overlapping_reservations:
+                    raise OverlappingReservations(reservation, overlapping_reservations)
+
 
 class SubjectWithApprovableReservations(models.Model):
 
@@ -152,11 +241,24 @@ class SubjectWithApprovableReservations(models.Model):
         """
         Find overlapping reservation discarding not approved and stale ones.
         """
-        extra_filter = Q(approved=True) | Q(valid_until__gt=now())
-        return self.reservations.filter(extra_filter, start__lt=end, end__gt=start)
+        return self.reservations.filter(effective_until__gt=now(), **self.reservation_model.overlap_lookups(start, end))
+
+    @classmethod
+    def overlapping_reservations_in_subjects(cls, subjects, start, end):
+        """
+        Find overlapping reservations on subjects discarding not approved and stale ones.
+        """
+        return super(SubjectWithApprovableReservations, cls).overlapping_reservations_in_subjects(
+            subjects, start, end).filter(effective_until__gt=now())
+
+    def _before_save_reservations(self, reservations):
+        """Fill ``effective_until`` of reservations that are saved without ``save``."""
+        for reservation in reservations:
+            reservation.update_effective_until()
+        super(SubjectWithApprovableReservations, self)._before_save_reservations(reservations)
 
     # def make_preliminary_reservation(self, valid_until, start=None, end=None, **kwargs):
-    def create_reservation(self, valid_until=None, validity_period=None, approved=False, **kwargs):
+    def build_reservation(self, valid_until=None, validity_period=None, approved=False, **kwargs):
 
         assert int(bool(valid_until)) + int(bool(validity_period)) + int(approved) <= 1, (
             "Supply no more than one of the following arguments: valid_until, validity_period, approved. "
@@ -170,7 +272,7 @@ class SubjectWithApprovableReservations(models.Model):
             else:
                 valid_until = now() + self.validity_timedelta()
 
-        return super(SubjectWithApprovableReservations, self).create_reservation(
+        return super(SubjectWithApprovableReservations, self).build_reservation(
             valid_until=valid_until, approved=approved, **kwargs)
 
     def validity_timedelta(self):
@@ -200,10 +302,17 @@ class FiniteSizeSubjectMixin(models.Model):
 
     Mix in before BaseSubject.
 
+    Peak usage of the subject in requested period is computed by
+    ``peak_usage_engine`` (see ``kitabu.engines``). By default reservations
+    are swept in Python, set ``DatabasePeakUsage`` to compute it inside
+    the database.
+
     '''
     class Meta:
         abstract = True
 
+    peak_usage_engine = PythonPeakUsage
+
     def create_reservation(self, start=None, end=None, **kwargs):
         """Make a reservation on current subject and return the reservation.
 
@@ -218,26 +327,53 @@ class FiniteSizeSubjectMixin(models.Model):
         if size > self.size:
             raise SizeExceeded(subject=self, requested_size=size, start=start, end=end)
 
-        overlapping_reservations = self.overlapping_reservations(start, end)
-
-        dates = defaultdict(lambda: 0)
-        for r in overlapping_reservations:
-            # mark when usage of subject changes
-            dates[r.start] += getattr(r, 'size', 1)
-            dates[r.end] -= getattr(r, 'size', 1)
-        balance = 0
-        for date, delta in sorted(dates.iteritems()):
-            balance += delta
-            if balance + size > self.size:
+        with overlap_memo:
+            if self.peak_usage_engine.peak_usage(self, start, end) + size > self.size:
                 raise SizeExceeded(
                     subject=self,
                     requested_size=size,
                     start=start,
                     end=end,
-                    overlapping_reservations=overlapping_reservations
+                    overlapping_reservations=self.overlapping_reservations(start, end)
                 )
 
-        return super(FiniteSizeSubjectMixin, self).create_reservation(start=start, end=end, **kwargs)
+            return super(FiniteSizeSubjectMixin, self).create_reservation(start=start, end=end, **kwargs)
+
+    def _check_availability(self, reservations, existing_reservations):
+        """Check that at no moment of new ``reservations`` size of subject is exceeded."""
+        super(FiniteSizeSubjectMixin, self)._check_availability(reservations, existing_reservations)
+
+        # moment -> [change of usage, change of number of new reservations]
+        changes = defaultdict(lambda: [0, 0])
+        for r in existing_reservations:
+            changes[r.start][0] += getattr(r, 'size', 1)
+            changes[r.end][0] -= getattr(r, 'size', 1)
+        for r in reservations:
+            size = getattr(r, 'size', 1)
+            assert size > 0, "size must be greater than zero"
+            if size > self.size:
+                raise SizeExceeded(subject=self, requested_size=size, start=r.start, end=r.end)
+            changes[r.start][0] += size
+            changes[r.start][1] += 1
+            changes[r.end][0] -= size
+            changes[r.end][1] -= 1
+
+        usage = new_reservations = 0
+        for moment, (usage_change, new_reservations_change) in sorted(changes.iteritems()):
+            usage += usage_change
+            new_reservations += new_reservations_change
+            if new_reservations and usage > self.size:
+                reservation = [r for r in reservations if r.start <= moment < r.end][0]
+                raise SizeExceeded(
+                    subject=self,
+                    requested_size=getattr(reservation, 'size', 1),
+                    start=reservation.start,
+                    end=reservation.end,
+                    overlapping_reservations=[
+                        r for r in existing_reservations + reservations
+                        if r is not reservation and r.start < reservation.end and r.end > reservation.start
+                    ]
+                )
 
 
 class FixedSizeSubject(FiniteSizeSubjectMixin):
@@ -292,20 +428,133 @@ class ExclusivableVariableSizeSubjectMixin(VariableSizeSubjectMixin):
     class Meta:
         abstract = True
 
+    resize_chunk_size = 1000
+
     def __setattr__(self, name, value):
-        if name == 'size' and getattr(self, '_old_size', None) is None:
-            self._old_size = self.size
+        if name == 'size' and 'size' in self.__dict__ and '_old_size' not in self.__dict__:
+            self.__dict__['_old_size'] = self.size
         return super(ExclusivableVariableSizeSubjectMixin, self).__setattr__(name, value)
 
-    def save(self, **kwargs):
+    def save(self, retry_policy=None, **kwargs):
+        """Save subject and, if its size has changed, resize its exclusive reservations.
+
+        Shrinking is refused with ``SizeExceeded`` if future reservations
+        that are not exclusive would not fit anymore. The check and the save
+        are done with this subject locked, in a transaction (see
+        ``kitabu.transactions.RetryPolicy``) unless the caller is already in
+        one. Reservations are then resized by
+        ``resize_exclusive_reservations``; ones made in the meantime already
+        get the new size.
+
+        """
+        old_size = self.__dict__.get('_old_size', self.size)
+        if self.pk is not None and old_size != self.size:
+            retry_policy = retry_policy or default_retry_policy
+            self._run_in_transaction(retry_policy, self._save_resized, old_size, **kwargs)
+            self.resize_exclusive_reservations(retry_policy)
+        else:
+            super(ExclusivableVariableSizeSubjectMixin, self).save(**kwargs)
+        self.__dict__.pop('_old_size', None)
+
+    def resize_exclusive_reservations(self, retry_policy=None):
+        """Set size of future exclusive reservations on this subject to its size.
+
+        Reservations are updated ``resize_chunk_size`` at a time, each chunk
+        in its own transaction with this subject locked (unless the caller
+        is already in a transaction), so that no long lasting locks are
+        held. Return number of updated reservations.
+
+        """
+        retry_policy = retry_policy or default_retry_policy
+        updated = 0
+        last_pk = None
+        while True:
+            chunk_updated, last_pk = self._run_in_transaction(retry_policy, self._resize_chunk, last_pk)
+            updated += chunk_updated
+            if last_pk is None:
+                return updated
+
+    def _run_in_transaction(self, retry_policy, function, *args, **kwargs):
+        if transaction.is_managed():
+            return function(*args, **kwargs)
+        return retry_policy.run(function, *args, **kwargs)
+
+    def _save_resized(self, old_size, **kwargs):
+        overlap_memo.select_for_update(self.__class__.objects.filter(pk=self.pk))
+        if self.size < old_size:
+            self._check_capacity_for_size(self.size)
         super(ExclusivableVariableSizeSubjectMixin, self).save(**kwargs)
 
-        if getattr(self, '_old_size', self.size) != self.size:  # if size has changed
-            self.reservation_model.objects.filter(end__gte=now(), exclusive=True).update(size=self.size)
-            delattr(self, '_old_size')
+    def _resize_chunk(self, last_pk):
+        """Resize exclusive reservations following ``last_pk``.
+
+        Return number of updated reservations and pk to continue from, or
+        None if no reservations are left.
+
+        """
+        overlap_memo.select_for_update(self.__class__.objects.filter(pk=self.pk))
+        reservations = self.reservations.filter(end__gte=now(), exclusive=True).exclude(size=self.size)
+        if last_pk is not None:
+            reservations = reservations.filter(pk__gt=last_pk)
+        chunk = list(reservations.order_by('pk').values_list('pk', 'start', 'end')[:self.resize_chunk_size])
+        if not chunk:
+            return 0, None
+
+        updated = self.reservation_model.objects.filter(pk__in=[pk for pk, start, end in chunk]).update(size=self.size)
+        reservations_changed.send(
+            sender=self.__class__,
+            subject=self,
+            start=min(start for pk, start, end in chunk),
+            end=max(end for pk, start, end in chunk),
+        )
+        return updated, chunk[-1][0] if len(chunk) == self.resize_chunk_size else None
+
+    def _check_capacity_for_size(self, size):
+        """Raise ``SizeExceeded`` if future not exclusive reservations need more than ``size``."""
+        start = now()
+        last_end = self.reservations.filter(end__gt=start).aggregate(last_end=Max('end'))['last_end']
+        if last_end is None:
+            return
+
+        changes = defaultdict(lambda: 0)
+        reservations = self.overlapping_reservations(start, last_end).filter(exclusive=False)
+        for span in load_spans(reservations, chunk_size=self.resize_chunk_size):
+            changes[span.start] += span.size
+            changes[span.end] -= span.size
+
+        balance = 0
+        for moment, delta in sorted(changes.iteritems()):
+            balance += delta
+            if balance > size:
+                raise SizeExceeded(self, balance, max(start, moment), last_end)
 
     def create_reservation(self, start=None, end=None, **kwargs):
         """Forbid exclusive reservation with size set, then call super."""
+        self._forbid_exclusive_size(kwargs)
+        return super(ExclusivableVariableSizeSubjectMixin, self).create_reservation(start=start, end=end, **kwargs)
+
+    def build_reservation(self, **kwargs):
+        """Forbid exclusive reservation with size set, then call super."""
+        self._forbid_exclusive_size(kwargs)
+        return super(ExclusivableVariableSizeSubjectMixin, self).build_reservation(**kwargs)
+
+    def _forbid_exclusive_size(self, kwargs):
         if 'size' in kwargs and kwargs.get('exclusive'):
             raise AttributeError('Cannot explicitly set size for exclusive reservation')
-        return super(ExclusivableVariableSizeSubjectMixin, self).create_reservation(start=start, end=end, **kwargs)
+
+
+def forbid_approvable_reservations(subject_mixin):
+    """Refuse subject models mixing ``subject_mixin`` with ``SubjectWithApprovableReservations``.
+
+    Meant for mixins keeping usage of subjects that doesn't follow expiry
+    of not approved reservations, so expired ones would keep counting.
+
+    """
+    def check_subject_model(sender, **kwargs):
+        if issubclass(sender, subject_mixin) and issubclass(sender, SubjectWithApprovableReservations):
+            raise ImproperlyConfigured(
+                '%s cannot be used with SubjectWithApprovableReservations, as it would count not approved '
+                'reservations after they expire' % subject_mixin.__name__)
+
+    class_prepared.connect(check_subject_model, weak=False,
+                           dispatch_uid='kitabu_forbid_approvable_reservations_%s' % subject_mixin.__name__)
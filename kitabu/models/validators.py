@@ -1,10 +1,16 @@
 #-*- coding=utf-8 -*-
 
 from importlib import import_module
+from bisect import bisect_right
 from datetime import datetime, timedelta, time
 from collections import defaultdict
+from fractions import gcd
+import time as time_module
 
+from django.conf import settings
 from django.db import models
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete, m2m_changed
 
 from kitabu.exceptions import (
     TimeUnitNotNull,
@@ -17,6 +23,7 @@ from kitabu.exceptions import (
     TooLong,
     TooManyReservationsForUser,
     TooManyReservationsOnSubjectForUser,
+    ReservationValidationError,
 )
 from kitabu import managers
 from django.utils import timezone
@@ -65,10 +72,17 @@ class Validator(models.Model):
     subclasses of the ReservationValidationError to give better information on why
     reservation is not possible.
 
+    Validators that look at reservations already made (e.g. count them)
+    should set ``checks_other_reservations``; bulk reservations with such
+    validators are saved one by one, so each is checked against the ones
+    before it.
+
     """
     class Meta:
         app_label = 'kitabu'
 
+    checks_other_reservations = False
+
     actual_validator_related_name = models.CharField(max_length=200, editable=False)
 
     apply_to_all = models.BooleanField(default=False)
@@ -77,9 +91,10 @@ class Validator(models.Model):
     universal = managers.Universal()
 
     def __unicode__(self):
-        if '__unicode__' in getattr(self, self.actual_validator_related_name).__class__.__dict__:
-            return unicode(getattr(self, self.actual_validator_related_name))
-        return getattr(self, self.actual_validator_related_name).__class__.__name__ + ' ' + unicode(self.id)
+        actual_validator = self.get_actual_validator()
+        if '__unicode__' in actual_validator.__class__.__dict__:
+            return unicode(actual_validator)
+        return actual_validator.__class__.__name__ + ' ' + unicode(self.id)
 
     def validate(self, reservation, allow_reservation_update=False):
         """Validate reservation and raise ReservationValidationError if not valid.
@@ -96,10 +111,39 @@ class Validator(models.Model):
         """
         if not allow_reservation_update:
             assert reservation.id is None, "Reservation must be validated before being saved to database"
-        getattr(self, self.actual_validator_related_name)._perform_validation(reservation)
+        self.get_actual_validator()._perform_validation(reservation)
+
+    def validate_many(self, reservations):
+        """Validate many fresh reservations at once and return the invalid ones.
+
+        Unlike ``validate`` it doesn't raise ``ReservationValidationError``,
+        but collects reservations that failed validation. Subclasses can
+        override ``_perform_bulk_validation`` to validate all reservations
+        with constant number of queries.
+
+        """
+        return self.get_actual_validator()._perform_bulk_validation(reservations)
+
+    def get_actual_validator(self):
+        """Return instance of the subclass that implements validation.
 
-    def get_forbidden_periods(self, start, end, size=1):
-        """Get all unavailable periods between start and end."""
+        If this object already is an instance of that subclass (e.g. it was
+        loaded by ``ValidatorRegistry``) no query is made.
+
+        """
+        if self.__class__.__name__.lower() == self.actual_validator_related_name:
+            return self
+        return getattr(self, self.actual_validator_related_name)
+
+    def get_forbidden_periods(self, start, end, size=1, duration=None):
+        """Get all unavailable periods between start and end.
+
+        Return list of (start, end) pairs in which no valid reservation of
+        ``size`` (and ``duration``, if given) can be. Searchers use them to
+        discard subjects and periods without validating reservations one by
+        one, so they may be incomplete, but must not forbid anything valid.
+
+        """
         return []
 
     def save(self, *args, **kwargs):
@@ -120,6 +164,158 @@ class Validator(models.Model):
         ''' Method meant to be overridden. This one actually runs validation. '''
         raise NotImplementedError('Must be implemented in subclasses!')
 
+    def _perform_bulk_validation(self, reservations):
+        ''' Validate reservations one by one. May be overridden to use less queries. '''
+        invalid = []
+        for reservation in reservations:
+            try:
+                self._perform_validation(reservation)
+            except ReservationValidationError:
+                invalid.append(reservation)
+        return invalid
+
+
+class ValidatorRegistry(object):
+    """Process-local cache of validators resolved to their actual subclasses.
+
+    Validators applying to a subject are the universal ones plus the ones
+    attached to the subject by many-to-many relationship. The registry loads
+    them in bulk: one query for universal validators, one query for
+    validators attached to all requested subjects and one query per actual
+    validator subclass (instead of one query per validator).
+
+    Results are cached for ``settings.KITABU_VALIDATORS_CACHE_TIMEOUT``
+    seconds (0, the default, disables caching). The cache is cleared whenever
+    a validator is saved or deleted or validators of any subject change.
+    Other processes are not notified, so the timeout bounds how long they may
+    use outdated validators.
+
+    """
+
+    UNIVERSAL = 'universal'
+
+    def __init__(self):
+        self._cache = {}
+
+    def get_validators(self, subject):
+        """Return list of validators that apply to reservations on ``subject``."""
+        return self.get_validators_for_subjects([subject])[subject.pk]
+
+    def get_validators_for_subjects(self, subjects):
+        """Return dict mapping pks of ``subjects`` to lists of their validators.
+
+        All ``subjects`` must be instances of the same model.
+
+        """
+        subjects = list(subjects)
+        if not subjects:
+            return {}
+        subject_model = subjects[0].__class__
+
+        universal = self._get(self.UNIVERSAL)
+        attached = {}
+        missing_pks = []
+        for subject in subjects:
+            validators = self._get((subject_model, subject.pk))
+            if validators is None:
+                missing_pks.append(subject.pk)
+            else:
+                attached[subject.pk] = validators
+
+        if universal is None or missing_pks:
+            universal_rows = [] if universal is not None else list(
+                Validator.universal.values_list('pk', 'actual_validator_related_name'))
+            attached_rows = self._get_attached_rows(subject_model, missing_pks)
+            resolved = self._resolve(
+                universal_rows + [(validator_pk, name) for (subject_pk, validator_pk, name) in attached_rows])
+
+            if universal is None:
+                universal = [resolved[pk] for (pk, name) in universal_rows]
+                self._set(self.UNIVERSAL, universal)
+
+            loaded = dict((pk, []) for pk in missing_pks)
+            for (subject_pk, validator_pk, name) in attached_rows:
+                loaded[subject_pk].append(resolved[validator_pk])
+            for subject_pk, validators in loaded.iteritems():
+                self._set((subject_model, subject_pk), validators)
+            attached.update(loaded)
+
+        return dict((subject.pk, universal + attached.get(subject.pk, [])) for subject in subjects)
+
+    def invalidate(self, *args, **kwargs):
+        """Forget all cached validators. Accepts signal handler arguments."""
+        self._cache = {}
+
+    # Private
+
+    def _timeout(self):
+        return getattr(settings, 'KITABU_VALIDATORS_CACHE_TIMEOUT', 0)
+
+    def _get(self, key):
+        timeout = self._timeout()
+        if not timeout or key not in self._cache:
+            return None
+        stored_at, value = self._cache[key]
+        if time_module.time() - stored_at > timeout:
+            return None
+        return value
+
+    def _set(self, key, value):
+        if self._timeout():
+            self._cache[key] = (time_module.time(), value)
+
+    def _get_attached_rows(self, subject_model, subject_pks):
+        """Return (subject pk, validator pk, related name) for attached validators."""
+        subject_pks = [pk for pk in subject_pks if pk is not None]
+        if not subject_pks:
+            return []
+        field = subject_model._meta.get_field('validators')
+        subject_field_name = field.m2m_field_name()
+        validator_field_name = field.m2m_reverse_field_name()
+        return list(field.rel.through.objects.filter(
+            **{subject_field_name + '__in': subject_pks}
+        ).order_by('pk').values_list(
+            subject_field_name,
+            validator_field_name,
+            validator_field_name + '__actual_validator_related_name',
+        ))
+
+    def _resolve(self, rows):
+        """Load actual validator subclass instances, one query per subclass.
+
+        ``rows`` are (validator pk, actual validator related name) pairs.
+        Return dict mapping validator pk to instance.
+
+        """
+        pks_by_name = defaultdict(set)
+        for pk, name in rows:
+            pks_by_name[name].add(pk)
+
+        resolved = {}
+        for name, pks in pks_by_name.iteritems():
+            validator_model = getattr(Validator, name).related.model
+            for validator in validator_model.objects.filter(pk__in=pks):
+                resolved[validator.pk] = validator
+        return resolved
+
+
+validator_registry = ValidatorRegistry()
+
+
+def _invalidate_validator_registry(sender, instance, **kwargs):
+    if isinstance(instance, Validator):
+        validator_registry.invalidate()
+
+
+def _invalidate_validator_registry_on_m2m(sender, instance, model, **kwargs):
+    if isinstance(instance, Validator) or issubclass(model, Validator):
+        validator_registry.invalidate()
+
+
+post_save.connect(_invalidate_validator_registry, dispatch_uid='kitabu_validator_registry_save')
+post_delete.connect(_invalidate_validator_registry, dispatch_uid='kitabu_validator_registry_delete')
+m2m_changed.connect(_invalidate_validator_registry_on_m2m, dispatch_uid='kitabu_validator_registry_m2m')
+
 
 class FullTimeValidator(Validator):
     """Validator for full time.
@@ -160,6 +356,36 @@ class FullTimeValidator(Validator):
                 elif time_value > 0:
                     raise TimeUnitNotNull(time_unit)
 
+    def get_slot_length(self):
+        """Return length of slots that every valid reservation consists of."""
+        seconds = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+        units_in_next = {'second': 60, 'minute': 60, 'hour': 24}
+
+        if self.interval_type == 'day':
+            return timedelta(days=1)
+        if self.interval == 0:
+            units = units_in_next[self.interval_type]
+        else:
+            units = gcd(self.interval, units_in_next[self.interval_type])
+        return timedelta(seconds=units * seconds[self.interval_type])
+
+    def get_forbidden_periods(self, start, end, size=1, duration=None):
+        """Forbid beginning and ending of period that are not at full time."""
+        first = self._round_to_slot(start, up=True)
+        last = self._round_to_slot(end)
+        if first >= last:
+            return [(start, end)]
+        return [period for period in [(start, first), (last, end)] if period[0] < period[1]]
+
+    def _round_to_slot(self, moment, up=False):
+        midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        slot_length = self.get_slot_length()
+        slot_microseconds = (slot_length.days * SECONDS_IN_DAY + slot_length.seconds) * 10 ** 6
+        delta = moment - midnight
+        microseconds = (delta.days * SECONDS_IN_DAY + delta.seconds) * 10 ** 6 + delta.microseconds
+        slots = -(-microseconds // slot_microseconds) if up else microseconds // slot_microseconds
+        return midnight + slots * slot_length
+
 
 class StaticValidator(Validator):
     """Validator that doesn't require any additional data.
@@ -188,10 +414,45 @@ class StaticValidator(Validator):
         self._get_validation_function()(reservation)
 
     def _get_validation_function(self):
-        path = self.validator_function_absolute_name.split('.')
+        return resolve_validation_function(self.validator_function_absolute_name)
+
+
+_validation_functions = {}
+
+
+def resolve_validation_function(absolute_name):
+    """Return function given by ``absolute_name`` of ``StaticValidator``.
+
+    Functions are resolved once per process and kept by their names.
+
+    """
+    try:
+        return _validation_functions[absolute_name]
+    except KeyError:
+        path = absolute_name.split('.')
         base_module = import_module(path[0])
+        function = reduce(getattr, path[1:], base_module)
+        _validation_functions[absolute_name] = function
+        return function
+
 
-        return reduce(getattr, path[1:], base_module)
+def warm_static_validators():
+    """Resolve functions of all saved static validators.
+
+    Meant to be called at startup (e.g. from ``urls.py`` or WSGI script), so
+    that requests don't pay for imports. Return dict mapping names of
+    functions that could not be resolved to the exceptions raised.
+
+    """
+    errors = {}
+    for model in models.get_models():
+        if issubclass(model, StaticValidator):
+            for name in model.objects.values_list('validator_function_absolute_name', flat=True):
+                try:
+                    resolve_validation_function(name)
+                except (ImportError, AttributeError) as e:
+                    errors[name] = e
+    return errors
 
 
 class TimeIntervalValidator(Validator):
@@ -226,7 +487,7 @@ class TimeIntervalValidator(Validator):
     check_end = models.BooleanField(default=False)
 
     def _perform_validation(self, reservation):
-        if self.get_forbidden_periods(reservation.start, reservation.end, check_end=self.check_end):
+        if self.get_forbidden_periods(reservation.start, reservation.end):
             if self.interval_type == self.NOT_SOONER:
                 raise TooSoon((self.time_unit, self.time_value))
             elif self.interval_type == self.NOT_LATER:
@@ -234,7 +495,9 @@ class TimeIntervalValidator(Validator):
             else:
                 raise AssertionError("Interval type must be 'l' or 's', '%s' given" % self.interval_type)
 
-    def get_forbidden_periods(self, start, end, size=1, check_end=False):
+    def get_forbidden_periods(self, start, end, size=1, duration=None, check_end=None):
+        if check_end is None:
+            check_end = self.check_end
         interval_params = (
             {'seconds': self.time_value}
             if self.time_unit == 'second' else
@@ -292,6 +555,22 @@ class WithinPeriodValidator(Validator):
 
         raise OutsideAllowedPeriods(list(self.periods.all()))
 
+    def get_forbidden_periods(self, start, end, size=1, duration=None):
+        """Forbid what is outside all periods."""
+        forbidden = []
+        allowed_from = start
+        periods = sorted(self.periods.all(), key=lambda period: period.start or start)
+        for period in periods:
+            period_start = max(period.start or start, start)
+            if allowed_from < min(period_start, end):
+                forbidden.append((allowed_from, min(period_start, end)))
+            if period.end is None:
+                return forbidden
+            allowed_from = max(allowed_from, period.end)
+        if allowed_from < end:
+            forbidden.append((allowed_from, end))
+        return forbidden
+
 
 class Period(models.Model):
     """Period model for WithinPeriodValidator.
@@ -313,7 +592,12 @@ class Period(models.Model):
 
 
 class NotWithinPeriodValidator(Validator):
-    """Make sure reservation is not in given period."""
+    """Make sure reservation is not in given period.
+
+    Both ends of the period are forbidden, so reservations may not even
+    touch it.
+
+    """
     class Meta:
         abstract = True
 
@@ -326,38 +610,36 @@ class NotWithinPeriodValidator(Validator):
         if reservation.start <= self.end and reservation.end >= self.start:
             raise ForbiddenPeriod(self.start, self.end)
 
+    def get_forbidden_periods(self, start, end, size=1, duration=None):
+        # reservations touching the period are invalid too
+        forbidden_start = self.start - timedelta.resolution
+        forbidden_end = self.end + timedelta.resolution
+        if forbidden_start < end and forbidden_end > start:
+            return [(max(forbidden_start, start), min(forbidden_end, end))]
+        return []
 
-class PeriodsInWeekdaysValidator(Validator):
-    """Allow only reservation that fall into open hours pattern.
 
-    This validator requires associated ``Period`` model."""
+class WeekdaySchedule(object):
+    """Open hours of a week, compiled from ``WithinDayPeriod``s.
 
-    class Meta:
-        abstract = True
+    For every weekday keeps sorted starts and ends of merged (disjoint)
+    open periods, so checking whether a period of a day is open is a binary
+    search. Period without start opens at midnight, period without end lasts
+    till the end of the day (23:59:59).
 
-    def _perform_validation(self, reservation):
-        periods_for_days = self._get_periods_for_days()
-        required_periods = self._construct_required_periods(
-            start=reservation.start,
-            end=reservation.end
-        )
-
-        for period_data in required_periods:
-            if not self._check_period(period_data, periods_for_days):
-                raise ForbiddenHours(self.periods.all())
-
-    def _check_period(self, period_data, periods_for_days):
-        weekday = period_data['weekday']
-        periods_for_weekday = periods_for_days[weekday]
-        return any(
-            (period['start'] <= period_data['start'] and period['end'] >= period_data['end'])
-            for period in periods_for_weekday
-        )
-
-    def _get_periods_for_days(self):
-        timelines = self._construct_timelines()
-        periods = defaultdict(lambda: [])
+    """
+    END_OF_DAY = time(23, 59, 59)
 
+    def __init__(self, periods):
+        timelines = defaultdict(lambda: defaultdict(lambda: 0))
+        for period in periods:
+            start = period.start if period.start else time(0)
+            end = period.end if period.end else self.END_OF_DAY
+            timelines[period.weekday][start] += 1
+            timelines[period.weekday][end] -= 1
+
+        self.starts = dict((weekday, []) for weekday in range(7))
+        self.ends = dict((weekday, []) for weekday in range(7))
         for weekday, timeline in timelines.iteritems():
             current_start = None
             current_sum = 0
@@ -366,46 +648,121 @@ class PeriodsInWeekdaysValidator(Validator):
                     current_start = moment
                 current_sum += timeline[moment]
                 if current_sum == 0:
-                    periods[weekday].append({'start': current_start, 'end': moment})
+                    self.starts[weekday].append(current_start)
+                    self.ends[weekday].append(moment)
                     current_start = None
 
-        return periods
+    def is_open(self, weekday, start, end):
+        """Tell whether whole period between times ``start`` and ``end`` of ``weekday`` is open."""
+        index = bisect_right(self.starts[weekday], start) - 1
+        return index >= 0 and self.ends[weekday][index] >= end
 
-    def _construct_timelines(self):
-        timelines = defaultdict(lambda: defaultdict(lambda: 0))
-        for period in self.periods.all():
-            start = period.start if period.start else time(0)
-            end = period.end if period.end else time(23, 59, 59)
-            timelines[period.weekday][start] += 1
-            timelines[period.weekday][end] -= 1
+    def covers(self, start, end):
+        """Tell whether period between datetimes ``start`` and ``end`` is open.
 
-        return timelines
+        The period is split into days. After 8 days every weekday has been
+        checked as a whole day, so further days need no checking.
 
-    def _construct_required_periods(self, start, end, already_constructed=None):
-        if already_constructed is None:
-            already_constructed = []
+        """
+        day = start
+        for _ in range(8):
+            if day.date() == end.date():
+                return self.is_open(day.weekday(), day.time(), end.time())
+            if not self.is_open(day.weekday(), day.time(), self.END_OF_DAY):
+                return False
+            day = datetime.combine(day.date(), time()) + timedelta(days=1)
+        return True
 
-        if len(already_constructed) >= 8:
-            return already_constructed
+    def closed_periods(self, start, end):
+        """Return list of closed (start, end) periods between datetimes ``start`` and ``end``.
 
-        period_params = {
-            'weekday': start.weekday(),
-            'start': start.time()
-        }
+        Open period lasting till 23:59:59 is taken as lasting till midnight,
+        the same as when validating reservations spanning many days.
 
-        if start.day == end.day:
-            period_params['end'] = end.time()
-            already_constructed.append(period_params)
-            return already_constructed
+        """
+        closed = []
+        day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day < end:
+            weekday = day.weekday()
+            closed_from = day
+            for open_start, open_end in zip(self.starts[weekday], self.ends[weekday]):
+                open_from = datetime.combine(day.date(), open_start).replace(tzinfo=day.tzinfo)
+                if open_end == self.END_OF_DAY:
+                    open_until = day + timedelta(days=1)
+                else:
+                    open_until = datetime.combine(day.date(), open_end).replace(tzinfo=day.tzinfo)
+                if closed_from < open_from:
+                    self._add_closed(closed, closed_from, open_from, start, end)
+                closed_from = max(closed_from, open_until)
+            self._add_closed(closed, closed_from, day + timedelta(days=1), start, end)
+            day += timedelta(days=1)
+        return closed
+
+    def _add_closed(self, closed, closed_start, closed_end, start, end):
+        closed_start = max(closed_start, start)
+        closed_end = min(closed_end, end)
+        if closed_start >= closed_end:
+            return
+        if closed and closed[-1][1] == closed_start:
+            closed[-1] = (closed[-1][0], closed_end)
         else:
-            period_params['end'] = time(23, 59, 59)
-            already_constructed.append(period_params)
-            new_start = datetime.combine(start.date(), time()) + timedelta(days=1)
-            return self._construct_required_periods(
-                start=new_start,
-                end=end,
-                already_constructed=already_constructed
-            )
+            closed.append((closed_start, closed_end))
+
+
+class WeekdaySchedulesCache(object):
+    """Process-local cache of compiled ``WeekdaySchedule``s by validator pk."""
+
+    def __init__(self):
+        self._cache = {}
+
+    def get(self, pk):
+        if pk is None or pk not in self._cache:
+            return None
+        stored_at, schedule = self._cache[pk]
+        timeout = getattr(settings, 'KITABU_WEEKDAY_SCHEDULES_CACHE_TIMEOUT', None)
+        if timeout is not None and time_module.time() - stored_at > timeout:
+            return None
+        return schedule
+
+    def set(self, pk, schedule):
+        if pk is not None:
+            self._cache[pk] = (time_module.time(), schedule)
+
+    def invalidate(self, *args, **kwargs):
+        """Forget all compiled schedules. Accepts signal handler arguments."""
+        self._cache = {}
+
+
+weekday_schedules = WeekdaySchedulesCache()
+
+
+class PeriodsInWeekdaysValidator(Validator):
+    """Allow only reservation that fall into open hours pattern.
+
+    This validator requires associated ``Period`` model.
+
+    Periods are compiled into a ``WeekdaySchedule`` once and kept in
+    ``weekday_schedules`` until any ``WithinDayPeriod`` is saved or deleted
+    in this process. Set ``settings.KITABU_WEEKDAY_SCHEDULES_CACHE_TIMEOUT``
+    (in seconds) if periods are changed by other processes too."""
+
+    class Meta:
+        abstract = True
+
+    def get_schedule(self):
+        """Return ``WeekdaySchedule`` of this validator."""
+        schedule = weekday_schedules.get(self.pk)
+        if schedule is None:
+            schedule = WeekdaySchedule(self.periods.all())
+            weekday_schedules.set(self.pk, schedule)
+        return schedule
+
+    def get_forbidden_periods(self, start, end, size=1, duration=None):
+        return self.get_schedule().closed_periods(start, end)
+
+    def _perform_validation(self, reservation):
+        if not self.get_schedule().covers(reservation.start, reservation.end):
+            raise ForbiddenHours(self.periods.all())
 
 
 class WithinDayPeriod(models.Model):
@@ -425,6 +782,15 @@ class WithinDayPeriod(models.Model):
     end = models.TimeField()
 
 
+def _invalidate_weekday_schedules(sender, instance, **kwargs):
+    if isinstance(instance, (WithinDayPeriod, PeriodsInWeekdaysValidator)):
+        weekday_schedules.invalidate()
+
+
+post_save.connect(_invalidate_weekday_schedules, dispatch_uid='kitabu_weekday_schedules_save')
+post_delete.connect(_invalidate_weekday_schedules, dispatch_uid='kitabu_weekday_schedules_delete')
+
+
 class MaxDurationValidator(Validator):
     """Make sure reservation is not too long.
 
@@ -443,6 +809,12 @@ class MaxDurationValidator(Validator):
         if duration > self.max_duration_in_seconds:
             raise TooLong(self.max_duration_in_seconds)
 
+    def get_forbidden_periods(self, start, end, size=1, duration=None):
+        """Forbid whole period if reservations are to be longer than allowed."""
+        if duration is not None and duration.days * SECONDS_IN_DAY + duration.seconds > self.max_duration_in_seconds:
+            return [(start, end)]
+        return []
+
 
 class MaxReservationsPerUserValidator(Validator):
     """Make sure specific user doesn't have too many reservations.
@@ -461,6 +833,8 @@ class MaxReservationsPerUserValidator(Validator):
     max_reservations_on_current_subject = models.PositiveSmallIntegerField(default=0, help_text="0 means no limit")
     max_reservations_on_all_subjects = models.PositiveSmallIntegerField(default=0, help_text="0 means no limit")
 
+    checks_other_reservations = True
+
     def _perform_validation(self, reservation):
         if self.max_reservations_on_current_subject:
             reservations_so_far = reservation.subject.reservations.filter(
@@ -472,3 +846,29 @@ class MaxReservationsPerUserValidator(Validator):
                 end__gte=now(), owner=reservation.owner).count()
             if reservations_so_far >= self.max_reservations_on_all_subjects:
                 raise TooManyReservationsForUser(self.max_reservations_on_all_subjects)
+
+    def _perform_bulk_validation(self, reservations):
+        """Count reservations so far with one grouped query per user."""
+        invalid = []
+        reservations_by_owner = defaultdict(list)
+        for reservation in reservations:
+            reservations_by_owner[(reservation.__class__, reservation.owner)].append(reservation)
+
+        for (reservation_model, owner), owner_reservations in reservations_by_owner.iteritems():
+            future_reservations = reservation_model.objects.filter(end__gte=now(), owner=owner)
+
+            if self.max_reservations_on_current_subject:
+                reservations_so_far = dict(future_reservations.filter(
+                    subject__in=set(r.subject_id for r in owner_reservations)
+                ).values_list('subject').annotate(Count('pk')).order_by())
+                for reservation in owner_reservations:
+                    if reservations_so_far.get(reservation.subject_id, 0) >= self.max_reservations_on_current_subject:
+                        invalid.append(reservation)
+
+            if self.max_reservations_on_all_subjects:
+                if future_reservations.count() >= self.max_reservations_on_all_subjects:
+                    # unsaved reservations compare equal, so compare identities
+                    already_invalid = set(id(r) for r in invalid)
+                    invalid.extend(r for r in owner_reservations if id(r) not in already_invalid)
+
+        return invalid
@@ -1,13 +1,28 @@
 # TODO: code review of whole module
 from collections import defaultdict
+from heapq import merge
+from itertools import islice
 
 from datetime import timedelta
 
-from django.db.models import Q, Sum
+from django.db import connections
+from django.db.models import Q, Sum, Max
 
-from kitabu.search.utils import Timeline
+from kitabu.search.utils import Timeline, subtract_periods
+from kitabu.utils import has_size_field, load_spans
+from kitabu.engines import supports_window_functions
+from kitabu.models.validators import validator_registry
+from kitabu.models.occupancy import OccupancySegmentsSubjectMixin
+from kitabu.models.slots import SlotCountersSubjectMixin
 
-from kitabu.exceptions import ReservationValidationError
+
+def _forbidden_periods(validators, start, end, size, duration):
+    """Return periods forbidden by any of ``validators``."""
+    forbidden_periods = []
+    for validator in validators:
+        forbidden_periods.extend(validator.get_actual_validator().get_forbidden_periods(
+            start, end, size=size, duration=duration))
+    return forbidden_periods
 
 
 class Subjects(object):
@@ -19,11 +34,15 @@ class Subjects(object):
     Finite availablity means only certain number of reservations at a time is
     possible.
 
+    If ``index`` (``kitabu.search.index.AvailabilityIndex``) is given, usage
+    of subjects is read from it instead of the database.
+
     """
 
-    def __init__(self, subject_model, subject_manager=None):
+    def __init__(self, subject_model, subject_manager=None, index=None):
         self.subject_model = subject_model
         self.reservation_model = subject_model.get_reservation_model()
+        self.index = index
         if subject_manager:
             self._subject_manager = subject_manager
 
@@ -44,53 +63,163 @@ class Subjects(object):
         if required_size is None:
             raise Exception('required_size or size must be provided')
 
+        disqualified_subjects = [
+            subject.id for subject, peak_usage in self._peak_usages(start, end, self.subject_manager.all())
+            if peak_usage + required_size > subject.size
+        ]
+        return self.subject_manager.exclude(id__in=disqualified_subjects).filter(size__gte=required_size)
+
+    def _peak_usages(self, start, end, subjects):
+        """Return (subject, peak usage) pairs for ``subjects`` used in given period.
+
+        Subjects with no reservations in the period may be omitted. Subjects
+        with ``OccupancySegmentsSubjectMixin`` are answered from occupancy
+        segments with one grouped query, and those with
+        ``SlotCountersSubjectMixin`` from chunks of slot counters fetched
+        with one query.
+
+        """
+        if self.index is not None:
+            return [(subject, self.index.peak_usage(subject, start, end)) for subject in subjects]
+
+        if issubclass(self.subject_model, SlotCountersSubjectMixin):
+            subjects = list(subjects)
+            validators = validator_registry.get_validators_for_subjects(subjects)
+            slot_lengths = {}
+            other_subjects = []
+            for subject in subjects:
+                slot_length = subject.get_slot_length(validators[subject.pk])
+                if slot_length is None or not subject.slot_counters_cover(start, slot_length):
+                    other_subjects.append(subject.pk)
+                else:
+                    slot_lengths[subject.pk] = slot_length
+            chunks = defaultdict(list)
+            if slot_lengths:
+                chunk_length = max(slot_lengths.values()) * self.subject_model.slot_counters_chunk_size
+                chunk_model = self.subject_model.get_slot_counters_chunk_model()
+                for subject_id, chunk_start, counters in chunk_model.objects.filter(
+                        subject__in=slot_lengths.keys(), start__gt=start - chunk_length, start__lt=end,
+                ).values_list('subject', 'start', 'counters'):
+                    chunks[subject_id].append((chunk_start, counters))
+            peak_usages = [
+                (subject, subject.slot_peak_usage(start, end, slot_lengths[subject.pk], chunks[subject.pk]))
+                for subject in subjects if subject.pk in slot_lengths
+            ]
+            if other_subjects:
+                peak_usages.extend(self._reservations_peak_usages(
+                    start, end, self.subject_model.objects.filter(pk__in=other_subjects)))
+            return peak_usages
+
+        if issubclass(self.subject_model, OccupancySegmentsSubjectMixin):
+            subjects = subjects.filter(
+                occupancy_segments__start__lt=end,
+                occupancy_segments__end__gt=start,
+            ).annotate(peak_usage=Max('occupancy_segments__size'))
+            return [(subject, subject.peak_usage) for subject in subjects]
+
+        return self._reservations_peak_usages(start, end, subjects)
+
+    def _reservations_peak_usages(self, start, end, subjects):
         colliding_reservations = self.reservation_model.colliding_reservations_in_subjects(
             start=start,
             end=end,
-            subjects=self.subject_manager.all()
-        ).select_related('subject')
+            subjects=subjects
+        )
 
         timelines = defaultdict(lambda: defaultdict(lambda: 0))
 
-        for reservation in colliding_reservations:
-            reservation_start = max(start, reservation.start)
-            timelines[reservation.subject][reservation_start] += reservation.size
-            if reservation.end < end:
-                timelines[reservation.subject][reservation.end] -= reservation.size
+        for span in load_spans(colliding_reservations):
+            timelines[span.subject_id][max(start, span.start)] += span.size
+            if span.end < end:
+                timelines[span.subject_id][span.end] -= span.size
 
-        disqualified_subjects = []
-        for subject, timeline in timelines.iteritems():
+        peak_usages = []
+        for subject in subjects.filter(pk__in=timelines.keys()):
+            timeline = timelines[subject.pk]
             reservations_cnt = 0
             max_reservations = 0
             for moment in sorted(timeline.keys()):
                 reservations_cnt += timeline[moment]
-                if reservations_cnt > max_reservations:
-                    max_reservations = reservations_cnt
-                    if reservations_cnt + required_size > subject.size:
-                        disqualified_subjects.append(subject.id)
-                        break
-        return self.subject_manager.exclude(id__in=disqualified_subjects).filter(size__gte=required_size)
+                max_reservations = max(max_reservations, reservations_cnt)
+            peak_usages.append((subject, max_reservations))
+        return peak_usages
 
     def valid_search(self, *args, **kwargs):
-        pre_results = self.search(*args, **kwargs)
-        final_results = []
-        for subject in pre_results:
-            reservation = subject.reservation_model(subject=subject, **kwargs)
-            try:
-                subject._validate_reservation(reservation)
-                if kwargs.get('exclusive') or subject._only_exclusive_reservations():
-                    subject._validate_exclusive(reservation)
-            except ReservationValidationError:
-                pass
-            else:
-                final_results.append(subject)
-        return final_results
+        """Search for subjects on which reservation with given arguments is valid.
+
+        Reservation is checked against validators of each subject and, if it
+        is exclusive, against overlapping reservations (found for all
+        subjects with ``overlapping_reservations_in_subjects`` of the subject
+        model). Validators of all subjects are loaded at once and each of
+        them validates all the reservations it applies to in one go, so
+        number of queries doesn't grow with number of subjects. Subjects with
+        a validator that forbids the period (see
+        ``Validator.get_forbidden_periods``) are discarded without validating
+        their reservations.
+
+        """
+        search_kwargs = dict(kwargs)
+        search_kwargs.pop('exclusive', None)
+        if 'size' not in search_kwargs and 'required_size' not in search_kwargs:
+            search_kwargs['required_size'] = 1
+        reservation_kwargs = dict(kwargs)
+        reservation_kwargs.pop('required_size', None)
+
+        pre_results = list(self.search(*args, **search_kwargs))
+        reservations = [subject.reservation_model(subject=subject, **reservation_kwargs) for subject in pre_results]
+
+        validators = {}
+        reservations_for_validator = defaultdict(list)
+        subjects_validators = validator_registry.get_validators_for_subjects(pre_results)
+        forbidding = set()
+        for subject_validators in subjects_validators.itervalues():
+            for validator in subject_validators:
+                if validator.pk not in validators:
+                    validators[validator.pk] = validator
+                    if _forbidden_periods([validator], kwargs['start'], kwargs['end'], kwargs.get('size', 1),
+                                          kwargs['end'] - kwargs['start']):
+                        forbidding.add(validator.pk)
+
+        invalid = set()
+        for reservation in reservations:
+            subject_validators = subjects_validators[reservation.subject_id]
+            if any(validator.pk in forbidding for validator in subject_validators):
+                invalid.add(id(reservation))
+                continue
+            for validator in subject_validators:
+                reservations_for_validator[validator.pk].append(reservation)
+
+        for validator_pk, validator_reservations in reservations_for_validator.iteritems():
+            invalid.update(id(r) for r in validators[validator_pk].validate_many(validator_reservations))
+
+        exclusive_subjects = [
+            subject for subject in pre_results
+            if kwargs.get('exclusive') or subject._only_exclusive_reservations()
+        ]
+        if exclusive_subjects:
+            overlapped_subjects = set(self.subject_model.overlapping_reservations_in_subjects(
+                [subject.pk for subject in exclusive_subjects], kwargs['start'], kwargs['end'],
+            ).values_list('subject_id', flat=True))
+        else:
+            overlapped_subjects = set()
+
+        return [
+            reservation.subject for reservation in reservations
+            if id(reservation) not in invalid and reservation.subject_id not in overlapped_subjects
+        ]
 
 
 class ExclusivelyAvailableSubjects(Subjects):
     """Searcher to find subject available for exclusive reservation."""
 
     def search(self, start, end):
+        if self.index is not None:
+            disqualified_subjects = [
+                subject.id for subject, peak_usage in self._peak_usages(start, end, self.subject_manager.all())
+                if peak_usage > 0
+            ]
+            return self.subject_manager.exclude(id__in=disqualified_subjects)
+
         colliding_reservations = self.reservation_model.colliding_reservations_in_subjects(
             start=start,
             end=end,
@@ -105,8 +234,26 @@ class FindPeriod(object):
 
     To search on certain subject for a period when it is available.
     E.g. to search for 7 days availability during May 2012.
+
+    If ``index`` (``kitabu.search.index.AvailabilityIndex``) is given,
+    timeline of subject is taken from it instead of the database.
+
+    ``timeline_class`` may be set to ``kitabu.search.utils.ArrayTimeline``
+    to search long periods with many reservations faster (requires NumPy).
+
+    Timeline of subjects with ``SlotCountersSubjectMixin`` is built from
+    their slot counters.
+
+    Periods forbidden by validators of subjects are cut out of free periods
+    (see ``Validator.get_forbidden_periods``), unless ``use_validators`` is
+    False.
     """
 
+    def __init__(self, index=None, timeline_class=Timeline, use_validators=True):
+        self.index = index
+        self.timeline_class = timeline_class
+        self.use_validators = use_validators
+
     def search(self,
                start,
                end,
@@ -115,37 +262,102 @@ class FindPeriod(object):
                required_size=0,
                reservations=None
                ):
-        timeline = Timeline(start, end, subject, reservations)
+        forbidden_periods = []
+        if self.use_validators and subject is not None:
+            forbidden_periods = _forbidden_periods(
+                validator_registry.get_validators(subject), start, end, required_size or subject.size,
+                required_duration)
+            if not list(subtract_periods([(start, end)], forbidden_periods, required_duration)):
+                return []
+
+        slot_length = None
+        if self.index is None and reservations is None and isinstance(subject, SlotCountersSubjectMixin):
+            slot_length = subject.get_slot_length()
+
+        if self.index is not None and subject is not None and reservations is None:
+            timeline = self.index.timeline(subject, start, end, timeline_class=self.timeline_class)
+        elif slot_length is not None and subject.slot_counters_cover(start, slot_length):
+            timeline = subject.slot_timeline(start, end, slot_length)
+        else:
+            timeline = self.timeline_class(start, end, subject, reservations)
 
         available_size = subject.size if subject else 1
         if not required_size:
             required_size = available_size
-        available_dates = []
-        potential_start = timeline.start
-        current_date = timeline.end
-        current_size = 0
-
-        for current_date, delta in timeline:
-            current_size += delta
-            if current_size + required_size <= available_size:
-                if potential_start is None:
-                    potential_start = current_date
-            elif potential_start:
-                if current_date - potential_start >= required_duration:
-                    available_dates.append((potential_start, current_date))
-                potential_start = None
-        if (
-            potential_start is not None
-            and current_size + required_size <= available_size
-            and end - potential_start >= required_duration
-        ):
-            available_dates.append((potential_start, end))
-        return available_dates
+        free_periods = timeline.free_periods(required_size, available_size, required_duration)
+        if forbidden_periods:
+            free_periods = list(subtract_periods(free_periods, forbidden_periods, required_duration))
+        return free_periods
+
+    def search_many(self,
+                    start,
+                    end,
+                    subjects,
+                    required_duration=timedelta(1),
+                    required_size=0,
+                    limit=None
+                    ):
+        """Find free periods on any of ``subjects``, earliest first.
+
+        ``subjects`` is a query set (or list) of subjects of one class, e.g.
+        ``Lane.objects.filter(pool=pool)`` or ``hotel.rooms.all()``.
+        Reservations of all of them are fetched with one query (none if
+        ``index`` is set).
+
+        Return list of (subject, start, end) tuples sorted by start, at most
+        ``limit`` long. Sweeping timelines stops once ``limit`` periods are
+        found.
+
+        """
+        subjects = list(subjects)
+        if not subjects:
+            return []
+
+        if self.index is None:
+            reservations_by_subject = defaultdict(lambda: [])
+            reservation_model = subjects[0].get_reservation_model()
+            reservations = reservation_model.colliding_reservations_in_subjects(
+                start=start, end=end, subjects=[subject.pk for subject in subjects])
+            for span in load_spans(reservations):
+                reservations_by_subject[span.subject_id].append(span)
+
+        if self.use_validators:
+            validators = validator_registry.get_validators_for_subjects(subjects)
+
+        free_periods = []
+        for number, subject in enumerate(subjects):
+            if self.index is not None:
+                timeline = self.index.timeline(subject, start, end, timeline_class=self.timeline_class)
+            elif reservations_by_subject[subject.pk]:
+                timeline = self.timeline_class(start, end, subject, reservations_by_subject[subject.pk])
+            else:
+                timeline = self.timeline_class.from_changes(start, end, [], subject=subject)
+            forbidden_periods = []
+            if self.use_validators:
+                forbidden_periods = _forbidden_periods(
+                    validators[subject.pk], start, end, required_size or subject.size, required_duration)
+            free_periods.append(self._subject_free_periods(
+                timeline, number, subject, required_size or subject.size, required_duration, forbidden_periods))
+
+        results = ((subject, period_start, period_end)
+                   for period_start, period_end, number, subject in merge(*free_periods))
+        return list(islice(results, limit))
+
+    def _subject_free_periods(self, timeline, number, subject, required_size, required_duration,
+                              forbidden_periods):
+        periods = timeline.iter_free_periods(required_size, subject.size, required_duration)
+        if forbidden_periods:
+            periods = subtract_periods(periods, forbidden_periods, required_duration)
+        for period_start, period_end in periods:
+            # number keeps order of subjects for periods with the same bounds
+            yield period_start, period_end, number, subject
 
 
 class Clusters(Subjects):
     """Searcher for clusters available in certain time period."""
-    def __init__(self, subject_model, cluster_model, subject_related_name='subjects', *args, **kwargs):
+    def __init__(self, subject_model, cluster_model, subject_related_name='subjects', index=None, *args, **kwargs):
+        self.subject_model = subject_model
+        self.index = index
         self.reservation_model = subject_model.get_reservation_model()
         self.cluster_model = cluster_model
         self.subject_related_name = subject_related_name
@@ -162,36 +374,91 @@ class Clusters(Subjects):
 
     def search(self, start, end, required_size):
 
-        clusters_with_size = self.cluster_manager.annotate(size=Sum(self.subject_related_name + '__size'))
+        clusters_with_size = self._clusters_with_size()
         clusters_with_size_dict = dict((cluster.id, cluster) for cluster in clusters_with_size)
 
-        colliding_reservations = self.reservation_model.colliding_reservations_in_clusters(
-            start=start,
-            end=end,
-            clusters=self.cluster_manager.all()
-        ).select_related('subject')
-
-        timelines = defaultdict(lambda: defaultdict(lambda: 0))
-
         disqualified_clusters = []
 
-        for reservation in colliding_reservations:
-            reservation_start = start if reservation.start < start else reservation.start
-            timelines[reservation.subject][reservation_start] += reservation.size
-            if reservation.end < end:
-                timelines[reservation.subject][reservation.end] -= reservation.size
-
-        for subject, timeline in timelines.iteritems():
-            reservations_cnt = 0
-            max_reservations = 0
-            for moment in sorted(timeline.keys()):
-                reservations_cnt += timeline[moment]
-                if reservations_cnt > max_reservations:
-                    max_reservations = reservations_cnt
-
+        subjects = self.subject_model.objects.filter(cluster__in=self.cluster_manager.all())
+        for subject, peak_usage in self._peak_usages(start, end, subjects):
             cluster = clusters_with_size_dict[subject.cluster_id]
-            cluster.size -= max_reservations
+            cluster.size -= peak_usage
             if cluster.size < required_size:
                 disqualified_clusters.append(subject.cluster_id)
 
         return clusters_with_size.filter(~Q(id__in=disqualified_clusters), size__gte=required_size)
+
+    def _clusters_with_size(self):
+        """Return clusters annotated with summed ``size`` of their subjects."""
+        return self.cluster_manager.annotate(size=Sum(self.subject_related_name + '__size'))
+
+
+class AggregateClusters(Clusters):
+    """Searcher for clusters available in certain time period, inside the database.
+
+    Gives the same results as ``Clusters``, but peak usage of subjects and
+    remaining capacity of clusters are computed by one grouped query using
+    window functions, so no reservations are transferred at all. On
+    databases without window functions (or with ``index``) it falls back to
+    ``Clusters``.
+
+    """
+
+    SQL = (
+        "SELECT sizes.%(cluster)s FROM (%(sizes)s) sizes "
+        "LEFT JOIN ("
+        "SELECT s.%(cluster)s AS cluster_id, SUM(peaks.peak) AS used FROM ("
+        "SELECT subject_id, MAX(balance) AS peak FROM ("
+        "SELECT subject_id, SUM(delta) OVER ("
+        "PARTITION BY subject_id ORDER BY moment, delta ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW"
+        ") AS balance FROM ("
+        "SELECT r.%(subject)s AS subject_id, r.%(start)s AS moment, %(size)s AS delta FROM (%(reservations)s) r "
+        "UNION ALL "
+        "SELECT r.%(subject)s AS subject_id, r.%(end)s AS moment, -%(size)s AS delta FROM (%(reservations)s) r"
+        ") events"
+        ") balances GROUP BY subject_id"
+        ") peaks JOIN %(subject_table)s s ON s.%(subject_pk)s = peaks.subject_id "
+        "GROUP BY s.%(cluster)s"
+        ") usages ON usages.cluster_id = sizes.%(cluster)s "
+        "WHERE sizes.total - COALESCE(usages.used, 0) >= %%s"
+    )
+
+    def search(self, start, end, required_size):
+        ids = self.search_ids(start, end, required_size)
+        if ids is None:
+            return super(AggregateClusters, self).search(start, end, required_size)
+        return self._clusters_with_size().filter(pk__in=ids)
+
+    def search_ids(self, start, end, required_size):
+        """Return list of ids of available clusters, or None if query can't be run here."""
+        subjects = self.subject_model.objects.filter(cluster__in=self.cluster_manager.all())
+        connection = connections[subjects.db]
+        if self.index is not None or not supports_window_functions(connection):
+            return None
+
+        sizes_sql, sizes_params = subjects.values('cluster').annotate(total=Sum('size')).values_list(
+            'cluster', 'total').order_by().query.sql_with_params()
+
+        fields = ['subject', 'start', 'end']
+        if has_size_field(self.reservation_model):
+            fields.append('size')
+        reservations = self.reservation_model.colliding_reservations_in_subjects(
+            start=start, end=end, subjects=subjects)
+        reservations_sql, reservations_params = reservations.values_list(*fields).order_by().query.sql_with_params()
+
+        qn = connection.ops.quote_name
+        subject_opts = self.subject_model._meta
+        reservation_opts = self.reservation_model._meta
+        cursor = connection.cursor()
+        cursor.execute(self.SQL % {
+            'sizes': sizes_sql,
+            'reservations': reservations_sql,
+            'cluster': qn(subject_opts.get_field('cluster').column),
+            'subject': qn(reservation_opts.get_field('subject').column),
+            'start': qn(reservation_opts.get_field('start').column),
+            'end': qn(reservation_opts.get_field('end').column),
+            'size': 'r.' + qn(reservation_opts.get_field('size').column) if 'size' in fields else '1',
+            'subject_table': qn(subject_opts.db_table),
+            'subject_pk': qn(subject_opts.pk.column),
+        }, tuple(sizes_params) + tuple(reservations_params) * 2 + (required_size,))
+        return [row[0] for row in cursor.fetchall()]
@@ -0,0 +1,277 @@
+#-*- coding=utf-8 -*-
+"""In-process availability index for read-heavy searching.
+
+``AvailabilityIndex`` keeps changes of usage of every subject in memory, in
+a balanced tree that can answer "what is the peak usage of this subject
+between start and end" in O(log n). Searchers accept it as ``index``
+argument and then don't query reservations at all:
+
+    index = AvailabilityIndex(Lane)
+    index.load()
+    index.connect()
+
+    SubjectsSearcher(Lane, index=index).search(start, end, required_size=2)
+
+The index sees only changes made in its own process (through model
+signals). Give it ``timeout`` to reload periodically if other processes
+make reservations too. Transactions rolled back by ``RetryPolicy`` make it
+reload on next use, as reservations saved in them are gone.
+
+"""
+
+from heapq import heappush, heappop
+from random import random
+from threading import RLock
+from time import time
+
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+from kitabu.search.utils import Timeline
+from kitabu.signals import reservations_changed, transaction_rolled_back
+
+now = timezone.now
+
+
+class _Node(object):
+    __slots__ = ('moment', 'delta', 'priority', 'left', 'right', 'sum', 'max_prefix')
+
+    def __init__(self, moment, delta):
+        self.moment = moment
+        self.delta = delta
+        self.priority = random()
+        self.left = self.right = None
+        self.update()
+
+    def update(self):
+        left_sum = self.left.sum if self.left else 0
+        self.sum = left_sum + self.delta + (self.right.sum if self.right else 0)
+        self.max_prefix = left_sum + self.delta
+        if self.left:
+            self.max_prefix = max(self.max_prefix, self.left.max_prefix)
+        if self.right:
+            self.max_prefix = max(self.max_prefix, left_sum + self.delta + self.right.max_prefix)
+
+
+def _split(node, moment, include_equal=False):
+    """Split tree into nodes before ``moment`` and the rest.
+
+    With ``include_equal`` node at ``moment`` goes to the first part.
+
+    """
+    if node is None:
+        return None, None
+    if node.moment < moment or (include_equal and node.moment == moment):
+        node.right, right = _split(node.right, moment, include_equal)
+        node.update()
+        return node, right
+    else:
+        left, node.left = _split(node.left, moment, include_equal)
+        node.update()
+        return left, node
+
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        right.update()
+        return right
+
+
+def _in_order(node, items):
+    if node is not None:
+        _in_order(node.left, items)
+        items.append((node.moment, node.delta))
+        _in_order(node.right, items)
+
+
+class UsageTree(object):
+    """Changes of usage of one subject in time.
+
+    A treap keyed by moment, holding how much usage changes at that moment.
+    Every node knows sum of changes in its subtree and the biggest prefix
+    sum, which is enough to find peak usage in any period in O(log n).
+
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, moment, delta):
+        """Change usage from ``moment`` on by ``delta``."""
+        before, rest = _split(self.root, moment)
+        node, after = _split(rest, moment, include_equal=True)
+        if node is None:
+            node = _Node(moment, delta)
+        else:
+            node.delta += delta
+            node.update()
+        if node.delta == 0:
+            node = None
+        self.root = _merge(_merge(before, node), after)
+
+    def peak(self, start, end):
+        """Return maximal usage in period between ``start`` and ``end``."""
+        before, rest = _split(self.root, start, include_equal=True)
+        inside, after = _split(rest, end)
+        base = before.sum if before else 0
+        peak = base + max(0, inside.max_prefix) if inside else base
+        self.root = _merge(_merge(before, inside), after)
+        return peak
+
+    def changes(self, start, end):
+        """Return changes like ``kitabu.search.utils.Timeline`` does.
+
+        Usage at ``start`` is given as change at ``start`` and whatever is
+        in use at ``end`` is released at ``end``.
+
+        """
+        before, rest = _split(self.root, start, include_equal=True)
+        inside, after = _split(rest, end)
+        items = []
+        _in_order(inside, items)
+        base = before.sum if before else 0
+        self.root = _merge(_merge(before, inside), after)
+
+        changes = [(start, base)] if base else []
+        changes.extend(items)
+        balance = sum(delta for moment, delta in changes)
+        if balance:
+            changes.append((end, -balance))
+        return changes
+
+
+class AvailabilityIndex(object):
+    """In-memory usage of all subjects of ``subject_model``.
+
+    Not approved reservations are dropped from the index once their
+    ``valid_until`` passes.
+
+    """
+
+    def __init__(self, subject_model, timeout=None):
+        self.subject_model = subject_model
+        self.reservation_model = subject_model.get_reservation_model()
+        self.timeout = timeout
+        self.loaded_at = None
+        self._lock = RLock()
+        self._clear()
+
+    def load(self):
+        """(Re)load the index from reservations in the database."""
+        with self._lock:
+            self._clear()
+            self._load_reservations(self.reservation_model.objects.all())
+            self.loaded_at = time()
+
+    def connect(self):
+        """Keep the index up to date with reservations saved in this process."""
+        post_save.connect(self._reservation_saved, sender=self.reservation_model)
+        post_delete.connect(self._reservation_deleted, sender=self.reservation_model)
+        reservations_changed.connect(self._reservations_changed)
+        transaction_rolled_back.connect(self._transaction_rolled_back)
+
+    def disconnect(self):
+        post_save.disconnect(self._reservation_saved, sender=self.reservation_model)
+        post_delete.disconnect(self._reservation_deleted, sender=self.reservation_model)
+        reservations_changed.disconnect(self._reservations_changed)
+        transaction_rolled_back.disconnect(self._transaction_rolled_back)
+
+    def peak_usage(self, subject, start, end):
+        """Return maximal usage of ``subject`` between ``start`` and ``end``."""
+        with self._lock:
+            self._refresh()
+            tree = self._trees.get(subject.pk)
+            return tree.peak(start, end) if tree else 0
+
+    def timeline(self, subject, start, end, timeline_class=Timeline):
+        """Return ``Timeline`` of ``subject`` between ``start`` and ``end``."""
+        with self._lock:
+            self._refresh()
+            tree = self._trees.get(subject.pk)
+            changes = tree.changes(start, end) if tree else []
+        return timeline_class.from_changes(start, end, changes, subject=subject)
+
+    # Private
+
+    def _clear(self):
+        self._trees = {}
+        self._reservations = {}
+        self._expiring = []
+
+    def _load_reservations(self, reservations):
+        fields = ['pk', 'subject_id', 'start', 'end']
+        field_names = [field.name for field in self.reservation_model._meta.fields]
+        for field_name in ['size', 'approved', 'valid_until']:
+            if field_name in field_names:
+                fields.append(field_name)
+
+        for values in reservations.values_list(*fields).iterator():
+            values = dict(zip(fields, values))
+            if values.get('approved', True):
+                values['valid_until'] = None
+            self._add(values['pk'], values['subject_id'], values['start'], values['end'],
+                      values.get('size', 1), values.get('valid_until'))
+
+    def _reload_subject(self, subject_id):
+        for pk in [pk for pk, values in self._reservations.iteritems() if values[0] == subject_id]:
+            self._remove(pk)
+        self._trees.pop(subject_id, None)
+        self._load_reservations(self.reservation_model.objects.filter(subject_id=subject_id))
+
+    def _refresh(self):
+        if self.loaded_at is None or (self.timeout is not None and time() - self.loaded_at > self.timeout):
+            self.load()
+        current_time = now()
+        while self._expiring and self._expiring[0][0] <= current_time:
+            valid_until, pk = heappop(self._expiring)
+            if pk in self._reservations and self._reservations[pk][4] == valid_until:
+                self._remove(pk)
+
+    def _add(self, pk, subject_id, start, end, size, valid_until=None):
+        self._remove(pk)
+        tree = self._trees.setdefault(subject_id, UsageTree())
+        tree.add(start, size)
+        tree.add(end, -size)
+        self._reservations[pk] = (subject_id, start, end, size, valid_until)
+        if valid_until is not None:
+            heappush(self._expiring, (valid_until, pk))
+
+    def _remove(self, pk):
+        if pk in self._reservations:
+            subject_id, start, end, size, valid_until = self._reservations.pop(pk)
+            tree = self._trees[subject_id]
+            tree.add(start, -size)
+            tree.add(end, size)
+
+    def _reservation_saved(self, sender, instance, **kwargs):
+        with self._lock:
+            if not instance.is_valid():
+                self._remove(instance.pk)
+                return
+            start = instance._meta.get_field('start').to_python(instance.start)
+            end = instance._meta.get_field('end').to_python(instance.end)
+            valid_until = None if getattr(instance, 'approved', True) else instance.valid_until
+            self._add(instance.pk, instance.subject_id, start, end, getattr(instance, 'size', 1), valid_until)
+
+    def _reservation_deleted(self, sender, instance, **kwargs):
+        with self._lock:
+            self._remove(instance.pk)
+
+    def _reservations_changed(self, sender, subject, **kwargs):
+        if issubclass(sender, self.subject_model):
+            with self._lock:
+                self._reload_subject(subject.pk)
+
+    def _transaction_rolled_back(self, sender, **kwargs):
+        # changes seen in the transaction are undone, which sends no signals
+        with self._lock:
+            self.loaded_at = None
@@ -1,6 +1,8 @@
 # TODO: This module might use a little refactoring. Espacially passing *args
 # and use of __init__ could use a closer look.
 
+from kitabu.utils import load_spans
+
 
 class ReservationSearch(object):
     """Searcher for reservations.
@@ -8,6 +10,10 @@ class ReservationSearch(object):
     Constructor takes reservation model.
     ``search`` method on intialized object takes start and end arguments,
     plus any narrowing search criteria.
+
+    ``stream`` takes the same arguments and yields ``ReservationSpan``s
+    (subject_id, start, end, size) instead, fetching them in chunks - use it
+    for exporting large number of reservations.
     """
     def __init__(self, reservation_model):
         self.reservation_model = reservation_model
@@ -15,6 +21,10 @@ class ReservationSearch(object):
     def search(self, start, end, *args, **kwargs):
         return self.reservation_model.colliding_reservations(start=start, end=end, *args, **kwargs)
 
+    def stream(self, *args, **kwargs):
+        chunk_size = kwargs.pop('chunk_size', 1000)
+        return load_spans(self.search(*args, **kwargs), chunk_size=chunk_size)
+
 
 class SingleSubjectReservationSearch(ReservationSearch):
     """Searcher to find all reservations on given subject."""
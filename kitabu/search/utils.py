@@ -1,4 +1,53 @@
 from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+from kitabu.utils import ReservationSpan, load_spans
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def subtract_periods(periods, forbidden_periods, required_duration=timedelta(0)):
+    """Yield parts of ``periods`` that are outside of all ``forbidden_periods``.
+
+    Both are iterables of (start, end) pairs, ``periods`` sorted and not
+    overlapping. Parts shorter than ``required_duration`` are skipped.
+
+    """
+    forbidden_periods = sorted(forbidden_periods)
+    for period_start, period_end in periods:
+        current = period_start
+        for forbidden_start, forbidden_end in forbidden_periods:
+            if forbidden_start >= period_end:
+                break
+            if forbidden_end <= current:
+                continue
+            if forbidden_start - current >= required_duration and forbidden_start > current:
+                yield (current, forbidden_start)
+            current = max(current, forbidden_end)
+        if period_end - current >= required_duration and period_end > current:
+            yield (current, period_end)
+
+
+def _spans(start, end, subject, reservations):
+    """Return spans of ``reservations`` or of those overlapping period on ``subject``.
+
+    ``reservations`` may be model instances or ``ReservationSpan``s, which
+    are assumed to be valid.
+
+    """
+    if subject and not reservations:
+        return load_spans(subject.overlapping_reservations(start=start, end=end))
+    if subject:
+        reservations = [
+            r for r in reservations
+            if r.subject_id == subject.id and (isinstance(r, ReservationSpan) or r.is_valid())
+        ]
+    return [r if isinstance(r, ReservationSpan) else ReservationSpan.from_reservation(r) for r in reservations]
 
 
 class Timeline(list):
@@ -8,19 +57,24 @@ class Timeline(list):
         self.end = end
         self.subject = subject
 
-        if subject and not reservations:
-            reservations = subject.overlapping_reservations(start=start, end=end).select_related('subject')
-        elif subject and reservations:
-            reservations = [r for r in reservations if r.subject_id == subject.id and r.is_valid()]
-
         timeline = defaultdict(lambda: 0)
 
-        for reservation in reservations:
-            timeline[max(start, reservation.start)] += reservation.size
-            timeline[min(reservation.end, end)] -= reservation.size
+        for span in _spans(start, end, subject, reservations):
+            timeline[max(start, span.start)] += span.size
+            timeline[min(span.end, end)] -= span.size
 
         super(Timeline, self).__init__(sorted(timeline.iteritems()))
 
+    @classmethod
+    def from_changes(cls, start, end, changes, subject=None):
+        """Build timeline from already computed, sorted (moment, delta) pairs."""
+        timeline = cls.__new__(cls)
+        timeline.start = start
+        timeline.end = end
+        timeline.subject = subject
+        list.__init__(timeline, changes)
+        return timeline
+
     def max(self):
         current_max = current = 0
         for date, delta in self:
@@ -28,3 +82,142 @@ class Timeline(list):
             current_max = max(current, current_max)
 
         return current_max
+
+    def usage(self):
+        """Return list of (moment, usage from that moment on) pairs."""
+        current = 0
+        usage = []
+        for date, delta in self:
+            current += delta
+            usage.append((date, current))
+        return usage
+
+    def free_periods(self, required_size, available_size, required_duration):
+        """Return periods at least ``required_duration`` long with ``required_size`` free."""
+        return list(self.iter_free_periods(required_size, available_size, required_duration))
+
+    def iter_free_periods(self, required_size, available_size, required_duration):
+        """Like ``free_periods``, but yield periods as soon as they are found."""
+        potential_start = self.start
+        current_date = self.end
+        current_size = 0
+
+        for current_date, delta in self:
+            current_size += delta
+            if current_size + required_size <= available_size:
+                if potential_start is None:
+                    potential_start = current_date
+            elif potential_start:
+                if current_date - potential_start >= required_duration:
+                    yield (potential_start, current_date)
+                potential_start = None
+        if potential_start is not None and current_size + required_size <= available_size:
+            if self.end - potential_start >= required_duration:
+                yield (potential_start, self.end)
+
+
+class ArrayTimeline(object):
+    """Timeline kept in NumPy arrays, for long periods with many reservations.
+
+    Moments are stored as int64 microseconds since epoch and changes of
+    usage as int32, so ``max``, ``usage`` and ``free_periods`` run as
+    vectorized operations instead of Python loops. Iterating yields the
+    same (moment, delta) pairs as ``Timeline`` does, so it can be used
+    wherever ``Timeline`` is, e.g. ``FindPeriod(timeline_class=ArrayTimeline)``.
+
+    Requires NumPy.
+
+    """
+
+    def __init__(self, start, end, subject=None, reservations=None):
+        assert any([subject, reservations]), "You must provide either subject or reservations"
+        assert numpy is not None, "ArrayTimeline requires NumPy"
+        self.start = start
+        self.end = end
+        self.subject = subject
+
+        moments = []
+        deltas = []
+        for span in _spans(start, end, subject, reservations):
+            moments.append(self._to_int(max(start, span.start)))
+            deltas.append(span.size)
+            moments.append(self._to_int(min(span.end, end)))
+            deltas.append(-span.size)
+        self._set_changes(numpy.array(moments, dtype=numpy.int64), numpy.array(deltas, dtype=numpy.int32))
+
+    @classmethod
+    def from_changes(cls, start, end, changes, subject=None):
+        """Build timeline from already computed, sorted (moment, delta) pairs."""
+        assert numpy is not None, "ArrayTimeline requires NumPy"
+        timeline = cls.__new__(cls)
+        timeline.start = start
+        timeline.end = end
+        timeline.subject = subject
+        timeline._set_changes(
+            numpy.array([timeline._to_int(moment) for moment, delta in changes], dtype=numpy.int64),
+            numpy.array([delta for moment, delta in changes], dtype=numpy.int32))
+        return timeline
+
+    def __iter__(self):
+        return iter(zip(map(self._to_datetime, self.moments), self.deltas.tolist()))
+
+    def __len__(self):
+        return len(self.moments)
+
+    def max(self):
+        if not len(self.deltas):
+            return 0
+        return max(0, int(numpy.cumsum(self.deltas).max()))
+
+    def usage(self):
+        """Return list of (moment, usage from that moment on) pairs."""
+        return zip(map(self._to_datetime, self.moments), numpy.cumsum(self.deltas).tolist())
+
+    def usage_at(self, moment):
+        """Return usage at given ``moment``."""
+        index = numpy.searchsorted(self.moments, self._to_int(moment), side='right')
+        return int(self.deltas[:index].sum())
+
+    def free_periods(self, required_size, available_size, required_duration):
+        """Return periods at least ``required_duration`` long with ``required_size`` free.
+
+        Gives the same results as ``Timeline.free_periods``.
+
+        """
+        usage = numpy.cumsum(self.deltas)
+        # whether required size is free from each change on; beginning of
+        # timeline is always treated as a potential start
+        free = numpy.concatenate([[True], usage + required_size <= available_size])
+        # where free period starts (False -> True) and ends (True -> False)
+        transitions = numpy.diff(free.astype(numpy.int8))
+        starts = self.moments[transitions == 1]
+        ends = self.moments[transitions == -1]
+
+        starts = [self.start] + map(self._to_datetime, starts)
+        ends = map(self._to_datetime, ends)
+        current_size = int(usage[-1]) if len(usage) else 0
+        if current_size + required_size <= available_size:
+            ends.append(self.end)
+        return [(s, e) for s, e in zip(starts, ends) if e - s >= required_duration]
+
+    def iter_free_periods(self, required_size, available_size, required_duration):
+        return iter(self.free_periods(required_size, available_size, required_duration))
+
+    # Private
+
+    def _set_changes(self, moments, deltas):
+        self.moments, positions = numpy.unique(moments, return_inverse=True)
+        self.deltas = numpy.zeros(len(self.moments), dtype=numpy.int32)
+        numpy.add.at(self.deltas, positions, deltas)
+
+    def _epoch(self):
+        if timezone.is_aware(self.start):
+            return datetime(1970, 1, 1, tzinfo=timezone.utc)
+        return datetime(1970, 1, 1)
+
+    def _to_int(self, moment):
+        delta = moment - self._epoch()
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    def _to_datetime(self, value):
+        return self._epoch() + timedelta(microseconds=int(value))
@@ -0,0 +1,14 @@
+from django.dispatch import Signal
+
+# Sent when reservations on ``subject`` between ``start`` and ``end`` were
+# created, changed or deleted in bulk, without model signals for each
+# reservation (e.g. with ``bulk_create`` or ``QuerySet.update``).
+reservations_changed = Signal(providing_args=['subject', 'start', 'end'])
+
+# Sent by ``kitabu.transactions.RetryPolicy`` before a transaction that
+# failed with ``exception`` in ``attempt`` is run again.
+transaction_retried = Signal(providing_args=['policy', 'attempt', 'exception'])
+
+# Sent by ``kitabu.transactions.RetryPolicy`` after rolling back a transaction
+# that failed with ``exception``, whether it is retried or not.
+transaction_rolled_back = Signal(providing_args=['policy', 'exception'])
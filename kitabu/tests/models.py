@@ -1,9 +1,14 @@
+from datetime import timedelta
+
 from django.db import models
 from kitabu.models.subjects import (BaseSubject, ExclusiveSubjectMixin, FixedSizeSubject, VariableSizeSubjectMixin,
                                     ExclusivableVariableSizeSubjectMixin, SubjectWithApprovableReservations)
 from kitabu.models.reservations import (BaseReservation, ReservationWithSize, ReservationGroup,
                                         ReservationMaybeExclusive, ApprovableReservation)
 from kitabu.models.clusters import BaseCluster
+from kitabu.models.occupancy import BaseOccupancySegment, OccupancySegmentsSubjectMixin
+from kitabu.models.slots import BaseSlotCountersChunk, SlotCountersSubjectMixin
+from kitabu.models.locking import OptimisticLockingSubjectMixin, BucketLockingSubjectMixin, BaseReservationLock
 from kitabu.models.validators import (
     FullTimeValidator as KitabuFullTimeValidator,
     StaticValidator as KitabuStaticValidator,
@@ -125,6 +130,14 @@ class ApprovableRoomReservation(ReservationWithSize, ApprovableReservation, Base
     subject = models.ForeignKey(RoomWithApprovableReservations, related_name='reservations')
 
 
+class ExpiredRoomReservation(models.Model):
+    subject = models.ForeignKey(RoomWithApprovableReservations, related_name='expired_reservations')
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    size = models.PositiveIntegerField()
+    valid_until = models.DateTimeField()
+
+
 class Table(BaseSubject):
     pass
 
@@ -136,3 +149,61 @@ class TableReservation(BaseReservation):
 
 class MaxReservationsPerUserValidator(KitabuMaxReservationsPerUserValidator):
     pass
+
+
+class TrackedRoom(OccupancySegmentsSubjectMixin, VariableSizeSubjectMixin, BaseSubject):
+    cluster = models.ForeignKey(Hotel, related_name='tracked_rooms', null=True)
+
+
+class TrackedRoomReservation(ReservationWithSize, BaseReservation):
+    subject = models.ForeignKey(TrackedRoom, related_name='reservations')
+
+
+class TrackedRoomOccupancySegment(BaseOccupancySegment):
+    subject = models.ForeignKey(TrackedRoom, related_name='occupancy_segments')
+
+
+class OptimisticRoom(OptimisticLockingSubjectMixin, VariableSizeSubjectMixin, BaseSubject):
+    pass
+
+
+class OptimisticRoomReservation(ReservationWithSize, BaseReservation):
+    subject = models.ForeignKey(OptimisticRoom, related_name='reservations')
+
+
+class BucketRoom(BucketLockingSubjectMixin, VariableSizeSubjectMixin, BaseSubject):
+    lock_bucket_size = timedelta(hours=6)
+
+
+class BucketRoomReservation(ReservationWithSize, BaseReservation):
+    subject = models.ForeignKey(BucketRoom, related_name='reservations')
+
+
+class BucketRoomLock(BaseReservationLock):
+    subject = models.ForeignKey(BucketRoom, related_name='reservation_locks')
+
+    class Meta:
+        unique_together = ('subject', 'bucket')
+
+
+class SlotRoom(SlotCountersSubjectMixin, VariableSizeSubjectMixin, BaseSubject):
+    slot_counters_chunk_size = 24
+
+
+class SlotRoomReservation(ReservationWithSize, BaseReservation):
+    subject = models.ForeignKey(SlotRoom, related_name='reservations')
+
+
+class SlotRoomCountersChunk(BaseSlotCountersChunk):
+    subject = models.ForeignKey(SlotRoom, related_name='slot_counters')
+
+    class Meta:
+        unique_together = ('subject', 'start')
+
+
+class BoundedRoom(VariableSizeSubjectMixin, BaseSubject):
+    max_reservation_duration = timedelta(days=2)
+
+
+class BoundedRoomReservation(ReservationWithSize, BaseReservation):
+    subject = models.ForeignKey(BoundedRoom, related_name='reservations')
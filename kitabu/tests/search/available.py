@@ -1,9 +1,31 @@
 from datetime import datetime, timedelta
 
-from django.test import TestCase
-
-from kitabu.tests.models import Room, RoomReservation, Hotel, HotelRoom
-from kitabu.search.available import FindPeriod, Clusters as ClustersSearcher, Subjects as SubjectsSearcher
+from django.test import TestCase, TransactionTestCase
+from django.utils import unittest
+
+from mock import patch
+
+from kitabu.tests.models import (
+    Room,
+    RoomReservation,
+    Hotel,
+    HotelRoom,
+    ConferenceRoom,
+    ConferenceRoomReservation,
+    FullTimeValidator,
+    MaxDurationValidator,
+    NotWithinPeriodValidator,
+)
+from kitabu.exceptions import SizeExceeded
+from kitabu.search.available import (
+    FindPeriod,
+    Clusters as ClustersSearcher,
+    AggregateClusters as AggregateClustersSearcher,
+    Subjects as SubjectsSearcher,
+)
+from kitabu.search.index import AvailabilityIndex, UsageTree
+from kitabu.search.utils import Timeline, ArrayTimeline, numpy
+from kitabu.utils import AtomicReserver
 
 
 class SearchAvailableSubject(TestCase):
@@ -58,6 +80,58 @@ class SearchAvailableSubject(TestCase):
         self.assertEqual(0, len(searcher.search(**data)))
 
 
+class ValidSearchTest(TestCase):
+    def setUp(self):
+        self.rooms = [Room.objects.create(name='Room %s' % i, size=2) for i in range(6)]
+        self.full_hours_validator = FullTimeValidator.objects.create(interval_type='minute', interval=0)
+        for room in self.rooms[:3]:
+            room.validators.add(self.full_hours_validator)
+        RoomReservation.objects.create(
+            subject=self.rooms[5], size=2, start=datetime(2000, 1, 1, 10), end=datetime(2000, 1, 1, 12))
+
+    def test_subjects_failing_validation_are_excluded(self):
+        searcher = SubjectsSearcher(Room)
+        results = searcher.valid_search(start=datetime(2000, 1, 1, 10, 30), end=datetime(2000, 1, 1, 11), size=1)
+        self.assertEqual(self.rooms[3:5], results)
+
+        results = searcher.valid_search(start=datetime(2000, 1, 1, 12), end=datetime(2000, 1, 1, 14), size=1)
+        self.assertEqual(self.rooms, results)
+
+    def test_forbidden_periods_discard_subjects_without_validation(self):
+        searcher = SubjectsSearcher(Room)
+        with patch.object(FullTimeValidator, '_perform_validation') as perform_validation:
+            results = searcher.valid_search(start=datetime(2000, 1, 1, 10, 30), end=datetime(2000, 1, 1, 11), size=1)
+        self.assertEqual(self.rooms[3:5], results)
+        self.assertFalse(perform_validation.called)
+
+    def test_universal_validator(self):
+        MaxDurationValidator.objects.create(max_duration_in_seconds=3600, apply_to_all=True)
+        searcher = SubjectsSearcher(Room)
+        results = searcher.valid_search(start=datetime(2000, 1, 1, 12), end=datetime(2000, 1, 1, 14), size=1)
+        self.assertEqual([], results)
+
+    def test_number_of_queries_doesnt_depend_on_number_of_subjects(self):
+        searcher = SubjectsSearcher(Room)
+        # search: reservations, subjects; validators: universal, attached, FullTimeValidator subclass
+        with self.assertNumQueries(5):
+            searcher.valid_search(start=datetime(2000, 1, 1, 12), end=datetime(2000, 1, 1, 14), size=1)
+
+    def test_exclusive_reservations(self):
+        room1 = ConferenceRoom.objects.create(size=3)
+        room2 = ConferenceRoom.objects.create(size=3)
+        room1.reserve(start=datetime(2000, 1, 1, 10), end=datetime(2000, 1, 1, 12), size=1)
+
+        searcher = SubjectsSearcher(ConferenceRoom)
+        results = searcher.valid_search(start=datetime(2000, 1, 1, 11), end=datetime(2000, 1, 1, 13), exclusive=True)
+        self.assertEqual([room2], results)
+
+        with patch.object(ConferenceRoom, 'overlapping_reservations_in_subjects',
+                          return_value=ConferenceRoomReservation.objects.none()):
+            results = searcher.valid_search(
+                start=datetime(2000, 1, 1, 11), end=datetime(2000, 1, 1, 13), exclusive=True)
+        self.assertEqual([room1, room2], results)
+
+
 class VaryingDateAndSizeSearchTest(TestCase):
     def setUp(self):
         '''
@@ -194,13 +268,16 @@ class VaryingDateAndSizeSearchTest(TestCase):
         )
 
     def test_period_unavailable(self):
-        day = lambda day: datetime(2001, 1, day)
-        reserve = lambda start, end, size: RoomReservation.objects.create(
-            subject=self.room3,
-            size=size,
-            start=start,
-            end=end
-        )
+        def day(day):
+            return datetime(2001, 1, day)
+
+        def reserve(start, end, size):
+            return RoomReservation.objects.create(
+                subject=self.room3,
+                size=size,
+                start=start,
+                end=end
+            )
 
         reserve(day(1), day(4), 3)
         reserve(day(4), day(7), 1)
@@ -224,6 +301,125 @@ class VaryingDateAndSizeSearchTest(TestCase):
         )
 
 
+class FindPeriodManySubjectsTest(TestCase):
+    def setUp(self):
+        self.room1 = Room.objects.create(name='Room 1', size=1)
+        self.room2 = Room.objects.create(name='Room 2', size=2)
+        self.room3 = Room.objects.create(name='Room 3', size=1)
+        RoomReservation.objects.create(subject=self.room1, size=1, start=datetime(2001, 1, 1), end=datetime(2001, 1, 3))
+        RoomReservation.objects.create(subject=self.room2, size=2, start=datetime(2001, 1, 2), end=datetime(2001, 1, 4))
+        RoomReservation.objects.create(subject=self.room3, size=1, start=datetime(2001, 1, 1), end=datetime(2001, 1, 6))
+        self.data = {
+            'start': datetime(2001, 1, 1),
+            'end': datetime(2001, 1, 10),
+            'subjects': Room.objects.all(),
+            'required_duration': timedelta(2),
+            'required_size': 1,
+        }
+
+    def test_earliest_periods_first(self):
+        with self.assertNumQueries(2):  # subjects and reservations
+            results = FindPeriod(use_validators=False).search_many(**self.data)
+        self.assertEqual([
+            (self.room1, datetime(2001, 1, 3), datetime(2001, 1, 10)),
+            (self.room2, datetime(2001, 1, 4), datetime(2001, 1, 10)),
+            (self.room3, datetime(2001, 1, 6), datetime(2001, 1, 10)),
+        ], results)
+
+    def test_queries_with_validators(self):
+        with self.assertNumQueries(4):  # subjects, validators of subjects, universal validators and reservations
+            FindPeriod().search_many(**self.data)
+
+    def test_limit(self):
+        self.data['required_duration'] = timedelta(1)
+        self.assertEqual([
+            (self.room2, datetime(2001, 1, 1), datetime(2001, 1, 2)),
+            (self.room1, datetime(2001, 1, 3), datetime(2001, 1, 10)),
+        ], FindPeriod().search_many(limit=2, **self.data))
+
+    def test_same_as_single_subject_search(self):
+        self.data['required_size'] = 0
+        for subject in [self.room1, self.room2, self.room3]:
+            self.data['subjects'] = [subject]
+            single_data = dict(self.data, subject=subject)
+            del single_data['subjects']
+            self.assertEqual(
+                [(subject, start, end) for start, end in FindPeriod().search(**single_data)],
+                FindPeriod().search_many(**self.data))
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class ArrayTimelineTest(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room', size=3)
+
+        def day(day):
+            return datetime(2001, 1, day)
+
+        for start, end, size in [(1, 4, 3), (4, 7, 1), (6, 11, 1), (8, 15, 2), (8, 9, 1), (22, 29, 2)]:
+            RoomReservation.objects.create(subject=self.room, size=size, start=day(start), end=day(end))
+
+    def test_same_changes_as_timeline(self):
+        for start, end in [(datetime(2001, 1, 1), datetime(2001, 1, 31)), (datetime(2001, 1, 5), datetime(2001, 1, 9))]:
+            timeline = Timeline(start, end, self.room)
+            array_timeline = ArrayTimeline(start, end, self.room)
+            self.assertEqual(list(timeline), list(array_timeline))
+            self.assertEqual(timeline.max(), array_timeline.max())
+            self.assertEqual(timeline.usage(), array_timeline.usage())
+        self.assertEqual(2, array_timeline.usage_at(datetime(2001, 1, 6, 12)))
+
+    def test_find_period(self):
+        for required_size in range(5):
+            for required_duration in [timedelta(0), timedelta(1), timedelta(3), timedelta(8)]:
+                data = {
+                    'start': datetime(2000, 12, 30),
+                    'end': datetime(2001, 1, 31),
+                    'required_duration': required_duration,
+                    'required_size': required_size,
+                    'subject': self.room,
+                }
+                self.assertEqual(FindPeriod().search(**data), FindPeriod(timeline_class=ArrayTimeline).search(**data))
+
+
+class FindPeriodWithValidatorsTest(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room', size=1)
+        self.room.validators.add(NotWithinPeriodValidator.objects.create(
+            start=datetime(2001, 1, 5), end=datetime(2001, 1, 7)))
+        self.data = {
+            'start': datetime(2001, 1, 1, 6, 30),
+            'end': datetime(2001, 1, 10),
+            'required_duration': timedelta(2),
+            'subject': self.room,
+        }
+
+    def test_forbidden_periods_are_cut_out(self):
+        self.assertEqual([
+            (datetime(2001, 1, 1, 6, 30), datetime(2001, 1, 5) - timedelta.resolution),
+            (datetime(2001, 1, 7) + timedelta.resolution, datetime(2001, 1, 10)),
+        ], FindPeriod().search(**self.data))
+        self.assertEqual([(self.data['start'], self.data['end'])], FindPeriod(use_validators=False).search(**self.data))
+
+        self.room.validators.add(FullTimeValidator.objects.create(interval_type='hour', interval=0))
+        self.assertEqual([
+            (datetime(2001, 1, 2), datetime(2001, 1, 5) - timedelta.resolution),
+            (datetime(2001, 1, 7) + timedelta.resolution, datetime(2001, 1, 10)),
+        ], FindPeriod().search(**self.data))
+        del self.data['subject']
+        self.assertEqual([
+            (self.room, datetime(2001, 1, 2), datetime(2001, 1, 5) - timedelta.resolution),
+            (self.room, datetime(2001, 1, 7) + timedelta.resolution, datetime(2001, 1, 10)),
+        ], FindPeriod().search_many(subjects=[self.room], **self.data))
+
+    def test_found_periods_can_be_reserved(self):
+        for start, end in FindPeriod().search(**self.data):
+            self.room.reserve(start=start, end=end, size=1)
+
+    def test_whole_period_forbidden(self):
+        self.room.validators.add(MaxDurationValidator.objects.create(max_duration_in_seconds=3600))
+        self.assertEqual([], FindPeriod().search(**self.data))
+
+
 class FindPeriodTestWithApprovableReservations(TestCase):
     def setUp(self):
         self.hotel = Hotel.objects.create(name='Hotel')
@@ -381,3 +577,131 @@ class ClusterAvailabilityWithApprovableReservationsTest(TestCase):
 
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0].name, 'Hotel 1')
+
+
+class AggregateClustersSearchTest(TestCase):
+    def setUp(self):
+        self.hotels = [Hotel.objects.create(name='Hotel %s' % i) for i in range(3)]
+
+        def day(day):
+            return datetime(2001, 1, day)
+
+        for hotel, sizes_and_reservations in zip(self.hotels, [
+            [(5, [(1, 10, 2), (5, 15, 3)]), (5, [(3, 4, 5)])],
+            [(10, [(1, 31, 7), (10, 12, 1)]), (10, [(2, 5, 4), (4, 8, 4), (20, 30, 9)])],
+            [(3, [])],
+        ]):
+            for size, reservations in sizes_and_reservations:
+                room = HotelRoom.objects.create(name='Room', size=size, cluster=hotel)
+                for start, end, reserved_size in reservations:
+                    room.reserve(start=day(start), end=day(end), size=reserved_size)
+        HotelRoom.objects.create(name='Room', size=10, cluster=self.hotels[0]).reserve(
+            start=day(1), end=day(20), size=10, valid_until=datetime(1900, 1, 1))
+
+    def test_same_results_as_clusters_searcher(self):
+        for start, end in [(datetime(2001, 1, 1), datetime(2001, 1, 31)), (datetime(2001, 1, 4), datetime(2001, 1, 9))]:
+            for required_size in range(0, 22, 3):
+                expected = ClustersSearcher(HotelRoom, Hotel, 'rooms').search(start, end, required_size)
+                results = AggregateClustersSearcher(HotelRoom, Hotel, 'rooms').search(start, end, required_size)
+                self.assertEqual(sorted((h.pk, h.size) for h in expected), sorted((h.pk, h.size) for h in results))
+
+    def test_one_query(self):
+        searcher = AggregateClustersSearcher(HotelRoom, Hotel, 'rooms')
+        with self.assertNumQueries(1):
+            ids = searcher.search_ids(datetime(2001, 1, 1), datetime(2001, 1, 31), 4)
+        self.assertEqual([self.hotels[0].pk], ids)
+
+
+class UsageTreeTest(TestCase):
+    def test_peak_matches_brute_force(self):
+        def day(day):
+            return datetime(2001, 1, day)
+
+        reservations = [(1, 4, 3), (4, 7, 1), (6, 11, 1), (8, 15, 2), (22, 29, 2), (2, 3, 1), (10, 12, 4)]
+        tree = UsageTree()
+        for start, end, size in reservations:
+            tree.add(day(start), size)
+            tree.add(day(end), -size)
+
+        for start in range(1, 30):
+            for end in range(start + 1, 31):
+                expected = max(
+                    sum(size for (s, e, size) in reservations if s <= moment < e)
+                    for moment in range(start, end)
+                )
+                self.assertEqual(expected, tree.peak(day(start), day(end)), (start, end))
+
+        for start, end, size in reservations:
+            tree.add(day(start), -size)
+            tree.add(day(end), size)
+        self.assertEqual(None, tree.root)
+
+
+class AvailabilityIndexTest(TestCase):
+    def setUp(self):
+        self.room1 = Room.objects.create(name='Room 1', size=2)
+        self.room2 = Room.objects.create(name='Room 2', size=3)
+        self.room1.reserve(start=datetime(2001, 1, 1), end=datetime(2001, 1, 8), size=1)
+        self.room2.reserve(start=datetime(2001, 1, 5), end=datetime(2001, 1, 10), size=2)
+
+        self.index = AvailabilityIndex(Room)
+        self.index.load()
+        self.index.connect()
+
+    def tearDown(self):
+        self.index.disconnect()
+
+    def test_search_without_reservation_queries(self):
+        searcher = SubjectsSearcher(Room, index=self.index)
+        with self.assertNumQueries(2):  # subjects to check and final results
+            results = list(searcher.search(datetime(2001, 1, 6), datetime(2001, 1, 7), required_size=2))
+        self.assertEqual([], results)
+        results = searcher.search(datetime(2001, 1, 6), datetime(2001, 1, 7), required_size=1)
+        self.assertEqual([self.room1, self.room2], list(results))
+
+    def test_index_follows_reservations(self):
+        searcher = SubjectsSearcher(Room, index=self.index)
+        reservation = self.room2.reserve(start='2001-01-01', end='2001-01-03', size=3)
+        self.assertEqual([self.room1], list(searcher.search(datetime(2001, 1, 2), datetime(2001, 1, 4), size=1)))
+        reservation.delete()
+        self.assertEqual(2, len(searcher.search(datetime(2001, 1, 2), datetime(2001, 1, 4), size=1)))
+
+    def test_index_follows_bulk_reservations(self):
+        AtomicReserver.bulk_reserve((self.room1, {'start': '2001-01-02', 'end': '2001-01-03', 'size': 1}))
+        self.assertEqual(2, self.index.peak_usage(self.room1, datetime(2001, 1, 1), datetime(2001, 1, 4)))
+
+    def test_find_period(self):
+        data = {
+            'start': datetime(2001, 1, 1),
+            'end': datetime(2001, 1, 31),
+            'required_duration': timedelta(3),
+            'required_size': 2,
+            'subject': self.room2,
+        }
+        expected = FindPeriod().search(**data)
+        with self.assertNumQueries(0):
+            self.assertEqual(expected, FindPeriod(index=self.index, use_validators=False).search(**data))
+        self.assertEqual([(datetime(2001, 1, 1), datetime(2001, 1, 5)), (datetime(2001, 1, 10), datetime(2001, 1, 31))],
+                         expected)
+
+
+class AvailabilityIndexRollbackTest(TransactionTestCase):
+    def setUp(self):
+        self.room1 = Room.objects.create(name='Room 1', size=2)
+        self.room2 = Room.objects.create(name='Room 2', size=1)
+        self.index = AvailabilityIndex(Room)
+        self.index.load()
+        self.index.connect()
+
+    def tearDown(self):
+        self.index.disconnect()
+
+    def test_rolled_back_reservations_are_forgotten(self):
+        with self.assertRaises(SizeExceeded):
+            AtomicReserver.reserve(
+                (self.room1, {'start': '2001-01-01', 'end': '2001-01-03', 'size': 2}),
+                (self.room2, {'start': '2001-01-01', 'end': '2001-01-03', 'size': 2}),
+            )
+        self.assertEqual(0, self.room1.reservations.count())
+        searcher = SubjectsSearcher(Room, index=self.index)
+        self.assertEqual([self.room1], list(searcher.search(datetime(2001, 1, 1), datetime(2001, 1, 2), size=2)))
@@ -40,6 +40,16 @@ class ReservationSearchTest(TestCase):
         length = len(results)
         self.assertEqual(length, 2, 'There should be 2 results returned')
 
+    def test_stream(self):
+        search = SingleSubjectReservationSearch(subject=self.room1)
+        with self.assertNumQueries(2):  # two chunks, second one is not full
+            results = list(search.stream('2001-01-05', '2001-02-15', chunk_size=2))
+        self.assertEqual([
+            (self.room1.pk, datetime(2001, 1, 1), datetime(2001, 1, 15), 5),
+            (self.room1.pk, datetime(2001, 1, 10), datetime(2001, 1, 25), 5),
+            (self.room1.pk, datetime(2001, 2, 12), datetime(2001, 2, 20), 5),
+        ], results)
+
     def test_search_in_one_cluster(self):
         search = SingleSubjectManagerReservationSearch(subject_manager=self.hotel1.rooms,
                                                        reservation_model=HotelRoomReservation)
@@ -1,9 +1,15 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from StringIO import StringIO
 from mock import patch
 from threading import Thread
 from time import sleep
 
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
 from django.test import TransactionTestCase, TestCase
+from django.test.utils import override_settings
+from django.db import connection
+from django.db.utils import DatabaseError
 
 from kitabu.tests.models import (
     TennisCourt,
@@ -16,15 +22,44 @@ from kitabu.tests.models import (
     ConferenceRoom,
     ConferenceRoomReservation,
     RoomWithApprovableReservations,
-    ApprovableRoomReservation
+    ApprovableRoomReservation,
+    ExpiredRoomReservation,
+    BoundedRoom,
+    BoundedRoomReservation,
+    CourtReservation,
+    Hotel,
+    TrackedRoom,
+    OptimisticRoom,
+    BucketRoom,
+    SlotRoom,
+    SlotRoomCountersChunk,
+    Table,
+    TableReservation,
+    FullTimeValidator,
+    MaxReservationsPerUserValidator,
 )
 from kitabu.exceptions import (
     SizeExceeded,
     ReservationError,
     OverlappingReservations,
     OutdatedReservationError,
+    ConcurrentReservationError,
+    TooLong,
+    TooManyReservationsOnSubjectForUser,
 )
-from kitabu.utils import AtomicReserver
+from kitabu.utils import AtomicReserver, ReservationSpan, load_spans, overlap_memo
+from kitabu.models.occupancy import OccupancySegmentsSubjectMixin
+from kitabu.models.slots import SlotCountersSubjectMixin, _unpack
+from kitabu.models.subjects import BaseSubject, SubjectWithApprovableReservations
+from kitabu.models.validators import validator_registry
+from kitabu.search.available import Subjects as SubjectsSearcher, Clusters as ClustersSearcher, FindPeriod
+from kitabu.engines import PythonPeakUsage, DatabasePeakUsage
+from kitabu.transactions import RetryPolicy
+from kitabu.expiry import sweep_expired_reservations
+from kitabu.indexes import fill_effective_until, overlap_index_columns, overlap_index_sql
+from kitabu.management.commands.kitabu_benchmark_attributes import former_model
+import kitabu.expiry
+from kitabu.signals import reservations_changed, transaction_retried
 
 
 class TennisCourtTest(TestCase):
@@ -97,6 +132,419 @@ class BusTest(TestCase):
             self.bus.reserve(start='2012-04-15', end='2012-05-13', size=3)
 
 
+class EnsureSizeTest(TestCase):
+    def test_default_size(self):
+        self.assertEqual(1, CourtReservation().size)
+        self.assertEqual(1, TennisCourt().size)
+        self.assertEqual(3, RoomReservation(size=3).size)
+        self.assertEqual(5, FiveSeatsBus().size)
+        with self.assertRaises(AttributeError):
+            CourtReservation().no_such_attribute
+
+    def test_former_implementation_for_benchmark(self):
+        self.assertEqual(1, former_model(CourtReservation)().size)
+        self.assertEqual(3, former_model(RoomReservation)(size=3).size)
+
+    def test_benchmark_command(self):
+        court = TennisCourt.objects.create(name="court")
+        court.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 2))
+        out = StringIO()
+        call_command('kitabu_benchmark_attributes', 'tests.CourtReservation', number=2, stdout=out)
+        self.assertIn('2 times 1 reservations', out.getvalue())
+
+
+class LoadSpansTest(TestCase):
+    def test_spans(self):
+        room = Room.objects.create(name="room", size=10)
+        court = TennisCourt.objects.create(name="court")
+        RoomReservation.objects.create(subject=room, start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=3)
+        CourtReservation.objects.create(subject=court, start=datetime(2012, 4, 1), end=datetime(2012, 4, 5))
+
+        spans = list(load_spans(RoomReservation.objects.all())) + list(load_spans(CourtReservation.objects.all()))
+        self.assertEqual([
+            ReservationSpan(room.pk, datetime(2012, 4, 1), datetime(2012, 4, 5), 3),
+            ReservationSpan(court.pk, datetime(2012, 4, 1), datetime(2012, 4, 5), 1),
+        ], spans)
+        self.assertEqual(3, spans[0].size)
+        self.assertEqual(spans[0], ReservationSpan.from_reservation(RoomReservation.objects.get()))
+
+
+class PeakUsageEnginesTest(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room", size=10)
+        self.approvable_room = RoomWithApprovableReservations.objects.create(size=10)
+        self.court = TennisCourt.objects.create(name="court")
+
+        for start, end, size in [
+            (datetime(2012, 4, 1), datetime(2012, 4, 5), 3),
+            (datetime(2012, 4, 3), datetime(2012, 4, 8), 2),
+            (datetime(2012, 4, 5), datetime(2012, 4, 9), 4),  # starts when the first ends
+            (datetime(2012, 4, 6), datetime(2012, 4, 7), 1),
+        ]:
+            RoomReservation.objects.create(subject=self.room, start=start, end=end, size=size)
+
+        self.approvable_room.reserve(start='2012-04-01', end='2012-04-05', size=3, valid_until=datetime(1900, 1, 1))
+        self.approvable_room.reserve(start='2012-04-02', end='2012-04-05', size=2, approved=True)
+
+        CourtReservation.objects.create(subject=self.court, start=datetime(2012, 4, 1), end=datetime(2012, 4, 2))
+
+    def assertPeakUsage(self, expected, subject, start, end):
+        for engine in [PythonPeakUsage, DatabasePeakUsage]:
+            self.assertEqual(expected, engine.peak_usage(subject, start, end), engine.__name__)
+
+    def test_peak_usage(self):
+        self.assertPeakUsage(7, self.room, datetime(2012, 4, 1), datetime(2012, 4, 10))
+        self.assertPeakUsage(5, self.room, datetime(2012, 4, 1), datetime(2012, 4, 5))
+        self.assertPeakUsage(4, self.room, datetime(2012, 4, 8, 12), datetime(2012, 4, 10))
+        self.assertPeakUsage(0, self.room, datetime(2012, 4, 9), datetime(2012, 4, 10))
+
+    def test_outdated_reservations_are_ignored(self):
+        self.assertPeakUsage(2, self.approvable_room, datetime(2012, 4, 1), datetime(2012, 4, 10))
+
+    def test_reservations_without_size(self):
+        self.assertPeakUsage(1, self.court, datetime(2012, 4, 1), datetime(2012, 4, 10))
+
+    def test_reserve_with_database_engine(self):
+        self.room.peak_usage_engine = DatabasePeakUsage
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 10), size=3)
+        with self.assertRaises(SizeExceeded):
+            self.room.reserve(start=datetime(2012, 4, 6), end=datetime(2012, 4, 10), size=1)
+
+
+class OccupancySegmentsTest(TestCase):
+    def setUp(self):
+        self.hotel = Hotel.objects.create(name='Hotel')
+        self.room = TrackedRoom.objects.create(size=5, cluster=self.hotel)
+        self.other_room = TrackedRoom.objects.create(size=5, cluster=self.hotel)
+
+    def segments(self, room=None):
+        return [(s.start, s.end, s.size) for s in (room or self.room).occupancy_segments.order_by('start')]
+
+    def test_segments_follow_reservations(self):
+        first = self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=2)
+        self.room.reserve(start='2012-04-03', end='2012-04-08', size=3)
+        self.assertEqual([
+            (datetime(2012, 4, 1), datetime(2012, 4, 3), 2),
+            (datetime(2012, 4, 3), datetime(2012, 4, 5), 5),
+            (datetime(2012, 4, 5), datetime(2012, 4, 8), 3),
+        ], self.segments())
+
+        first.end = datetime(2012, 4, 2)
+        first.save()
+        self.assertEqual([
+            (datetime(2012, 4, 1), datetime(2012, 4, 2), 2),
+            (datetime(2012, 4, 3), datetime(2012, 4, 8), 3),
+        ], self.segments())
+
+        first.delete()
+        self.assertEqual([(datetime(2012, 4, 3), datetime(2012, 4, 8), 3)], self.segments())
+        self.assertEqual([], self.segments(self.other_room))
+
+    def test_update_locks_subject(self):
+        with patch('django.db.models.query.QuerySet.select_for_update', autospec=True) as select_for_update:
+            select_for_update.side_effect = lambda queryset: queryset
+            self.room.update_occupancy(datetime(2012, 4, 1), datetime(2012, 4, 5))
+        self.assertEqual([TrackedRoom], [call[0][0].model for call in select_for_update.call_args_list])
+
+    def test_approvable_reservations_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            class ApprovableTrackedRoom(OccupancySegmentsSubjectMixin, SubjectWithApprovableReservations, BaseSubject):
+                class Meta:
+                    app_label = 'tests'
+
+    def test_capacity_check_uses_segments(self):
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=4)
+        with self.assertRaises(SizeExceeded):
+            self.room.reserve(start=datetime(2012, 4, 4), end=datetime(2012, 4, 6), size=2)
+        self.room.reserve(start=datetime(2012, 4, 5), end=datetime(2012, 4, 6), size=5)
+
+    def test_search(self):
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=4)
+        self.other_room.reserve(start=datetime(2012, 4, 3), end=datetime(2012, 4, 8), size=1)
+
+        results = SubjectsSearcher(TrackedRoom).search(datetime(2012, 4, 4), datetime(2012, 4, 6), required_size=2)
+        self.assertEqual([self.other_room], list(results))
+
+        results = ClustersSearcher(TrackedRoom, Hotel, 'tracked_rooms').search(
+            datetime(2012, 4, 4), datetime(2012, 4, 6), required_size=5)
+        self.assertEqual([self.hotel], list(results))
+        results = ClustersSearcher(TrackedRoom, Hotel, 'tracked_rooms').search(
+            datetime(2012, 4, 4), datetime(2012, 4, 6), required_size=6)
+        self.assertEqual([], list(results))
+
+
+class OptimisticLockingTest(TransactionTestCase):
+    def setUp(self):
+        self.room = OptimisticRoom.objects.create(size=3)
+
+    def test_reservations_bump_version(self):
+        stale_room = OptimisticRoom.objects.get(pk=self.room.pk)
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=2)
+        stale_room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=1)
+        self.assertEqual(2, OptimisticRoom.objects.get(pk=self.room.pk).reservations_version)
+        with self.assertRaises(SizeExceeded):
+            stale_room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=1)
+
+    def test_no_subject_lock(self):
+        with patch('django.db.models.query.QuerySet.select_for_update') as select_for_update:
+            self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=2)
+        self.assertFalse(select_for_update.called)
+
+    def test_concurrent_reservation_retried(self):
+        stale_room = OptimisticRoom.objects.get(pk=self.room.pk)
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=2)
+
+        # version read just before the other reservation was saved
+        reads = []
+        original_read = OptimisticRoom._read_reservations_version
+
+        def read_version(room):
+            reads.append(room)
+            if len(reads) > 1:
+                original_read(room)
+
+        with patch.object(OptimisticRoom, '_read_reservations_version', read_version):
+            stale_room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=1)
+        self.assertEqual(2, len(reads))
+        self.assertEqual(2, self.room.reservations.count())
+
+    def test_give_up_after_attempts(self):
+        stale_room = OptimisticRoom.objects.get(pk=self.room.pk)
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=1)
+        with patch.object(OptimisticRoom, '_read_reservations_version', lambda room: None):
+            with self.assertRaises(ConcurrentReservationError):
+                stale_room.reserve(start=datetime(2012, 4, 6), end=datetime(2012, 4, 7), size=1)
+        self.assertEqual(1, self.room.reservations.count())
+
+    def test_atomic_reserver(self):
+        stale_room = OptimisticRoom.objects.get(pk=self.room.pk)
+        AtomicReserver.reserve((self.room, {'start': '2012-04-01', 'end': '2012-04-05', 'size': 1}))
+        with self.assertRaises(ConcurrentReservationError):
+            AtomicReserver.bulk_reserve((stale_room, {'start': '2012-04-01', 'end': '2012-04-05', 'size': 1}))
+        self.assertEqual(1, self.room.reservations.count())
+
+
+class BucketLockingTest(TransactionTestCase):
+    def setUp(self):
+        self.room = BucketRoom.objects.create(size=3)
+
+    def test_buckets(self):
+        self.assertEqual(
+            [datetime(2012, 4, 1, 6), datetime(2012, 4, 1, 12)],
+            self.room.get_buckets(datetime(2012, 4, 1, 10), datetime(2012, 4, 1, 13)))
+        self.assertEqual([datetime(2012, 4, 1, 6)], self.room.get_buckets(datetime(2012, 4, 1, 6), '2012-04-01 12:00'))
+
+    def test_reserve_locks_buckets_not_subject(self):
+        with patch('django.db.models.query.QuerySet.select_for_update', autospec=True) as select_for_update:
+            select_for_update.side_effect = lambda queryset: queryset
+            self.room.reserve(start=datetime(2012, 4, 1, 10), end=datetime(2012, 4, 1, 13), size=2)
+            AtomicReserver.reserve((self.room, {'start': '2012-04-01 11:00', 'end': '2012-04-01 19:00', 'size': 1}))
+        self.assertEqual(
+            [BucketRoom.get_reservation_lock_model()] * 2,
+            [call[0][0].model for call in select_for_update.call_args_list])
+        self.assertEqual(
+            [datetime(2012, 4, 1, 6), datetime(2012, 4, 1, 12), datetime(2012, 4, 1, 18)],
+            list(self.room.reservation_locks.order_by('bucket').values_list('bucket', flat=True)))
+        with self.assertRaises(SizeExceeded):
+            self.room.reserve(start=datetime(2012, 4, 1, 12), end=datetime(2012, 4, 1, 14), size=1)
+
+
+class RetryPolicyTest(TransactionTestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="room", size=5)
+        self.policy = RetryPolicy(attempts=3)
+
+    def failing(self, errors):
+        def reserve_without_transaction(**kwargs):
+            if errors:
+                raise errors.pop(0)
+            return Room.reserve_without_transaction(self.room, **kwargs)
+        return reserve_without_transaction
+
+    def test_retryable_errors(self):
+        self.assertTrue(self.policy.is_retryable(DatabaseError('could not serialize access due to concurrent update')))
+        self.assertTrue(self.policy.is_retryable(DatabaseError(1213, 'Deadlock found when trying to get lock')))
+        self.assertFalse(self.policy.is_retryable(DatabaseError('no such table')))
+        self.assertFalse(self.policy.is_retryable(SizeExceeded(self.room, 6, None, None)))
+
+    @patch('kitabu.transactions.sleep')
+    def test_retry(self, sleep):
+        retries = []
+        transaction_retried.connect(lambda sender, attempt, **kwargs: retries.append(attempt), weak=False,
+                                    dispatch_uid='test_retry')
+        errors = [DatabaseError('deadlock detected'), DatabaseError('deadlock detected')]
+        try:
+            with patch.object(self.room, 'reserve_without_transaction', self.failing(errors)):
+                self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=2,
+                                  retry_policy=self.policy)
+        finally:
+            transaction_retried.disconnect(dispatch_uid='test_retry')
+        self.assertEqual(1, self.room.reservations.count())
+        self.assertEqual(2, self.policy.retries)
+        self.assertEqual([1, 2], retries)
+        self.assertEqual(2, sleep.call_count)
+
+    @patch('kitabu.transactions.sleep')
+    def test_give_up(self, sleep):
+        errors = [DatabaseError('deadlock detected')] * 3
+        with patch.object(self.room, 'reserve_without_transaction', self.failing(errors)):
+            with self.assertRaises(DatabaseError):
+                self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=2,
+                                  retry_policy=self.policy)
+        errors = [DatabaseError('no such table')]
+        with patch.object(self.room, 'reserve_without_transaction', self.failing(errors)):
+            with self.assertRaises(DatabaseError):
+                self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 5), size=2,
+                                  retry_policy=self.policy)
+        self.assertEqual(2, self.policy.retries)
+        self.assertEqual(1, self.policy.failures)
+        self.assertEqual(0, self.room.reservations.count())
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=0.1, max_backoff=0.3, jitter=0.5)
+        self.assertTrue(0.05 <= policy.get_delay(1) <= 0.15)
+        self.assertTrue(0.15 <= policy.get_delay(5) <= 0.45)
+
+
+class OverlapMemoTest(TestCase):
+    def setUp(self):
+        self.room = ConferenceRoom.objects.create(size=5)
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 3), size=2)
+
+    def test_reservation_queries_overlapping_reservations_once(self):
+        with patch.object(ConferenceRoom, 'overlapping_reservations', autospec=True,
+                          side_effect=ConferenceRoom.overlapping_reservations) as overlapping_reservations:
+            self.room.reserve(start=datetime(2012, 4, 3), end=datetime(2012, 4, 5), exclusive=True)
+            with self.assertRaises(SizeExceeded):
+                self.room.reserve(start='2012-04-02', end='2012-04-04', size=1)
+        # once for each reservation, and to report overlapping reservations
+        self.assertEqual(3, overlapping_reservations.call_count)
+
+    def test_memo_invalidated_on_write(self):
+        with overlap_memo:
+            self.assertEqual(1, len(self.room.overlapping_spans(datetime(2012, 4, 1), datetime(2012, 4, 9))))
+            self.room.reserve(start=datetime(2012, 4, 5), end=datetime(2012, 4, 6), size=1)
+            self.assertEqual(2, len(self.room.overlapping_spans(datetime(2012, 4, 1), datetime(2012, 4, 9))))
+            with self.assertNumQueries(0):
+                self.room.overlapping_spans(datetime(2012, 4, 1), '2012-04-09')
+        self.assertEqual({}, overlap_memo.spans)
+
+    def test_memo_invalidated_on_rollback(self):
+        def load_and_fail():
+            self.room.overlapping_spans(datetime(2012, 4, 1), datetime(2012, 4, 9))
+            raise ValueError
+
+        with overlap_memo:
+            with self.assertRaises(ValueError):
+                RetryPolicy().run(load_and_fail)
+            self.assertEqual({}, overlap_memo.spans)
+
+    def test_memo_invalidated_on_lock(self):
+        with overlap_memo:
+            self.room.overlapping_spans(datetime(2012, 4, 1), datetime(2012, 4, 9))
+            self.assertEqual([self.room], overlap_memo.select_for_update(ConferenceRoom.objects.all()))
+            self.assertEqual({}, overlap_memo.spans)
+
+
+class SlotCountersTest(TestCase):
+    def setUp(self):
+        self.room = SlotRoom.objects.create(size=5)
+        self.room.validators.add(FullTimeValidator.objects.create(interval_type='minute', interval=0))
+
+    def counters(self, start, end):
+        return list(SlotRoom.objects.get(pk=self.room.pk).get_slot_counters(start, end)[1])
+
+    def test_slot_length(self):
+        self.assertEqual(timedelta(hours=1), self.room.get_slot_length())
+        self.assertEqual(timedelta(minutes=15),
+                         FullTimeValidator(interval_type='minute', interval=15).get_slot_length())
+        self.assertEqual(timedelta(minutes=1), FullTimeValidator(interval_type='minute', interval=7).get_slot_length())
+        self.assertEqual(timedelta(days=1), FullTimeValidator(interval_type='hour', interval=0).get_slot_length())
+        self.assertEqual(None, SlotRoom.objects.create(size=1).get_slot_length())
+
+    def test_counters_follow_reservations(self):
+        first = self.room.reserve(start=datetime(2112, 4, 1, 10), end=datetime(2112, 4, 1, 13), size=2)
+        second = self.room.reserve(start=datetime(2112, 4, 1, 8), end=datetime(2112, 4, 1, 11), size=3)
+        self.assertEqual([3, 3, 5, 2, 2], self.counters(datetime(2112, 4, 1, 8), datetime(2112, 4, 1, 13)))
+
+        first.delete()
+        self.assertEqual([0, 3, 3, 3, 0, 0], self.counters(datetime(2112, 4, 1, 7), datetime(2112, 4, 1, 12, 30)))
+
+        second.delete()
+        self.assertEqual(0, SlotRoomCountersChunk.objects.count())
+
+    def test_counters_kept_in_chunks(self):
+        self.room.reserve(start=datetime(2112, 4, 1, 22), end=datetime(2112, 4, 3, 2), size=1)
+        chunks = SlotRoomCountersChunk.objects.filter(subject=self.room).order_by('start')
+        self.assertEqual([datetime(2112, 4, 1), datetime(2112, 4, 2), datetime(2112, 4, 3)],
+                         [chunk.start for chunk in chunks])
+        self.assertEqual([0] * 22 + [1] * 2, list(_unpack(chunks[0].counters)))
+        self.assertEqual([1] * 24, list(_unpack(chunks[1].counters)))
+        self.assertEqual([1] * 2 + [0] * 22, list(_unpack(chunks[2].counters)))
+
+    def test_past_chunks_dropped(self):
+        self.room.reserve(start=datetime(2112, 4, 1, 8), end=datetime(2112, 4, 1, 11), size=3)
+        with patch('kitabu.models.slots.now', lambda: datetime(2112, 4, 2, 10, 30)):
+            self.room.reserve(start=datetime(2112, 4, 2, 8), end=datetime(2112, 4, 2, 9), size=5)
+            self.assertEqual([datetime(2112, 4, 2)], [chunk.start for chunk in SlotRoomCountersChunk.objects.all()])
+
+            # past slots of the current chunk are still counted
+            with self.assertRaises(SizeExceeded):
+                self.room.reserve(start=datetime(2112, 4, 2, 8), end=datetime(2112, 4, 2, 9), size=1)
+
+            # past chunks are checked against reservations
+            with self.assertRaises(SizeExceeded):
+                self.room.reserve(start=datetime(2112, 4, 1, 8), end=datetime(2112, 4, 1, 9), size=3)
+            searcher = SubjectsSearcher(SlotRoom)
+            self.assertEqual([], list(searcher.search(datetime(2112, 4, 1, 8), datetime(2112, 4, 1, 9), size=3)))
+
+    def test_counters_above_16_bits(self):
+        room = SlotRoom.objects.create(size=100000)
+        room.validators.add(FullTimeValidator.objects.create(interval_type='minute', interval=0))
+        room.reserve(start=datetime(2112, 4, 1, 10), end=datetime(2112, 4, 1, 11), size=70000)
+        self.assertEqual([70000], list(room.get_slot_counters(datetime(2112, 4, 1, 10), datetime(2112, 4, 1, 11))[1]))
+
+    def test_approvable_reservations_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            class ApprovableSlotRoom(SlotCountersSubjectMixin, SubjectWithApprovableReservations, BaseSubject):
+                class Meta:
+                    app_label = 'tests'
+
+    def test_capacity_check_and_search(self):
+        self.room.reserve(start=datetime(2112, 4, 1, 10), end=datetime(2112, 4, 1, 13), size=4)
+        with self.assertRaises(SizeExceeded):
+            self.room.reserve(start=datetime(2112, 4, 1, 12), end=datetime(2112, 4, 1, 14), size=2)
+        self.room.reserve(start=datetime(2112, 4, 1, 13), end=datetime(2112, 4, 1, 14), size=5)
+
+        searcher = SubjectsSearcher(SlotRoom)
+        self.assertEqual([], list(searcher.search(datetime(2112, 4, 1, 12), datetime(2112, 4, 1, 15), size=1)))
+        self.assertEqual([self.room], list(searcher.search(datetime(2112, 4, 1, 14), datetime(2112, 4, 1, 15), size=5)))
+
+    def test_update_locks_subject(self):
+        with patch('django.db.models.query.QuerySet.select_for_update', autospec=True) as select_for_update:
+            select_for_update.side_effect = lambda queryset: queryset
+            self.room.update_slot_counters(datetime(2112, 4, 1, 10), datetime(2112, 4, 1, 13))
+        self.assertEqual([SlotRoom], [call[0][0].model for call in select_for_update.call_args_list])
+
+    @override_settings(KITABU_VALIDATORS_CACHE_TIMEOUT=60)
+    def test_find_period(self):
+        self.room.get_slot_length()  # warm validators cache
+        self.room.reserve(start=datetime(2112, 4, 1, 10), end=datetime(2112, 4, 1, 13), size=4)
+        self.room.reserve(start=datetime(2112, 4, 1, 12), end=datetime(2112, 4, 1, 14), size=1)
+        self.room.reserve(start=datetime(2112, 4, 1, 16), end=datetime(2112, 4, 1, 17), size=5)
+        for required_size in range(1, 6):
+            data = {
+                'start': datetime(2112, 4, 1, 9, 30),
+                'end': datetime(2112, 4, 1, 20),
+                'required_duration': timedelta(hours=1),
+                'required_size': required_size,
+                'subject': self.room,
+            }
+            with self.assertNumQueries(1):  # slot counters
+                results = FindPeriod().search(**data)
+            self.assertEqual(FindPeriod().search(reservations=list(self.room.reservations.all()), **data), results)
+
+
 class AtomicReserveTest(TransactionTestCase):
     def setUp(self):
         self.room5 = Room.objects.create(name="room", size=5)
@@ -127,6 +575,83 @@ class AtomicReserveTest(TransactionTestCase):
                          'There should be no reservation objects added to the database')
 
 
+class BulkReserveTest(TransactionTestCase):
+    def setUp(self):
+        self.room5 = Room.objects.create(name="room", size=5)
+        self.room3 = Room.objects.create(name="room", size=3)
+
+    @override_settings(KITABU_VALIDATORS_CACHE_TIMEOUT=60)
+    def test_bulk_reservation(self):
+        self.room5.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 3), size=2)
+        validator_registry.get_validators_for_subjects([self.room5, self.room3])
+        # lock of subjects, overlapping reservations of both subjects and one insert
+        with self.assertNumQueries(4):
+            reservations = AtomicReserver.non_transactional_bulk_reserve(
+                (self.room5, {'start': '2012-04-01', 'end': '2012-04-02', 'size': 3}),
+                (self.room5, {'start': '2012-04-02', 'end': '2012-04-03', 'size': 3}),
+                (self.room3, {'start': '2012-04-01', 'end': '2012-04-03', 'size': 3}),
+            )
+        self.assertEqual([3, 3, 3], [r.size for r in reservations])
+        self.assertEqual(3, self.room5.reservations.count())
+        self.assertEqual(1, self.room3.reservations.count())
+
+    def test_bulk_reservation_checks_reservations_against_each_other(self):
+        with self.assertRaises(SizeExceeded):
+            AtomicReserver.bulk_reserve(
+                (self.room5, {'start': '2012-04-01', 'end': '2012-04-03', 'size': 3}),
+                (self.room3, {'start': '2012-04-01', 'end': '2012-04-03', 'size': 1}),
+                (self.room5, {'start': '2012-04-02', 'end': '2012-04-04', 'size': 3}),
+            )
+        self.assertEqual(0, RoomReservation.objects.count())
+
+    def test_bulk_reservation_checks_existing_reservations(self):
+        self.room3.reserve(start=datetime(2012, 4, 2), end=datetime(2012, 4, 3), size=1)
+        with self.assertRaises(SizeExceeded):
+            AtomicReserver.bulk_reserve(
+                (self.room3, {'start': '2012-04-01', 'end': '2012-04-02', 'size': 3}),
+                (self.room3, {'start': '2012-04-02', 'end': '2012-04-04', 'size': 3}),
+            )
+        self.assertEqual(1, RoomReservation.objects.count())
+
+    def test_validators_see_other_reservations_of_the_batch(self):
+        table = Table.objects.create()
+        table.validators.add(MaxReservationsPerUserValidator.objects.create(max_reservations_on_current_subject=1))
+        with self.assertRaises(TooManyReservationsOnSubjectForUser):
+            AtomicReserver.bulk_reserve(
+                (table, {'start': datetime(2100, 4, 1), 'end': datetime(2100, 4, 2), 'owner': 'owner'}),
+                (table, {'start': datetime(2100, 4, 3), 'end': datetime(2100, 4, 4), 'owner': 'owner'}),
+            )
+        self.assertEqual(0, TableReservation.objects.count())
+
+    @patch('kitabu.utils.sleep')
+    def test_delay_between_reservations(self, sleep):
+        AtomicReserver.bulk_reserve(
+            (self.room5, {'start': '2012-04-01', 'end': '2012-04-02', 'size': 1}),
+            (self.room5, {'start': '2012-04-02', 'end': '2012-04-03', 'size': 1}),
+            delay_between_reservations=0.5,
+        )
+        sleep.assert_called_once_with(1.0)
+
+    def test_bulk_reservation_updates_occupancy(self):
+        room = TrackedRoom.objects.create(size=5, cluster=Hotel.objects.create(name='Hotel'))
+        AtomicReserver.bulk_reserve(
+            (room, {'start': datetime(2012, 4, 1), 'end': datetime(2012, 4, 3), 'size': 2}),
+            (room, {'start': datetime(2012, 4, 2), 'end': datetime(2012, 4, 4), 'size': 3}),
+        )
+        self.assertEqual([
+            (datetime(2012, 4, 1), datetime(2012, 4, 2), 2),
+            (datetime(2012, 4, 2), datetime(2012, 4, 3), 5),
+            (datetime(2012, 4, 3), datetime(2012, 4, 4), 3),
+        ], [(s.start, s.end, s.size) for s in room.occupancy_segments.order_by('start')])
+
+    def test_group_bulk_reservation(self):
+        group = TestReservationGroup.bulk_reserve(
+            (self.room5, {'start': '2012-04-01', 'end': '2012-05-12', 'size': 3}),
+            (self.room3, {'start': '2012-04-01', 'end': '2012-05-12', 'size': 2}),
+        )
+        self.assertEqual(2, group.reservations.count())
+
+
 class GroupReservationTest(TransactionTestCase):
     def setUp(self):
         self.room5 = Room.objects.create(name="room", size=5)
@@ -220,6 +745,257 @@ class ExclusiveReservationTest(TestCase):
             self.room5.reserve(start='2012-04-01', end='2012-04-02', exclusive=True, size=0)
 
 
+class ExclusiveReservationsResizeTest(TestCase):
+    def setUp(self):
+        self.room = ConferenceRoom.objects.create(size=5)
+        self.other_room = ConferenceRoom.objects.create(size=5)
+        for room in [self.room, self.other_room]:
+            for day in [1, 3, 5]:
+                room.reserve(start=datetime(2100, 1, day), end=datetime(2100, 1, day + 1), exclusive=True)
+        self.room.reserve(start=datetime(2100, 1, 2), end=datetime(2100, 1, 3), size=2)
+        self.room.reserve(start=datetime(2100, 1, 2, 12), end=datetime(2100, 1, 3), size=2)
+
+    def stored_sizes(self, room):
+        return list(room.reservations.filter(exclusive=True).order_by('pk').values_list('size', flat=True))
+
+    def test_only_reservations_of_resized_subject_are_updated(self):
+        self.room.resize_chunk_size = 2
+        self.room.size = 7
+        self.room.save()
+        self.assertEqual([7, 7, 7], self.stored_sizes(self.room))
+        self.assertEqual([5, 5, 5], self.stored_sizes(self.other_room))
+
+    def test_resizing_locks_subject(self):
+        self.room.size = 6
+        with patch('django.db.models.query.QuerySet.select_for_update', autospec=True) as select_for_update:
+            select_for_update.side_effect = lambda queryset: queryset
+            self.room.save()
+        # for the save and for the only chunk of reservations
+        self.assertEqual([ConferenceRoom] * 2, [call[0][0].model for call in select_for_update.call_args_list])
+
+    def test_callers_transaction_is_used(self):
+        self.room.size = 6
+        with patch.object(RetryPolicy, 'run') as run:
+            self.room.save()
+        self.assertFalse(run.called)
+        self.assertEqual([6, 6, 6], self.stored_sizes(self.room))
+
+    def test_changed_period_starts_with_resized_reservations(self):
+        periods = []
+
+        def receiver(sender, subject, start, end, **kwargs):
+            periods.append((subject, start, end))
+
+        reservations_changed.connect(receiver)
+        try:
+            self.room.size = 6
+            self.room.save()
+        finally:
+            reservations_changed.disconnect(receiver)
+        self.assertEqual([(self.room, datetime(2100, 1, 1), datetime(2100, 1, 6))], periods)
+
+    def test_no_update_if_size_is_unchanged(self):
+        room = ConferenceRoom.objects.get(pk=self.room.pk)
+        with self.assertNumQueries(2):  # save only
+            room.save()
+
+    def test_shrinking_below_usage_is_refused(self):
+        self.room.size = 3
+        with self.assertRaises(SizeExceeded):
+            self.room.save()
+        self.assertEqual(5, ConferenceRoom.objects.get(pk=self.room.pk).size)
+        self.assertEqual([5, 5, 5], self.stored_sizes(self.room))
+
+        self.room.size = 4
+        self.room.save()
+        self.assertEqual([4, 4, 4], self.stored_sizes(self.room))
+
+
+class ExclusiveReservationsResizeTransactionsTest(TransactionTestCase):
+    def setUp(self):
+        self.room = ConferenceRoom.objects.create(size=5)
+        for day in [1, 3, 5]:
+            self.room.reserve(start=datetime(2100, 1, day), end=datetime(2100, 1, day + 1), exclusive=True)
+
+    def test_chunk_per_transaction(self):
+        policy = RetryPolicy()
+        self.room.resize_chunk_size = 2
+        self.room.size = 7
+        with patch.object(policy, 'run', wraps=policy.run) as run:
+            self.room.save(retry_policy=policy)
+        # the save and two chunks
+        self.assertEqual(3, run.call_count)
+        self.assertEqual([7, 7, 7], list(self.room.reservations.values_list('size', flat=True)))
+
+
+class ExclusiveSizeTest(TestCase):
+    def setUp(self):
+        self.rooms = [ConferenceRoom.objects.create(size=size) for size in [3, 4, 5]]
+        for room in self.rooms:
+            room.reserve(start='2012-04-01', end='2012-04-02', exclusive=True)
+        self.rooms[0].reserve(start='2012-04-03', end='2012-04-04', size=2)
+
+    def test_loading_reservations_doesnt_fetch_subjects(self):
+        with self.assertNumQueries(1):
+            reservations = list(ConferenceRoomReservation.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            self.assertEqual(3, reservations[0].size)
+        with self.assertNumQueries(0):
+            self.assertEqual(2, reservations[3].size)
+
+    def test_fill_exclusive_sizes(self):
+        self.rooms[2].size = 6
+        self.rooms[2].save()
+        reservations = ConferenceRoomReservation.objects.order_by('pk')
+        with self.assertNumQueries(2):
+            reservations = ConferenceRoomReservation.fill_exclusive_sizes(reservations)
+            self.assertEqual([3, 4, 6, 2], [r.size for r in reservations])
+
+
+class MaxReservationDurationTest(TestCase):
+    def setUp(self):
+        self.room = BoundedRoom.objects.create(size=2)
+
+    def test_longer_reservations_are_refused(self):
+        self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 3), size=1)
+        with self.assertRaises(TooLong):
+            self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 3, 1), size=1)
+
+    def test_stored_reservations_cannot_exceed_limit(self):
+        reservation = self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 2), size=2)
+        reservation.end = datetime(2012, 4, 10)
+        with self.assertRaises(TooLong):
+            reservation.save()
+        with self.assertRaises(TooLong):
+            BoundedRoomReservation.objects.create(
+                subject=self.room, start=datetime(2012, 4, 1), end=datetime(2012, 4, 10), size=2)
+        with self.assertRaises(ValidationError):
+            reservation.full_clean()
+
+        self.room.reserve(start=datetime(2012, 4, 8), end=datetime(2012, 4, 9), size=2)
+        with self.assertRaises(SizeExceeded):
+            self.room.reserve(start=datetime(2012, 4, 1, 12), end=datetime(2012, 4, 2, 12), size=1)
+
+    def test_overlap_query_is_bounded(self):
+        first = self.room.reserve(start=datetime(2012, 4, 1), end=datetime(2012, 4, 3), size=1)
+        second = self.room.reserve(start=datetime(2012, 4, 4), end=datetime(2012, 4, 5), size=1)
+        self.assertEqual(
+            {'start__lt': datetime(2012, 4, 5), 'end__gt': datetime(2012, 4, 2), 'start__gt': datetime(2012, 3, 31)},
+            BoundedRoomReservation.overlap_lookups(datetime(2012, 4, 2), datetime(2012, 4, 5)))
+        self.assertEqual(
+            [first, second],
+            list(self.room.overlapping_reservations(datetime(2012, 4, 2), datetime(2012, 4, 5)).order_by('start')))
+        self.assertEqual(
+            [first],
+            list(BoundedRoomReservation.colliding_reservations_in_subjects(
+                datetime(2012, 4, 2, 12), datetime(2012, 4, 3, 12), [self.room])))
+
+    def test_overlap_index(self):
+        self.assertEqual(['subject_id', 'start', 'end'], overlap_index_columns(BoundedRoomReservation))
+        self.assertEqual(['subject_id', 'start', 'end', 'effective_until'],
+                         overlap_index_columns(ApprovableRoomReservation))
+        connection.cursor().execute(overlap_index_sql(BoundedRoomReservation))
+
+
+class ExpirySweeperTest(TestCase):
+    def setUp(self):
+        self.room = RoomWithApprovableReservations.objects.create(size=3)
+        for day in range(1, 6):
+            self.room.reserve(start='2012-04-0%s' % day, end='2012-04-0%s' % (day + 1), size=1,
+                              valid_until=datetime(2000, 1, day))
+        self.pending = self.room.reserve(start='2012-04-01', end='2012-04-02', size=1,
+                                         valid_until=datetime(2100, 1, 1))
+        self.approved = self.room.reserve(start='2012-04-01', end='2012-04-02', size=1, approved=True)
+
+    def remaining(self):
+        return set(ApprovableRoomReservation.objects.with_invalid().values_list('pk', flat=True))
+
+    def marked(self):
+        return set(ApprovableRoomReservation.objects.with_invalid().filter(
+            effective_until=ApprovableRoomReservation.EXPIRED_UNTIL).values_list('pk', flat=True))
+
+    def test_expired_reservations_are_marked_in_chunks(self):
+        expired = self.remaining() - set([self.pending.pk, self.approved.pk])
+        with patch('kitabu.expiry._sweep_chunk', wraps=kitabu.expiry._sweep_chunk) as sweep_chunk:
+            self.assertEqual(5, sweep_expired_reservations(ApprovableRoomReservation, chunk_size=2))
+        self.assertEqual(3, sweep_chunk.call_count)
+        self.assertEqual(expired, self.marked())
+        self.assertEqual(expired | set([self.pending.pk, self.approved.pk]), self.remaining())
+
+        # marked reservations are not visited again
+        self.assertEqual(0, sweep_expired_reservations(ApprovableRoomReservation))
+
+    def test_expired_reservations_are_deleted_in_chunks(self):
+        sweep_expired_reservations(ApprovableRoomReservation, chunk_size=2)
+        with patch('kitabu.expiry._sweep_chunk', wraps=kitabu.expiry._sweep_chunk) as sweep_chunk:
+            self.assertEqual(5, sweep_expired_reservations(ApprovableRoomReservation, delete=True, chunk_size=2))
+        self.assertEqual(3, sweep_chunk.call_count)
+        self.assertEqual(set([self.pending.pk, self.approved.pk]), self.remaining())
+
+    def test_expired_reservations_are_archived(self):
+        sweep_expired_reservations(ApprovableRoomReservation, delete=True, archive_model=ExpiredRoomReservation)
+        self.assertEqual(set([self.pending.pk, self.approved.pk]), self.remaining())
+        self.assertEqual(
+            [(datetime(2012, 4, day), datetime(2012, 4, day + 1), datetime(2000, 1, day)) for day in range(1, 6)],
+            list(ExpiredRoomReservation.objects.filter(subject=self.room).order_by('start').values_list(
+                'start', 'end', 'valid_until')))
+
+    def test_archiving_requires_deletion(self):
+        with self.assertRaises(ValueError):
+            sweep_expired_reservations(ApprovableRoomReservation, archive_model=ExpiredRoomReservation)
+        self.assertEqual(set(), self.marked())
+
+    def test_management_command(self):
+        call_command('kitabu_sweep_expired_reservations', 'tests.ApprovableRoomReservation', chunk_size=3,
+                     stdout=StringIO())
+        self.assertEqual(7, len(self.remaining()))
+        self.assertEqual(5, len(self.marked()))
+
+        call_command('kitabu_sweep_expired_reservations', 'tests.ApprovableRoomReservation', delete=True,
+                     stdout=StringIO())
+        self.assertEqual(set([self.pending.pk, self.approved.pk]), self.remaining())
+
+
+class EffectiveUntilTest(TestCase):
+    def setUp(self):
+        self.room = RoomWithApprovableReservations.objects.create(size=3)
+
+    def effective_until(self, reservation):
+        return ApprovableRoomReservation.objects.with_invalid().get(pk=reservation.pk).effective_until
+
+    def test_effective_until_follows_approval(self):
+        reservation = self.room.reserve(start='2012-04-01', end='2012-04-02', size=1,
+                                        valid_until=datetime(2100, 1, 1))
+        self.assertEqual(datetime(2100, 1, 1), self.effective_until(reservation))
+        reservation.approve()
+        self.assertEqual(ApprovableRoomReservation.APPROVED_UNTIL, self.effective_until(reservation))
+
+    def test_bulk_reservations(self):
+        reservations = AtomicReserver.bulk_reserve(
+            (self.room, {'start': '2012-04-01', 'end': '2012-04-02', 'size': 1, 'valid_until': datetime(2100, 1, 1)}),
+            (self.room, {'start': '2012-04-01', 'end': '2012-04-02', 'size': 1, 'approved': True}),
+        )
+        self.assertEqual(
+            set([datetime(2100, 1, 1), ApprovableRoomReservation.APPROVED_UNTIL]),
+            set(ApprovableRoomReservation.objects.values_list('effective_until', flat=True)))
+        self.assertEqual(2, len(reservations))
+
+    def test_fill_effective_until(self):
+        pending = self.room.reserve(start='2012-04-01', end='2012-04-02', size=1, valid_until=datetime(2100, 1, 1))
+        approved = self.room.reserve(start='2012-04-01', end='2012-04-02', size=1, approved=True)
+        ApprovableRoomReservation.objects.with_invalid().update(effective_until=None)
+        fill_effective_until(ApprovableRoomReservation)
+        self.assertEqual(datetime(2100, 1, 1), self.effective_until(pending))
+        self.assertEqual(ApprovableRoomReservation.APPROVED_UNTIL, self.effective_until(approved))
+
+    def test_single_predicate_on_validity(self):
+        sql = str(self.room.overlapping_reservations(datetime(2012, 4, 1), datetime(2012, 4, 2)).query)
+        sql = sql.split('WHERE')[1]
+        self.assertNotIn('OR', sql)
+        self.assertNotIn('approved', sql)
+        self.assertIn('effective_until', sql)
+
+
 class ApprovableReservationTest(TestCase):
     def setUp(self):
         self.room1 = RoomWithApprovableReservations.objects.create(size=3)
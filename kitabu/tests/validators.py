@@ -3,6 +3,7 @@ from datetime import datetime, time
 from mock import Mock, patch
 
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from kitabu.exceptions import (
     ReservationError,
@@ -25,6 +26,12 @@ from kitabu.tests.models import (
     WithinDayPeriod,
     Table,
 )
+from kitabu.models.validators import (
+    validator_registry,
+    weekday_schedules,
+    WeekdaySchedule,
+    warm_static_validators,
+)
 
 
 def MockWithoutId():
@@ -92,6 +99,52 @@ class SubjectAndUniversalValidatorTest(TestCase):
                          'There should be no reservation objects added to the database')
 
 
+@override_settings(KITABU_VALIDATORS_CACHE_TIMEOUT=60)
+class ValidatorRegistryTest(TestCase):
+    def setUp(self):
+        validator_registry.invalidate()
+        self.room = Room.objects.create(name="room", size=200)
+        self.other_room = Room.objects.create(name="other room", size=200)
+        self.universal_validator = MaxDurationValidator.objects.create(
+            max_duration_in_seconds=3600, apply_to_all=True)
+        self.full_time_validator = FullTimeValidator.objects.create(interval_type='minute', interval=3)
+        self.room.validators.add(self.full_time_validator)
+
+    def tearDown(self):
+        validator_registry.invalidate()
+
+    def test_validators_are_resolved_to_subclasses(self):
+        validators = validator_registry.get_validators(self.room)
+        self.assertEqual([MaxDurationValidator, FullTimeValidator], [v.__class__ for v in validators])
+
+    def test_cached_validators_need_no_queries(self):
+        validator_registry.get_validators(self.room)
+        start = datetime(2000, 01, 01, 16, 06)
+        with self.assertNumQueries(0):
+            validators = validator_registry.get_validators(self.room)
+            for validator in validators:
+                validator.validate(Mock(id=None, start=start, end=start))
+
+    def test_bulk_load_for_many_subjects(self):
+        with self.assertNumQueries(4):  # universal, attached, 2 subclasses
+            validators = validator_registry.get_validators_for_subjects([self.room, self.other_room])
+        self.assertEqual(2, len(validators[self.room.pk]))
+        self.assertEqual([self.universal_validator.pk], [v.pk for v in validators[self.other_room.pk]])
+
+    def test_cache_is_invalidated_when_validators_change(self):
+        validator_registry.get_validators(self.other_room)
+        self.other_room.validators.add(self.full_time_validator)
+        self.assertEqual(2, len(validator_registry.get_validators(self.other_room)))
+
+        self.universal_validator.delete()
+        self.assertEqual(1, len(validator_registry.get_validators(self.other_room)))
+
+    def test_reservation_is_validated_with_cached_validators(self):
+        validator_registry.get_validators(self.room)
+        with self.assertRaises(InvalidPeriod):
+            self.room.reserve(start=datetime(2000, 01, 01, 16, 07), end=datetime(2000, 01, 01, 16, 21), size=1)
+
+
 class FullTimeValidatorTest(TestCase):
 
     def test_half_a_minute(self):
@@ -216,6 +269,27 @@ class StaticValidatorTest(TestCase):
             validator_function_absolute_name='kitabu.tests.validators.StaticValidatorTest.non_existant_func')
         validator.save(force_validation_function_name=True)
 
+    def test_validation_function_is_resolved_once(self):
+        reservation = MockWithoutId()
+        validator = StaticValidator.objects.create(
+            validator_function_absolute_name='kitabu.tests.validators.StaticValidatorTest.pass_')
+
+        with patch('kitabu.models.validators.import_module') as import_module:
+            validator.validate(reservation)
+            validator.validate(reservation)
+        self.assertFalse(import_module.called)
+
+    def test_warm_static_validators(self):
+        StaticValidator.objects.create(
+            validator_function_absolute_name='kitabu.tests.validators.StaticValidatorTest.pass_')
+        StaticValidator(
+            validator_function_absolute_name='kitabu.tests.validators.StaticValidatorTest.non_existant_func'
+        ).save(force_validation_function_name=True)
+
+        errors = warm_static_validators()
+        self.assertEqual(['kitabu.tests.validators.StaticValidatorTest.non_existant_func'], errors.keys())
+        self.assertIsInstance(errors.values()[0], AttributeError)
+
     @staticmethod
     def fail(reservation):
         raise ReservationError()
@@ -772,6 +846,67 @@ class PeriodsInWeekdaysTest(TestCase):
             self.overlapping_periods_validator.validate(self.reservation)
 
 
+class WeekdayScheduleTest(TestCase):
+    def setUp(self):
+        weekday_schedules.invalidate()
+        self.validator = PeriodsInWeekdaysValidator.objects.create()
+        for weekday, start, end in [
+            (0, time(12, 0), time(14, 0)),
+            (0, time(13, 0), time(15, 0)),
+            (0, time(16, 0), time(23, 59, 59)),
+            (1, time(0), time(10, 0)),
+        ]:
+            WithinDayPeriod.objects.create(validator=self.validator, weekday=weekday, start=start, end=end)
+        self.reservation = MockWithoutId()
+
+    def test_periods_are_merged(self):
+        schedule = WeekdaySchedule([
+            Mock(weekday=6, start=time(10, 0), end=time(12, 0)),
+            Mock(weekday=6, start=time(11, 30), end=time(13, 0)),
+            Mock(weekday=6, start=time(14, 0), end=time(15, 0)),
+            Mock(weekday=6, start=time(15, 0), end=time(16, 0)),
+            Mock(weekday=5, start=None, end=None),
+        ])
+        self.assertEqual([time(10, 0), time(14, 0)], schedule.starts[6])
+        self.assertEqual([time(13, 0), time(16, 0)], schedule.ends[6])
+        self.assertEqual(([time(0)], [time(23, 59, 59)]), (schedule.starts[5], schedule.ends[5]))
+        self.assertTrue(schedule.is_open(6, time(10, 0), time(13, 0)))
+        self.assertFalse(schedule.is_open(6, time(12, 0), time(14, 30)))
+        self.assertFalse(schedule.is_open(0, time(12, 0), time(13, 0)))
+
+    def test_validation_uses_compiled_schedule(self):
+        # Monday: 2013-03-18
+        self.reservation.start = datetime(2013, 03, 18, 12, 0)
+        self.reservation.end = datetime(2013, 03, 18, 15, 0)
+        self.validator.validate(self.reservation)
+
+        with self.assertNumQueries(0):
+            self.reservation.start = datetime(2013, 03, 18, 16, 0)
+            self.reservation.end = datetime(2013, 03, 19, 10, 0)
+            self.validator.validate(self.reservation)
+
+            self.reservation.start = datetime(2013, 03, 18, 14, 0)
+            self.reservation.end = datetime(2013, 03, 18, 17, 0)
+            with self.assertRaises(ForbiddenHours):
+                self.validator.validate(self.reservation)
+
+    def test_cache_is_invalidated_when_periods_change(self):
+        self.reservation.start = datetime(2013, 03, 18, 14, 0)
+        self.reservation.end = datetime(2013, 03, 18, 17, 0)
+        with self.assertRaises(ForbiddenHours):
+            self.validator.validate(self.reservation)
+
+        WithinDayPeriod.objects.create(validator=self.validator, weekday=0, start=time(15, 0), end=time(16, 0))
+        self.validator.validate(self.reservation)
+
+    def test_forbidden_periods(self):
+        self.assertEqual([
+            (datetime(2013, 03, 17, 20, 0), datetime(2013, 03, 18, 12, 0)),
+            (datetime(2013, 03, 18, 15, 0), datetime(2013, 03, 18, 16, 0)),
+            (datetime(2013, 03, 19, 10, 0), datetime(2013, 03, 20, 8, 0)),
+        ], self.validator.get_forbidden_periods(datetime(2013, 03, 17, 20, 0), datetime(2013, 03, 20, 8, 0)))
+
+
 class MaxDurationValidatorTest(TestCase):
     def setUp(self):
         self.two_hours_validator = MaxDurationValidator.objects.create(max_duration_in_seconds=2 * 3600)
@@ -912,3 +1047,22 @@ class MaxReservationsPerUserValidatorTest(TestCase):
             with self.assertRaises(TooManyReservations):
                 # third reservation on the table is not possible because of other tables reservations
                 table.reserve(start=datetime(2000, 2, 1), end=datetime(2000, 2, 3), owner=self.user)
+
+    def test_bulk_validation(self):
+        with patch('kitabu.models.validators.now') as dtmock:
+            dtmock.return_value = datetime(2000, 1, 1)
+            tables = [Table.objects.create() for i in range(3)]
+            tables[0].reserve(start=datetime(2000, 2, 1), end=datetime(2000, 2, 3), owner=self.user)
+            reservations = [
+                table.reservation_model(subject=table, start=datetime(2000, 3, 1), end=datetime(2000, 3, 3),
+                                        owner=self.user)
+                for table in tables
+            ]
+
+            with self.assertNumQueries(2):
+                invalid = self.validator1_2.validate_many(reservations)
+            self.assertEqual([id(reservations[0])], [id(r) for r in invalid])
+
+            tables[1].reserve(start=datetime(2000, 2, 1), end=datetime(2000, 2, 3), owner=self.user)
+            invalid = self.validator1_2.validate_many(reservations)
+            self.assertEqual(3, len(invalid))
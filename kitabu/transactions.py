@@ -0,0 +1,116 @@
+#-*- coding=utf-8 -*-
+"""Running reservations in transactions that are retried on transient errors.
+
+Under concurrent load databases abort some transactions with serialization
+failures or deadlocks. These are safe to run again from the beginning, so
+``RetryPolicy`` does it, waiting a bit longer (with random jitter) before
+each attempt:
+
+    lane.reserve(start=start, end=end, retry_policy=RetryPolicy(attempts=5))
+
+Methods that make reservations in a transaction take ``retry_policy``
+argument and use ``default_retry_policy`` if it is not given. Its number of
+attempts is taken from ``KITABU_TRANSACTION_ATTEMPTS`` setting (3 by
+default).
+
+Each rollback sends ``kitabu.signals.transaction_rolled_back``. Each retry
+then sends ``kitabu.signals.transaction_retried`` and is counted in
+``retries`` of the policy; transactions that failed after all attempts are
+counted in ``failures``.
+
+"""
+
+import sys
+from itertools import count
+from random import uniform
+from time import sleep
+
+from django.conf import settings
+from django.db import transaction
+from django.db.utils import DatabaseError
+
+from kitabu.signals import transaction_retried, transaction_rolled_back
+
+
+# SQLSTATE codes of PostgreSQL and error numbers of MySQL
+RETRYABLE_CODES = frozenset(['40001', '40P01', 1205, 1213])
+
+# Django 1.5 doesn't keep codes of PostgreSQL errors it re-raises
+RETRYABLE_MESSAGES = (
+    'could not serialize access',
+    'deadlock detected',
+    'Deadlock found',
+    'Lock wait timeout exceeded',
+)
+
+
+class RetryPolicy(object):
+    """Run function in a transaction, retrying serialization failures and deadlocks.
+
+    ``attempts`` is the maximal number of times the transaction is run. Wait
+    before n-th retry is ``backoff * 2 ** (n - 1)`` seconds, at most
+    ``max_backoff``, randomly changed by up to ``jitter`` of itself.
+
+    """
+
+    def __init__(self, attempts=None, backoff=0.05, max_backoff=1.0, jitter=0.5):
+        self._attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retries = 0
+        self.failures = 0
+
+    @property
+    def attempts(self):
+        if self._attempts is not None:
+            return self._attempts
+        return getattr(settings, 'KITABU_TRANSACTION_ATTEMPTS', 3)
+
+    def is_retryable(self, exception):
+        if not isinstance(exception, DatabaseError):
+            return False
+        codes = [getattr(exception, 'pgcode', None)] + list(exception.args[:1])
+        if any(code in RETRYABLE_CODES for code in codes if isinstance(code, (basestring, int))):
+            return True
+        message = ' '.join(unicode(arg) for arg in exception.args)
+        return any(retryable_message in message for retryable_message in RETRYABLE_MESSAGES)
+
+    def get_delay(self, retry):
+        delay = min(self.max_backoff, self.backoff * 2 ** (retry - 1))
+        return delay * uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self, function, *args, **kwargs):
+        """Call ``function`` in a transaction and return its result.
+
+        The transaction is committed if ``function`` returns and rolled back
+        if it raises. Retryable errors make the whole transaction run again.
+
+        """
+        for attempt in count(1):
+            try:
+                return self._run_once(function, *args, **kwargs)
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                if not retryable or attempt >= self.attempts:
+                    if retryable:
+                        self.failures += 1
+                    raise
+                self.retries += 1
+                transaction_retried.send(sender=self.__class__, policy=self, attempt=attempt, exception=e)
+                sleep(self.get_delay(attempt))
+
+    @transaction.commit_manually
+    def _run_once(self, function, *args, **kwargs):
+        try:
+            result = function(*args, **kwargs)
+            transaction.commit()
+            return result
+        except Exception:
+            exc_info = sys.exc_info()
+            transaction.rollback()
+            transaction_rolled_back.send(sender=self.__class__, policy=self, exception=exc_info[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+default_retry_policy = RetryPolicy()
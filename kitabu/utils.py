@@ -1,29 +1,69 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from threading import local
 from time import sleep
 
-from django.db.models import Q
-from django.db import transaction
 from django.conf import settings
 from django.utils import timezone
 
+from kitabu.signals import reservations_changed
+from kitabu.transactions import default_retry_policy
+
 
 now = timezone.now
 
 
+def has_size_field(reservation_model):
+    return 'size' in [field.name for field in reservation_model._meta.fields]
+
+
+class ReservationSpan(namedtuple('ReservationSpan', 'subject_id start end size')):
+    """Lightweight, read-only representation of a reservation.
+
+    It holds only what timeline computations need, so prefer it over model
+    instances wherever many reservations are swept through. Build them from
+    a query set with ``load_spans``.
+
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_reservation(cls, reservation):
+        return cls(reservation.subject_id, reservation.start, reservation.end, reservation.size)
+
+
+def load_spans(reservations, chunk_size=1000):
+    """Yield ``ReservationSpan`` of every reservation in ``reservations`` query set.
+
+    No model instances are built and reservations are fetched ``chunk_size``
+    at a time, ordered by primary key, so memory use doesn't grow with
+    number of reservations. For reservations without size field, size is 1.
+
+    """
+    fields = ['pk', 'subject_id', 'start', 'end']
+    with_size = has_size_field(reservations.model)
+    if with_size:
+        fields.append('size')
+    reservations = reservations.order_by('pk').values_list(*fields)
+
+    last_pk = None
+    while True:
+        chunk = reservations if last_pk is None else reservations.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        for values in chunk:
+            yield ReservationSpan(values[1], values[2], values[3], values[4] if with_size else 1)
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1][0]
+
+
 class Timeline(list):
     def __init__(self, subject, start, end):
         self.start = start
         self.end = end
         self.subject = subject
 
-        colliding_reservations = subject.reservation_model.objects.filter(
-            (
-                Q(start__gte=start, start__lt=end)   # start in scope
-                | Q(end__gt=start, end__lte=end)     # end in scope
-                | Q(start__lte=start, end__gte=end)  # covers whole scope
-            ),
-            subject=subject,
-        ).select_related('subject')
+        colliding_reservations = load_spans(subject.reservation_model.colliding_reservations(
+            start=start, end=end, subject=subject))
 
         timeline = defaultdict(lambda: 0)
 
@@ -36,15 +76,68 @@ class Timeline(list):
         return super(Timeline, self).__init__(sorted(timeline.iteritems()))
 
 
+class OverlapMemo(local):
+    """Memo of reservations overlapping periods on subjects, per thread.
+
+    While it is active (``with overlap_memo:``), ``overlapping_spans`` of a
+    subject queries the database only once for the same period, so checks
+    made during one reservation attempt share the result. Blocks may nest;
+    the memo is cleared when the outermost one ends, whenever any
+    reservation is saved or deleted and when a ``RetryPolicy`` transaction
+    is rolled back. Lock rows with ``select_for_update`` of the memo, which
+    also clears it, as spans memoized before the lock may be outdated.
+
+    ``BaseSubject.create_reservation`` activates it; wrap a whole request in
+    it to share spans between several reservations and searches.
+
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.spans = {}
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if not self.depth:
+            self.spans.clear()
+
+    @property
+    def active(self):
+        return self.depth > 0
+
+    def get_spans(self, key, load):
+        """Return spans memoized under ``key``, calling ``load`` if missing."""
+        if not self.active:
+            return load()
+        if key not in self.spans:
+            self.spans[key] = load()
+        return self.spans[key]
+
+    def invalidate(self):
+        self.spans.clear()
+
+    def select_for_update(self, queryset):
+        """Lock rows of ``queryset`` and return them, clearing the memo."""
+        rows = list(queryset.select_for_update())
+        self.invalidate()
+        return rows
+
+
+overlap_memo = OverlapMemo()
+
+
 class EnsureSize(object):
-    def __getattribute__(self, name, *args):
-        try:
-            return super(EnsureSize, self).__getattribute__(name, *args)
-        except AttributeError:
-            if name == 'size':
-                return 1
-            else:
-                raise
+    """Make ``size`` default to 1 for subjects and reservations without it.
+
+    Size is a plain class attribute, so it is shadowed by ``size`` field or
+    property of subclasses and costs nothing on access to other attributes.
+
+    """
+    size = 1
 
 
 class AtomicReserver(object):
@@ -56,6 +149,7 @@ class AtomicReserver(object):
         if settings.SECURE_RESERVATIONS:
             # explicitly lock these subjects before reserving them
             cls._lock_subjects(map(lambda t: t[0], args))
+            cls._lock_periods(args, common_kwargs)
 
         for (subject, specific_kwargs) in args:
             reserve_kwargs = common_kwargs.copy()
@@ -68,21 +162,109 @@ class AtomicReserver(object):
         return reservations
 
     @classmethod
-    @transaction.commit_manually
     def reserve(cls, *args, **kwargs):
-        try:
-            reservations = cls.non_transactional_reserve(*args, **kwargs)
-            transaction.commit()
-            return reservations
-        except:
-            transaction.rollback()
-            raise
+        retry_policy = kwargs.pop('retry_policy', None) or default_retry_policy
+        return retry_policy.run(cls.non_transactional_reserve, *args, **kwargs)
+
+    @classmethod
+    def non_transactional_bulk_reserve(cls, *args, **common_kwargs):
+        """Like ``non_transactional_reserve`` but with few queries per subject.
+
+        Reservations are validated per subject, against reservations fetched
+        with one query, and then inserted with one ``bulk_create`` per
+        reservation model. Model signals are not sent for them; instead
+        ``kitabu.signals.reservations_changed`` is sent once per subject.
+
+        Returned reservations are in order of ``args``. As with
+        ``bulk_create``, their primary keys are not set.
+        ``delay_between_reservations`` is slept after validating every
+        reservation, before any of them is inserted.
+
+        If validators of any subject check other reservations (see
+        ``Validator.checks_other_reservations``), reservations are made one
+        by one with ``non_transactional_reserve`` instead, so that the
+        validators see the ones made before.
+
+        """
+        if cls._validators_check_other_reservations(subject for subject, specific_kwargs in args):
+            return cls.non_transactional_reserve(*args, **common_kwargs)
+
+        delay_time = common_kwargs.pop('delay_between_reservations', None)
+
+        if settings.SECURE_RESERVATIONS:
+            # explicitly lock these subjects before reserving them
+            cls._lock_subjects(map(lambda t: t[0], args))
+            cls._lock_periods(args, common_kwargs)
+
+        reservations = []
+        subjects = {}
+        reservations_by_subject = defaultdict(lambda: [])
+        for (subject, specific_kwargs) in args:
+            reserve_kwargs = common_kwargs.copy()
+            reserve_kwargs.update(specific_kwargs)
+            reservation = subject.build_reservation(**reserve_kwargs)
+            reservations.append(reservation)
+            key = (subject.__class__, subject.pk)
+            subjects[key] = subject
+            reservations_by_subject[key].append(reservation)
+
+        reservations_by_model = defaultdict(lambda: [])
+        for key, subject_reservations in reservations_by_subject.iteritems():
+            subjects[key]._validate_availability(subject_reservations)
+            subjects[key]._before_save_reservations(subject_reservations)
+            reservations_by_model[subject_reservations[0].__class__].extend(subject_reservations)
+            if delay_time is not None:
+                sleep(delay_time * len(subject_reservations))
+
+        for model, model_reservations in reservations_by_model.iteritems():
+            model.objects.bulk_create(model_reservations)
+
+        for key, subject_reservations in reservations_by_subject.iteritems():
+            reservations_changed.send(
+                sender=key[0],
+                subject=subjects[key],
+                start=min(r.start for r in subject_reservations),
+                end=max(r.end for r in subject_reservations),
+            )
+
+        return reservations
+
+    @classmethod
+    def bulk_reserve(cls, *args, **kwargs):
+        retry_policy = kwargs.pop('retry_policy', None) or default_retry_policy
+        return retry_policy.run(cls.non_transactional_bulk_reserve, *args, **kwargs)
+
+    @classmethod
+    def _validators_check_other_reservations(cls, subjects):
+        subjects_by_model = defaultdict(dict)
+        for subject in subjects:
+            subjects_by_model[subject.__class__][subject.pk] = subject
+        return any(model._validators_check_other_reservations(model_subjects.values())
+                   for model, model_subjects in subjects_by_model.iteritems())
 
     @classmethod
     def _lock_subjects(cls, subjects):
         subjects_dict = defaultdict(lambda: [])
         for subject in subjects:
+            if getattr(subject, 'optimistic_locking', False) or getattr(subject, 'bucket_locking', False):
+                # checked when reservations are saved or locked by _lock_periods instead
+                continue
             subjects_dict[subject.__class__].append(subject.pk)
 
         for klass, pks in sorted(subjects_dict.iteritems()):
-            list(klass.objects.select_for_update().filter(pk__in=pks))
+            overlap_memo.select_for_update(klass.objects.filter(pk__in=pks))
+
+    @classmethod
+    def _lock_periods(cls, args, common_kwargs):
+        periods = defaultdict(lambda: [])
+        subjects = {}
+        for (subject, specific_kwargs) in args:
+            if getattr(subject, 'bucket_locking', False):
+                reserve_kwargs = common_kwargs.copy()
+                reserve_kwargs.update(specific_kwargs)
+                key = (subject.__class__.__name__, subject.pk)
+                subjects[key] = subject
+                periods[key].append((reserve_kwargs['start'], reserve_kwargs['end']))
+
+        for key in sorted(periods):
+            subjects[key].lock_periods(periods[key])
@@ -16,6 +16,9 @@ setup(name='kitabu',
           'Django>=1.5',
           'South>=0.7.6',
       ],
+      extras_require={
+          'numpy': ['numpy'],
+      },
       dependency_links=[
       ],
       )